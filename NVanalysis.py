@@ -4,6 +4,7 @@
 
 import pylab as py
 import winspec
+import filecache
 from numpy import ndarray
 
 class Spectrum:
@@ -179,6 +180,13 @@ class Map:
         self._z=[]
         self._nfocus=0
         self._fname = fname
+        
+        # text parsing is slow, so reuse the result of an earlier load if possible
+        state = filecache.load('NVanalysis.Map', fname, filecache.source_version(__file__))
+        if state is not None:
+            self.__dict__.update(state)
+            return
+        
         self._wavelen = py.loadtxt(self._fname)[0]
         
         isReversed = self._wavelen[0] > self._wavelen[-1]
@@ -193,6 +201,8 @@ class Map:
             self.load_focus(data, isReversed)
         if lendiff == 3:
             self.load_map(data, isReversed)
+        
+        filecache.store('NVanalysis.Map', fname, self.__dict__, filecache.source_version(__file__))
     
     def get_wavelen(self):
         return self._wavelen
@@ -0,0 +1,164 @@
+# Header-only index of directories full of PicoHarp 300 (*.phd) files.
+#
+# Opening every file with PicoQuantUtils.Trace just to decide which ones
+# to fit reads and parses every histogram. PhdIndex instead reads only
+# the file headers (PicoQuantUtils.read_phd_header) and keeps a few
+# fields per file in an sqlite database next to the data, so selecting
+# a handful of files out of thousands is a single indexed query.
+#
+# example usage:
+#   idx = PhdIndex( '/data/2013_05_cavities' )
+#   idx.update()  # only (re)reads files that are new or whose mtime/size changed
+#   fnames = idx.select( Resolution=0.004, Tacq=(10000, 60000), Comment='%600nW%' )
+
+import os
+import os.path
+import sqlite3
+import PicoQuantUtils as pq
+
+# column name -> sqlite type for every field we keep
+INDEX_FIELDS = [
+    ( 'Resolution',      'REAL' ),    # ns, curve 0
+    ( 'InpRate0',        'INTEGER' ), # Hz, curve 0 (laser rep. rate)
+    ( 'Tacq',            'INTEGER' ), # ms
+    ( 'NumberOfCurves',  'INTEGER' ),
+    ( 'Comment',         'TEXT' ),
+    ( 'FileTime',        'TEXT' ),    # creation time as written in the ascii header
+    ( 'TimeOfRecording', 'INTEGER' ), # creation time, seconds since 1970 (curve 0)
+    ]
+
+FIELD_NAMES = [ name for name, sqltype in INDEX_FIELDS ]
+
+
+def header_fields( phdfile ):
+    """ return the indexed fields of one .phd file as a dict """
+    header = pq.read_phd_header( phdfile )
+    if header['NumberOfCurves'] > 0:
+        curve0 = header['curveheaders'][0]
+    else:
+        curve0 = dict( Resolution=None, InpRate0=None, TimeOfRecording=None )
+    return dict( Resolution      = curve0['Resolution'],
+                 InpRate0        = curve0['InpRate0'],
+                 Tacq            = header['Tacq'],
+                 NumberOfCurves  = header['NumberOfCurves'],
+                 Comment         = header['Comment'].split('\x00')[0].decode('latin-1').strip(),
+                 FileTime        = header['FileTime'].split('\x00')[0].decode('latin-1').strip(),
+                 TimeOfRecording = curve0['TimeOfRecording'] )
+
+
+class PhdIndex():
+    """ A persistent, queryable index of the headers of all .phd files
+        below the directory `dirname`.
+
+        The index lives in the sqlite file `indexfile` (by default
+        '.phdindex.sqlite' inside dirname), so it survives between
+        sessions; call self.update() to bring it up to date. Paths
+        are stored relative to dirname.
+    """
+    def __init__( self, dirname, indexfile=None, extension='.phd' ):
+        self.dirname = os.path.abspath( dirname )
+        self.extension = extension.lower()
+        if indexfile is None:
+            indexfile = os.path.join( self.dirname, '.phdindex.sqlite' )
+        self.indexfile = indexfile
+        self.db = sqlite3.connect( indexfile )
+        columns = ", ".join( "%s %s" % field for field in INDEX_FIELDS )
+        self.db.execute( "CREATE TABLE IF NOT EXISTS phd ( path TEXT PRIMARY KEY, "
+                         "mtime REAL, size INTEGER, %s )" % columns )
+        for name in ['Resolution', 'InpRate0', 'Tacq', 'TimeOfRecording']:
+            self.db.execute( "CREATE INDEX IF NOT EXISTS idx_%s ON phd (%s)" % (name, name) )
+        self.db.commit()
+
+    def __len__( self ):
+        return self.db.execute( "SELECT COUNT(*) FROM phd" ).fetchone()[0]
+
+    def close( self ):
+        self.db.close()
+
+    def update( self, verbose=False ):
+        """ Walk the directory tree and (re)read the headers of every file
+            that is new or whose mtime or size changed since the last update.
+            Entries for files that no longer exist are removed.
+            Returns the number of files (re)read and removed: (nread, nremoved)
+        """
+        known = dict( (path, (mtime, size)) for path, mtime, size in
+                      self.db.execute( "SELECT path, mtime, size FROM phd" ) )
+        found = set()
+        rows = []
+        for root, dirs, files in os.walk( self.dirname ):
+            for fname in files:
+                if not fname.lower().endswith( self.extension ):
+                    continue
+                fullname = os.path.join( root, fname )
+                path = os.path.relpath( fullname, self.dirname )
+                found.add( path )
+                stat = os.stat( fullname )
+                if known.get( path ) == (stat.st_mtime, stat.st_size):
+                    continue
+                try:
+                    fields = header_fields( fullname )
+                except (TypeError, ValueError, IOError), e:
+                    if verbose: print "Skipping %s: %s" % (path, e)
+                    continue
+                if verbose: print "Indexing", path
+                rows.append( [ path, stat.st_mtime, stat.st_size ] + [ fields[name] for name in FIELD_NAMES ] )
+
+        removed = [ (path,) for path in known if path not in found ]
+        placeholders = ", ".join( ["?"]*(3+len(FIELD_NAMES)) )
+        self.db.executemany( "INSERT OR REPLACE INTO phd VALUES (%s)" % placeholders, rows )
+        self.db.executemany( "DELETE FROM phd WHERE path = ?", removed )
+        self.db.commit()
+        return len(rows), len(removed)
+
+    def _where( self, criteria ):
+        clauses = []
+        params = []
+        for name, value in sorted( criteria.items() ):
+            if name not in FIELD_NAMES:
+                raise ValueError( "Can't query on %s; indexed fields are %s" % (name, FIELD_NAMES) )
+            if isinstance( value, tuple ):
+                # (low, high) range, inclusive; None leaves that side open
+                low, high = value
+                if low is not None:
+                    clauses.append( "%s >= ?" % name )
+                    params.append( low )
+                if high is not None:
+                    clauses.append( "%s <= ?" % name )
+                    params.append( high )
+            elif isinstance( value, basestring ) and '%' in value:
+                clauses.append( "%s LIKE ?" % name )
+                params.append( value )
+            elif name == 'Resolution':
+                # stored as float32 in the file; don't require exact float equality
+                clauses.append( "ABS(%s - ?) < 1e-6" % name )
+                params.append( value )
+            else:
+                clauses.append( "%s = ?" % name )
+                params.append( value )
+        if len(clauses) == 0:
+            return "", params
+        return " WHERE " + " AND ".join( clauses ), params
+
+    def records( self, **criteria ):
+        """ Like self.select(), but return a list of dicts holding the
+            indexed fields (plus 'fname') for each matching file.
+        """
+        where, params = self._where( criteria )
+        cursor = self.db.execute( "SELECT path, %s FROM phd%s ORDER BY path" %
+                                  (", ".join(FIELD_NAMES), where), params )
+        result = []
+        for row in cursor:
+            record = dict( zip( FIELD_NAMES, row[1:] ) )
+            record['fname'] = os.path.join( self.dirname, row[0] )
+            result.append( record )
+        return result
+
+    def select( self, **criteria ):
+        """ Return the (full) file names of all indexed files matching every
+            criterion, sorted by name. Each keyword is one of the indexed
+            fields (see FIELD_NAMES), and its value is either
+                a value the field must equal, e.g. InpRate0=76000000,
+                a tuple (low, high) giving an inclusive range, e.g. Tacq=(1000, None),
+                or a string containing '%' for an sql LIKE match, e.g. Comment='%IRF%'.
+        """
+        return [ record['fname'] for record in self.records( **criteria ) ]
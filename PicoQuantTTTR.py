@@ -0,0 +1,231 @@
+# PicoHarp 300 time-tagged (TTTR) file access: T2 (*.pt2) and T3 (*.pt3) mode, format version 2.0.
+#
+# PicoQuantUtils.Trace only reads histogram-mode (.phd) files. Time-tagged
+# measurements can be many GB, so TTTRFile never loads the whole file: it
+# decodes the records in fixed-size chunks with vectorized bit operations
+# (keeping track of the overflow records across chunks) and accumulates
+# lifetime histograms, binned intensity traces or time-gated lifetime
+# histograms on the fly. Lifetime histograms can be turned into a Trace
+# (see TTTRFile.to_trace) and fit with the usual Trace.fit_exponential.
+#
+# Record layout follows PicoQuant's PT2/PT3 demo code:
+#   T3 record: bits 0-15 nsync, bits 16-27 dtime, bits 28-31 channel
+#   T2 record: bits 0-27 time (4 ps units), bits 28-31 channel
+#   channel 15 marks special records: overflow (dtime/markers == 0) or external markers
+#
+# example usage:
+#   f = TTTRFile( 'longmeasurement.pt3' )
+#   result = f.accumulate( binwidth=1.0e7, gates=[(0, 6.0e10), (6.0e10, 1.2e11)] ) # 10 ms bins, two 60 s gates
+#   trace = f.to_trace( result['lifetime'] )
+#   trace.wrapcurves( 1.17 )
+#   trace.fit_exponential( tstart=trace.get_max()[0], guess=dict( l0=2.0, a0=1.0, b=0.0 ) )
+
+import os.path
+import numpy
+import PicoQuantUtils as pq
+
+# The ascii, binary and board headers of .pt2/.pt3 files have the same layout as
+# those of .phd files (only a few fields have other names: NumberOfCurves is
+# 'Curves', BitsPerHistogramBin is 'BitsPerRecord' and Tacq is 'AcquisitionTime').
+TTTR_HEADER = numpy.dtype([
+    ('ExtDevices',  '<i4'),
+    ('Reserved1',   '<i4'),
+    ('Reserved2',   '<i4'),
+    ('CntRate0',    '<i4'), # Hz, sync (laser) rate
+    ('CntRate1',    '<i4'), # Hz
+    ('StopAfter',   '<i4'), # ms
+    ('StopReason',  '<i4'),
+    ('Records',     '<i4'), # number of records that follow the headers
+    ('ImgHdrSize',  '<i4'), # number of int32 in the imaging header that follows
+    ])
+
+T2_WRAPAROUND = 210698240 # T2 time units per overflow record
+T2_RESOLUTION = 0.004     # ns per T2 time unit
+T3_WRAPAROUND = 65536     # sync periods per overflow record
+T3_DTIME_BINS = 4096      # 12 bit dtime
+
+CHUNKSIZE = 2**20 # records decoded per chunk (4 MB)
+
+
+class TTTRFile():
+    """ A time-tagged PicoHarp file (.pt2 or .pt3). Creating the object reads
+        only the headers; the photon records are decoded chunk by chunk
+        when you ask for a histogram or an intensity trace.
+
+        All times are in ns. For T3 files the micro-time ('delay', the time
+        since the last laser pulse) is the recorded dtime; for T2 files it is
+        the time since the last event on channel 0, which should then carry
+        the sync signal.
+    """
+    def __init__( self, fname, chunksize=CHUNKSIZE ):
+        self.fname = fname
+        self.chunksize = chunksize
+        with open( fname, 'rb' ) as fobj:
+            self.header = pq._record_to_dict( numpy.fromfile( fobj, dtype=pq.PHD_ASCII_HEADER, count=1 )[0] )
+            self.header['FormatVersion'] = self.header['FormatVersion'].strip()
+            if self.header['FormatVersion'] != '2.0':
+                raise TypeError("PicoQuantTTTR.py is only able to load pt2/pt3 file version 2.0. Quitting.")
+            self.header.update( pq._record_to_dict( numpy.fromfile( fobj, dtype=pq.PHD_BINARY_HEADER, count=1 )[0] ) )
+            boards = numpy.fromfile( fobj, dtype=pq.PHD_BOARD_HEADER, count=self.header['NumberOfBoards'] )
+            self.boardheaders = [ pq._record_to_dict( board ) for board in boards ]
+            self.header.update( pq._record_to_dict( numpy.fromfile( fobj, dtype=TTTR_HEADER, count=1 )[0] ) )
+            fobj.seek( 4*self.header['ImgHdrSize'], os.SEEK_CUR )
+            self.data_offset = fobj.tell()
+
+        self.Comment = self.header['Comment'].split('\x00')[0]
+        self.Tacq = self.header['Tacq'] # ms
+        self.Records = self.header['Records']
+        self.CntRate0 = self.header['CntRate0'] # Hz
+        self.tpulse = 1.0e9/self.CntRate0 # ns between laser pulses
+        self.syncperiod = self.tpulse*self.boardheaders[0]['SyncDivider'] # ns between sync events
+        # MeasurementMode is 2 for T2 and 3 for T3 data
+        if self.header['MeasurementMode'] == 2 or fname.lower().endswith('.pt2'):
+            self.mode = 'T2'
+            self.resolution = T2_RESOLUTION
+            self.ndelaybins = int( numpy.ceil( self.syncperiod/self.resolution ) )
+        else:
+            self.mode = 'T3'
+            self.resolution = self.boardheaders[0]['Resolution']
+            self.ndelaybins = T3_DTIME_BINS
+
+    def records( self ):
+        """ Generator over the raw (uint32) records, chunksize at a time. """
+        with open( self.fname, 'rb' ) as fobj:
+            fobj.seek( self.data_offset )
+            remaining = self.Records
+            while remaining > 0:
+                chunk = numpy.fromfile( fobj, dtype='<u4', count=min( self.chunksize, remaining ) )
+                if len(chunk) == 0:
+                    break # file is shorter than the header claims (e.g. aborted measurement)
+                remaining -= len(chunk)
+                yield chunk
+
+    def photons( self ):
+        """ Generator over decoded chunks of photon records. Each chunk is a dict of arrays:
+                'channel'   -- routing channel of each photon
+                'time'      -- arrival time since the start of the measurement (ns, float64)
+                'delay'     -- micro-time since the last sync, in bins of self.resolution (int)
+                'markers'   -- times (ns) of the external marker records in this chunk
+            Overflow records are accounted for across chunk boundaries.
+        """
+        noverflows = 0   # overflows seen in previous chunks
+        last_sync = None # T2 only: time of the last sync event of the previous chunk
+        for rec in self.records():
+            channel = (rec >> 28).astype(numpy.uint8)
+            special = channel == 15
+            if self.mode == 'T3':
+                nsync = (rec & 0xFFFF).astype(numpy.int64)
+                dtime = ((rec >> 16) & 0xFFF).astype(numpy.int64)
+                overflow = special & (dtime == 0)
+                ofl = numpy.cumsum( overflow ) + noverflows
+                noverflows = ofl[-1]
+                time = (ofl*T3_WRAPAROUND + nsync)*self.syncperiod
+                photon = ~special
+                chunk = dict( channel=channel[photon], time=time[photon], delay=dtime[photon],
+                              markers=time[special & ~overflow] )
+            else:
+                ttime = (rec & 0x0FFFFFFF).astype(numpy.int64)
+                overflow = special & ((ttime & 0xF) == 0)
+                ofl = numpy.cumsum( overflow ) + noverflows
+                noverflows = ofl[-1]
+                ticks = ofl*T2_WRAPAROUND + ttime
+                photon = ~special
+                isync = numpy.where( photon & (channel == 0) )[0]
+                # index (into isync) of the last sync at or before each record
+                which = numpy.searchsorted( isync, numpy.arange( len(rec) ), side='right' ) - 1
+                sync_ticks = numpy.where( which >= 0, ticks[ isync[ numpy.maximum( which, 0 ) ] ],
+                                          -1 if last_sync is None else last_sync )
+                if len(isync) > 0:
+                    last_sync = ticks[ isync[-1] ]
+                keep = photon & (channel != 0) & (sync_ticks >= 0)
+                chunk = dict( channel=channel[keep], time=ticks[keep]*T2_RESOLUTION,
+                              delay=ticks[keep] - sync_ticks[keep],
+                              markers=ticks[special & ~overflow]*T2_RESOLUTION )
+            yield chunk
+
+    def accumulate( self, channels=None, binwidth=None, gates=None ):
+        """ Decode the whole file once and return a dict holding
+                'lifetime'  -- histogram of the micro-time (bins of self.resolution)
+                'intensity' -- (if binwidth is given) counts per binwidth ns of
+                               arrival time; bin i starts at i*binwidth
+                'gated'     -- (if gates is given) one lifetime histogram for each
+                               (tstart, tend) window of arrival time (ns) in gates
+            Only photons on the routing channels in `channels` are counted (default: all).
+        """
+        lifetime = numpy.zeros( self.ndelaybins, dtype=numpy.int64 )
+        intensity = numpy.zeros( 0, dtype=numpy.int64 )
+        nintensity = 0 # bins of intensity in use
+        if gates is not None:
+            gates = numpy.asarray( gates, dtype=numpy.float )
+            gated = numpy.zeros( (len(gates), self.ndelaybins), dtype=numpy.int64 )
+
+        for chunk in self.photons():
+            if channels is not None:
+                keep = numpy.in1d( chunk['channel'], channels )
+                for key in ['channel', 'time', 'delay']:
+                    chunk[key] = chunk[key][keep]
+            delay = chunk['delay']
+            inrange = delay < self.ndelaybins
+            lifetime += numpy.bincount( delay[inrange], minlength=self.ndelaybins )
+
+            if binwidth is not None and len(delay) > 0:
+                # count only the bins this chunk spans, not all of them from t=0
+                ibin = (chunk['time']/binwidth).astype(numpy.int64)
+                first = ibin.min()
+                counts = numpy.bincount( ibin - first )
+                end = first + len(counts)
+                if end > len(intensity): # grow geometrically, not once per chunk
+                    grown = numpy.zeros( max( end, 2*len(intensity) ), dtype=numpy.int64 )
+                    grown[:len(intensity)] = intensity
+                    intensity = grown
+                intensity[first:end] += counts
+                nintensity = max( nintensity, end )
+
+            if gates is not None:
+                for i, (tstart, tend) in enumerate( gates ):
+                    ingate = inrange & (chunk['time'] >= tstart) & (chunk['time'] < tend)
+                    gated[i] += numpy.bincount( delay[ingate], minlength=self.ndelaybins )
+
+        result = dict( lifetime=lifetime )
+        if binwidth is not None: result['intensity'] = intensity[:nintensity]
+        if gates is not None: result['gated'] = gated
+        return result
+
+    def lifetime_histogram( self, channels=None ):
+        """ histogram of micro-times (bins of self.resolution ns) """
+        return self.accumulate( channels=channels )['lifetime']
+
+    def intensity_trace( self, binwidth, channels=None ):
+        """ Counts per binwidth (ns) of arrival time. Returns (t, counts),
+            where t (ns) is the start of each bin. """
+        counts = self.accumulate( channels=channels, binwidth=binwidth )['intensity']
+        return numpy.arange( len(counts) )*binwidth, counts
+
+    def gated_histograms( self, gates, channels=None ):
+        """ one lifetime histogram per (tstart, tend) window of arrival time (ns) """
+        return self.accumulate( channels=channels, gates=gates )['gated']
+
+    def intensity_gates( self, binwidth, threshold, channels=None ):
+        """ Windows of arrival time (list of (tstart, tend) in ns) during which the
+            intensity was at least `threshold` counts per binwidth. Pass these to
+            gated_histograms to get e.g. the lifetime of the 'on' state of a blinking emitter.
+        """
+        t, counts = self.intensity_trace( binwidth, channels=channels )
+        on = numpy.concatenate( [ [False], counts >= threshold, [False] ] )
+        edges = numpy.where( numpy.diff( on.astype(numpy.int8) ) )[0]
+        return [ (t[i], t[j-1]+binwidth) for i, j in zip( edges[::2], edges[1::2] ) ]
+
+    def to_trace( self, histogram=None, trace_class=None ):
+        """ Make a Trace (by default a PicoQuantUtils.Trace; pass e.g.
+            trace_class=PicoQuantUtils_FastFit.Trace for deconvolved fits)
+            out of a lifetime histogram, trimmed to one laser period just
+            like the curves of a .phd file, so that it can be wrapped, fit, etc.
+            If histogram is None, the lifetime histogram of all photons is used.
+        """
+        if histogram is None:
+            histogram = self.lifetime_histogram()
+        if trace_class is None:
+            trace_class = pq.Trace
+        nfullbins = min( int( self.tpulse/self.resolution ), len(histogram) )
+        return trace_class.from_histogram( histogram[:nfullbins], self.resolution,
+                                           self.CntRate0, self.Tacq, fname=self.fname )
@@ -12,38 +12,255 @@
 
 import sys
 import os.path
-import struct # deal with binary data
 import pylab
 import numpy
+import filecache
 from scipy.optimize import curve_fit, leastsq
 from scipy.signal import cspline1d, cspline1d_eval
 
+##################################################################################
+#
+# PHD v2.0 header layouts (little-endian, no padding between fields).
+# Each block is decoded with a single numpy.frombuffer call instead of
+# one struct.unpack_from per field.
+#
+##################################################################################
+
+PHD_ASCII_HEADER = numpy.dtype([
+    ('Ident',           'S16'),
+    ('FormatVersion',   'S6'),
+    ('CreatorName',     'S18'),
+    ('CreatorVersion',  'S12'),
+    ('FileTime',        'S18'),
+    ('CRLF',            'S2'),
+    ('Comment',         'S256'),
+    ])
+
+PHD_BINARY_HEADER = numpy.dtype([
+    ('NumberOfCurves',      '<i4'),
+    ('BitsPerHistogramBin', '<i4'),
+    ('RoutingChannels',     '<i4'),
+    ('NumberOfBoards',      '<i4'),
+    ('ActiveCurve',         '<i4'),
+    ('MeasurementMode',     '<i4'),
+    ('SubMode',             '<i4'),
+    ('RangeNo',             '<i4'),
+    ('Offset',              '<i4'),
+    ('Tacq',                '<i4'), # ms
+    ('StopAt',              '<i4'),
+    ('StopOnOverflow',      '<i4'),
+    ('Restart',             '<i4'),
+    ('DispLinLog',          '<i4'),
+    ('DispTimeAxisFrom',    '<i4'), # ns
+    ('DispTimeAxisTo',      '<i4'), # ns
+    ('DispCountAxisFrom',   '<i4'),
+    ('DispCountAxisTo',     '<i4'),
+    ('DispCurves',          [ ('MapTo', '<i4'), ('Show', '<i4') ], (8,)),
+    ('Params',              [ ('Start', '<f4'), ('Step', '<f4'), ('End', '<f4') ], (3,)),
+    ('RepeatMode',          '<i4'),
+    ('RepeatsPerCurve',     '<i4'),
+    ('RepeatTime',          '<i4'),
+    ('RepeatWaitTime',      '<i4'),
+    ('ScriptName',          'S20'),
+    ])
+
+PHD_ROUTER_CHANNEL = [
+    ('InputType',   '<i4'),
+    ('InputLevel',  '<i4'), # mV
+    ('InputEdge',   '<i4'),
+    ('CFDPresent',  '<i4'),
+    ('CFDLevel',    '<i4'), # mV
+    ('CFDZeroCross','<i4'), # mV
+    ]
+
+PHD_BOARD_HEADER = numpy.dtype([
+    ('HardwareIdent',   'S16'),
+    ('HardwareVersion', 'S8'),
+    ('HardwareSerial',  '<i4'),
+    ('SyncDivider',     '<i4'),
+    ('CFDZeroCross0',   '<i4'), # mV
+    ('CFDLevel0',       '<i4'), # mV
+    ('CFDZeroCross1',   '<i4'), # mV
+    ('CFDLevel1',       '<i4'), # mV
+    ('Resolution',      '<f4'), # ns
+    ('RouterModelCode', '<i4'),
+    ('RouterEnabled',   '<i4'),
+    ('RtChan',          PHD_ROUTER_CHANNEL, (4,)),
+    ])
+
+PHD_CURVE_HEADER = numpy.dtype([
+    ('CurveIndex',          '<i4'),
+    ('TimeOfRecording',     '<u4'), # seconds since 00:00:00 Jan 1, 1970 (UTC)
+    ('HardwareIdent',       'S16'),
+    ('HardwareVersion',     'S8'),
+    ('HardwareSerial',      '<i4'),
+    ('SyncDivider',         '<i4'),
+    ('CFDZeroCross0',       '<i4'), # mV
+    ('CFDLevel0',           '<i4'), # mV
+    ('CFDZeroCross1',       '<i4'), # mV
+    ('CFDLevel1',           '<i4'), # mV
+    ('Offset',              '<i4'),
+    ('RoutingChannel',      '<i4'),
+    ('ExtDevices',          '<i4'),
+    ('MeasMode',            '<i4'),
+    ('SubMode',             '<i4'),
+    ('P1',                  '<f4'),
+    ('P2',                  '<f4'),
+    ('P3',                  '<f4'),
+    ('RangeNo',             '<i4'),
+    ('Resolution',          '<f4'), # ns
+    ('Channels',            '<i4'),
+    ('Tacq',                '<i4'), # ms
+    ('StopAfter',           '<i4'), # ms
+    ('StopReason',          '<i4'),
+    ('InpRate0',            '<i4'), # Hz
+    ('InpRate1',            '<i4'), # Hz
+    ('HistCountRate',       '<i4'), # cps
+    ('IntegralCount',       '<i8'),
+    ('Reserved',            '<i4'),
+    ('DataOffset',          '<i4'), # bytes, relative to the start of the file
+    # below is new in format version 2.0
+    ('RouterModelCode',     '<i4'),
+    ('RouterEnabled',       '<i4'),
+    ('RtChan_InputType',    '<i4'),
+    ('RtChan_InputLevel',   '<i4'),
+    ('RtChan_InputEdge',    '<i4'),
+    ('RtChan_CFDPresent',   '<i4'),
+    ('RtChan_CFDLevel',     '<i4'),
+    ('RtChan_CFDZeroCross', '<i4'),
+    ])
+
+assert PHD_ASCII_HEADER.itemsize == 328
+assert PHD_BINARY_HEADER.itemsize == 208
+assert PHD_BOARD_HEADER.itemsize == 156
+assert PHD_CURVE_HEADER.itemsize == 172
+
+PHD_HISTOGRAM_BIN = numpy.dtype('<i4')
+
+# version of the parsed Traces in the file cache: changes with this file (see filecache.py)
+SOURCE_VERSION = filecache.source_version( __file__ )
+
+
+def _record_to_dict( record ):
+    """ convert one record of a structured array into a dict of plain
+        python values (strings are stripped of their trailing NULs by numpy).
+    """
+    return dict( zip( record.dtype.names, record.item() ) )
+
+
+def exponential_keys( num_exp, offset='b' ):
+    """ names of the parameters of a num_exp-exponential fit, in the order
+        fit_exponential uses: [ 'l<num_exp-1>', 'a<num_exp-1>', ..., 'l0', 'a0', offset ]
+    """
+    keylist = []
+    for i in reversed( range( num_exp ) ):
+        keylist += [ 'l%d' % i, 'a%d' % i ]
+    return keylist + [ offset ]
+
+def multi_exponential( t, l, a, b ):
+    """ sum_i |a_i|*exp(-t/|l_i|) + b, for arrays of lifetimes l and amplitudes a """
+    return numpy.dot( numpy.exp( -t[:,None]/abs(l) ), abs(a) ) + b
+
+def multi_exponential_jacobian( t, l, a ):
+    """ derivatives of multi_exponential( t, l, a, b ), one column per parameter
+        in the order [ l[0], a[0], l[1], a[1], ..., b ] (i.e. the order of exponential_keys)
+    """
+    decays = numpy.exp( -t[:,None]/abs(l) )
+    jac = numpy.empty( (len(t), 2*len(l)+1) )
+    jac[:, 0:-1:2] = decays*abs(a)*t[:,None]*numpy.sign(l)/l**2
+    jac[:, 1:-1:2] = decays*numpy.sign(a)
+    jac[:, -1] = 1.0
+    return jac
+
+
+def read_phd_header( phdfile ):
+    """ Read only the headers of a .phd file, skipping the histograms.
+        Returns a dict holding the ASCII and binary file header fields
+        (with the FormatVersion deblanked) plus the key 'curveheaders',
+        the same list of dicts that Trace.curveheaders holds.
+        This is much cheaper than Trace(phdfile) when you only want
+        to know what is in a file (see PicoQuantIndex).
+    """
+    with open( phdfile, 'rb' ) as fobj:
+        header = _record_to_dict( numpy.fromfile( fobj, dtype=PHD_ASCII_HEADER, count=1 )[0] )
+        header['FormatVersion'] = header['FormatVersion'].strip()
+        if header['FormatVersion'] != '2.0':
+            raise TypeError("PicoQuantUtils.py is only able to load phd file version 2.0. Quitting.")
+        header.update( _record_to_dict( numpy.fromfile( fobj, dtype=PHD_BINARY_HEADER, count=1 )[0] ) )
+        fobj.seek( header['NumberOfBoards']*PHD_BOARD_HEADER.itemsize, os.SEEK_CUR )
+        curveheaders = numpy.fromfile( fobj, dtype=PHD_CURVE_HEADER, count=header['NumberOfCurves'] )
+        header['curveheaders'] = [ _record_to_dict( curve ) for curve in curveheaders ]
+    return header
+
+
 class Trace():
     """ A class for holding lifetime data. You pass
         it the name of the phdfile (including .phd)
         and it will load it and offer various methods
         for plotting, wrapping (removing time offset)
         and fitting exponentials.
+
+        Pass memmap=True to skip the int conversion (and the cache):
+        each curve is then a read-only view of the bytes read from the
+        file, only copied (to float) when a method modifies it. This
+        saves time and memory when loading many traces, and keeps no
+        file open.
     """
-    def __init__( self, phdfile ):
+    def __init__( self, phdfile=None, memmap=False ):
         self.fname    = phdfile
         self.has_fit  = False
         self.ax       = None
         self.irf      = None
         self.wraptime = None
         
+        if phdfile is None:
+            return # empty trace, to be filled in by e.g. Trace.from_histogram
+
+        # a file that was parsed before is loaded from the cache (see filecache.py);
+        # memmap=True is for loading many traces cheaply, which skips the cache.
+        state = None if memmap else filecache.load( 'PicoQuantUtils.Trace', phdfile, SOURCE_VERSION )
+        if state is not None:
+            self.__dict__.update( state )
+            return
+
+        unparsed = set( self.__dict__.keys() )
         with open( phdfile, 'rb' ) as self.fobj:
             self.readasciiheader( verbose=False )
             self.readbinaryheader( verbose=False )
             self.readboardheader()
             self.readcurveheaders( verbose=False )
-            self.readhistograms()
+            self.readhistograms( memmap=memmap )
             self.resolution = self.curveheaders[0]['Resolution'] # curve 0 resolution, actually (ns)
             self.t = []
             for i, curve in enumerate( self.curves ):
                 self.t.append( pylab.arange(len(curve))*self.curveheaders[i]['Resolution'] )# this is in ns
             self.raw_t = self.t[:]
-        
+        if not memmap:
+            state = dict( (key, value) for key, value in self.__dict__.iteritems()
+                          if key not in unparsed and key != 'fobj' )
+            filecache.store( 'PicoQuantUtils.Trace', phdfile, state, SOURCE_VERSION )
+        
+    @classmethod
+    def from_histogram( cls, curve, resolution, inprate0, tacq, fname=None ):
+        """ Make a Trace out of a histogram that didn't come from a .phd file,
+            e.g. one built from time-tagged (.pt2/.pt3) data by PicoQuantTTTR.
+            resolution is the bin width (ns), inprate0 the laser repetition
+            rate (Hz) and tacq the acquisition time (ms), just like the
+            corresponding .phd header entries.
+        """
+        trace = cls()
+        trace.fname = fname
+        trace.Tacq = tacq
+        trace.NumberOfCurves = 1
+        trace.curveheaders = [ dict( Resolution=resolution, InpRate0=inprate0,
+                                     Tacq=tacq, Channels=len(curve) ) ]
+        trace.curves = [ numpy.asarray( curve ) ]
+        trace.raw_curves = trace.curves[:]
+        trace.resolution = resolution
+        trace.t = [ pylab.arange(len(curve))*resolution ]
+        trace.raw_t = trace.t[:]
+        return trace
+
     def fit_exponential( 
             self, 
             tstart       = 0.0, 
@@ -58,7 +275,7 @@ class Trace():
         fit a function of exponentials to a single curve of the file
         (my files only have one curve at this point anyway,
         curve 0). 
-        The parameter num_exp (default is 1, max is 3) defines the number of
+        The parameter num_exp (default is 1) defines the number of
         exponentials in the funtion to be fitted.
         num_exp=1 yields:
         f(t) = a0*exp(-t/l0) + b
@@ -89,51 +306,36 @@ class Trace():
         tpulse = 1.0e9/self.curveheaders[0]['InpRate0'] # avg. time between pulses, in ns
 
         if num_exp is None:
-            num_exp = (1 + int(guess.has_key('l1')) +
-                     int(guess.has_key('l2')) +
-                     int(guess.has_key('l3')) +
-                     int(guess.has_key('l4')))
-            num_a   = (1 + int(guess.has_key('a1')) +
-                     int(guess.has_key('a2')) +
-                     int(guess.has_key('a3')) +
-                     int(guess.has_key('a4')))
+            num_exp = 1
+            while guess.has_key( 'l%d' % num_exp ): num_exp += 1
+            num_a = 1
+            while guess.has_key( 'a%d' % num_a ): num_a += 1
             if num_exp != num_a:
                 raise ValueError("Missing a parameter! Unequal number of lifetimes and amplitudes.")
 
-        keylist = [ "l0", "a0", "b" ]
-        errlist = [ "l0_err", "a0_err" ]
-        if num_exp == 2:
-            keylist = [ "l1", "a1", "l0", "a0", "b" ]
-            errlist = [ "l1_err", "a1_err", "l0_err", "a0_err" ]
-        elif num_exp == 3 and not guess.has_key('t_ag') and not guess.has_key('t_d3'):
-            keylist = [ "l2", "a2", "l1", "a1", "l0", "a0", "b" ]
-            errlist = [ "l2_err", "a2_err", "l1_err", "a1_err", "l0_err", "a0_err" ]
-        elif num_exp == 3 and guess.has_key('t_ag'):
-            keylist = [ "l2", "a2", "l1", "a1", "l0", "a0", "t_ag" ]
-            errlist = [ "l2_err", "a2_err", "l1_err", "a1_err", "l0_err", "a0_err" ]
-        elif num_exp == 3 and guess.has_key('t_d3'):
-            keylist = [ "l2", "a2", "l1", "a1", "l0", "a0", "t_d3" ]
-            errlist = [ "l2_err", "a2_err", "l1_err", "a1_err", "l0_err", "a0_err" ]
-        elif num_exp == 4:
-            keylist = [ "l3", "a3", "l2", "a2", "l1", "a1", "l0", "a0", "b" ]
-            errlist = [ "l3_err", "a3_err", "l2_err", "a2_err", "l1_err", "a1_err", "l0_err", "a0_err" ]
-        elif num_exp == 5:
-            keylist = [ "l4", "a4", "l3", "a3", "l2", "a2", "l1", "a1", "l0", "a0", "b" ]
-            errlist = [ "l4_err", "a4_err", "l3_err", "a3_err", "l2_err", "a2_err", "l1_err", "a1_err", "l0_err", "a0_err" ]
+        if guess.has_key('t_ag'):
+            keylist = exponential_keys( num_exp, offset='t_ag' )
+        elif guess.has_key('t_d3'):
+            keylist = exponential_keys( num_exp, offset='t_d3' )
+        else:
+            keylist = exponential_keys( num_exp )
+        errlist = [ key+"_err" for key in keylist[:-1] ]
                     
                     
         if deconvolve==False:
             params = [ guess[key] for key in keylist ]
             free_params = [ i for i,key in enumerate(keylist) if not key in fixed_params ]
             initparams = [ guess[key] for key in keylist if not key in fixed_params ]
-            def f(t, *args ):
-                for i,arg in enumerate(args): params[ free_params[i] ] = arg
-                local_params = params[:]
-                b = local_params.pop(-1)
-                result = pylab.zeros(len(t))
-                for l,a in zip(params[::2],params[1::2]):
-                    result += abs(a)*pylab.exp(-(t-tstart)/abs(l))
-                return result+b
+            # model and its analytic jacobian (columns of the free parameters only),
+            # so the solver doesn't need extra model evaluations for finite differences
+            all_params = numpy.array( params, dtype=numpy.float )
+            def f( t, *args ):
+                all_params[ free_params ] = args
+                return multi_exponential( t-tstart, all_params[0:-1:2], all_params[1:-1:2], all_params[-1] )
+
+            def jac( t, *args ):
+                all_params[ free_params ] = args
+                return multi_exponential_jacobian( t-tstart, all_params[0:-1:2], all_params[1:-1:2] )[:, free_params]
 
         else:
             raise NameError("Deconvolution with this module is not kept current. Use FastFit module from fit directory instead.")
@@ -189,7 +391,8 @@ class Trace():
         self.bestparams, self.pcov = curve_fit( f, self.t[curve_num][istart:iend],
                                         self.curves[curve_num][istart:iend],
                                         p0=initparams,
-                                        sigma=sigma)
+                                        sigma=sigma,
+                                        jac=jac)
 
         if pylab.size(self.pcov) > 1 and len(pylab.find(self.pcov == pylab.inf))==0:
             self.stderr = pylab.sqrt( pylab.diag(self.pcov) ) # is this true?
@@ -229,12 +432,8 @@ class Trace():
         for l,a,lkey,akey in zip(stderr[::2],stderr[1::2],errlist[::2],errlist[1::2]):
             self.fitresults[lkey] = l
             self.fitresults[akey] = a
-        self.fitresults['l0_int'] = self.fitresults['l0']*self.fitresults['a0']
-
-        if num_exp > 1: self.fitresults['l1_int'] = self.fitresults['l1']*self.fitresults['a1']
-        if num_exp > 2: self.fitresults['l2_int'] = self.fitresults['l2']*self.fitresults['a2']
-        if num_exp > 3: self.fitresults['l3_int'] = self.fitresults['l3']*self.fitresults['a3']
-        if num_exp > 4: self.fitresults['l4_int'] = self.fitresults['l4']*self.fitresults['a4']
+        for i in range( num_exp ):
+            self.fitresults['l%d_int' % i] = self.fitresults['l%d' % i]*self.fitresults['a%d' % i]
 
         self.bestfit = f( self.t[curve_num][istart:iend], *self.bestparams )
         if deconvolve: self.model = fmodel( self.t[curve_num][istart:iend], *self.bestparams )
@@ -250,30 +449,11 @@ class Trace():
             print "Fit results: (Reduced Chi2 = %.3E)" % (self.fitresults['ReducedChi2'])
             print "             (MSE = %.3E)" % (self.fitresults['MSE'])
             print "  Offset/t_ag/scale = %.3f +-%.3e" % (self.fitresults['b'], self.fitresults['b_err'])
-            print "  l0=%.3f +-%.3f ns, a0=%.3e +-%.3e" % (self.fitresults['l0'],
-                                                            self.fitresults['l0_err'],
-                                                            self.fitresults['a0'],
-                                                            self.fitresults['a0_err'])
-            if num_exp > 1:
-                print "  l1=%.3f +-%.3f ns, a1=%.3e +-%.3e" % (self.fitresults['l1'],
-                                                            self.fitresults['l1_err'],
-                                                            self.fitresults['a1'],
-                                                            self.fitresults['a1_err'])
-            if num_exp > 2:
-                print "  l2=%.3f +-%.3f ns, a2=%.3e +-%.3e" % (self.fitresults['l2'],
-                                                            self.fitresults['l2_err'],
-                                                            self.fitresults['a2'],
-                                                            self.fitresults['a2_err'])
-            if num_exp > 3:
-                print "  l3=%.3f +-%.3f ns, a3=%.3e +-%.3e" % (self.fitresults['l3'],
-                                                            self.fitresults['l3_err'],
-                                                            self.fitresults['a3'],
-                                                            self.fitresults['a3_err'])
-            if num_exp > 4:
-                print "  l4=%.3f +-%.3f ns, a4=%.3e +-%.3e" % (self.fitresults['l4'],
-                                                            self.fitresults['l4_err'],
-                                                            self.fitresults['a4'],
-                                                            self.fitresults['a4_err'])
+            for i in range( num_exp ):
+                print "  l%d=%.3f +-%.3f ns, a%d=%.3e +-%.3e" % (i, self.fitresults['l%d' % i],
+                                                             self.fitresults['l%d_err' % i],
+                                                             i, self.fitresults['a%d' % i],
+                                                             self.fitresults['a%d_err' % i])
             print " "
 
         self.has_fit = True
@@ -465,147 +645,32 @@ class Trace():
         #
         ##################################################################################
         """
-            I use the struct module to unpack the binary SPE data.
-            Some useful formats for struct.unpack_from() include:
-            fmt   c type          python
-            c     char            string of length 1
-            s     char[]          string (Ns is a string N characters long)
-            h     short           integer 
-            H     unsigned short  integer
-            l     long            integer
-            f     float           float
-            d     double          float
-            
-            precede these with '=' to force usage of standard python sizes,
-            not native sizes (to make usage the same on 32 and 64-bit systems)
+            The layout of the header is declared once in PHD_BINARY_HEADER
+            (a numpy structured dtype, see top of this module), so the whole
+            208-byte block is decoded with a single numpy.frombuffer call.
+            Every scalar field becomes an attribute of the same name, e.g.
+            self.NumberOfCurves or self.Tacq (acquisition time in ms).
         """
         
-        binheader = self.fobj.read( 208 ) # should take up 208 bytes in memory...
+        binheader = numpy.frombuffer( self.fobj.read( PHD_BINARY_HEADER.itemsize ),
+                                      dtype=PHD_BINARY_HEADER, count=1 )[0]
+        self.binaryheader = _record_to_dict( binheader )
 
-        self.NumberOfCurves = struct.unpack_from( "=l", binheader, offset=0 )[0]
-        if verbose: 
-            print "Number of curves:", self.NumberOfCurves
-        
-        self.BitsPerHistogramBin = struct.unpack_from( "=l", binheader, offset=4 )[0]
-        if verbose: 
-            print "Bits per histogram bin:", self.BitsPerHistogramBin
-        
-        self.RoutingChannels = struct.unpack_from( "=l", binheader, offset=8 )[0]
-        if verbose: 
+        for name in PHD_BINARY_HEADER.names:
+            if PHD_BINARY_HEADER[name].shape == ():
+                setattr( self, name, self.binaryheader[name] )
+
+        self.DispCurveMapTo = binheader['DispCurves']['MapTo'].tolist()
+        self.DispCurveShow = binheader['DispCurves']['Show'].tolist()
+        self.ParamStart = binheader['Params']['Start'].tolist()
+        self.ParamStep = binheader['Params']['Step'].tolist()
+        self.ParamEnd = binheader['Params']['End'].tolist()
 
-            print "Number of routing channels:", self.RoutingChannels
-        
-        self.NumberOfBoards = struct.unpack_from( "=l", binheader, offset=12 )[0]
-        if verbose: 
-            print "Number of boards:", self.NumberOfBoards
-        
-        self.ActiveCurve = struct.unpack_from( "=l", binheader, offset=16 )[0]
-        if verbose: 
-            print "Active curve:", self.ActiveCurve
-        
-        self.MeasurementMode = struct.unpack_from( "=l", binheader, offset=20 )[0]
-        if verbose: 
-            print "Measurement mode:", self.MeasurementMode
-        
-        self.SubMode = struct.unpack_from( "=l", binheader, offset=24 )[0]
-        if verbose: 
-            print "Sub mode:", self.SubMode
-        
-        self.RangeNo = struct.unpack_from( "=l", binheader, offset=28 )[0]
-        if verbose: 
-            print "Range number:", self.RangeNo
-        
-        self.Offset = struct.unpack_from( "=l", binheader, offset=32 )[0]
-        if verbose: 
-            print "Offset:", self.Offset
-        
-        self.Tacq = struct.unpack_from( "=l", binheader, offset=36 )[0]
-        if verbose: 
-            print "Acquisition time (ms):", self.Tacq
-        
-        self.StopAt = struct.unpack_from( "=l", binheader, offset=40 )[0]
-        if verbose: 
-            print "Stop at (counts):", self.StopAt
-        
-        self.StopOnOverflow = struct.unpack_from( "=l", binheader, offset=44 )[0]
-        if verbose: 
-            print "Stop on overflow:", self.StopOnOverflow
-        
-        self.Restart = struct.unpack_from( "=l", binheader, offset=48 )[0]
-        if verbose: 
-            print "Restart:", self.Restart
-        
-        self.DispLinLog = struct.unpack_from( "=l", binheader, offset=52 )[0]
-        if verbose: 
-            print "Display lin/log:", self.DispLinLog
-        
-        self.DispTimeAxisFrom = struct.unpack_from( "=l", binheader, offset=56 )[0]
-        if verbose: 
-            print "Time axis from (ns):", self.DispTimeAxisFrom
-        
-        self.DispTimeAxisTo = struct.unpack_from( "=l", binheader, offset=60 )[0]
-        if verbose: 
-            print "Time axis to (ns):", self.DispTimeAxisTo
-        
-        self.DispCountAxisFrom = struct.unpack_from( "=l", binheader, offset=64 )[0]
-        if verbose: 
-            print "Count Axis From:", self.DispCountAxisFrom
-        
-        offset = 68
-        self.DispCountAxisTo = struct.unpack_from( "=l", binheader, offset=offset )[0]
-        if verbose: 
-            print "Count Axis To:", self.DispCountAxisTo
-        
-        self.DispCurveMapTo = []
-        self.DispCurveShow = []    
-        for i in range(8):
-            offset += 4
-            self.DispCurveMapTo.append( struct.unpack_from( "=l", binheader, offset=offset )[0] )
-            offset += 4
-            self.DispCurveShow.append( struct.unpack_from( "=l", binheader, offset=offset+4 )[0] )
-
-        self.ParamStart = []
-        self.ParamStep = []
-        self.ParamEnd = []    
-        for i in range(3):
-            offset += 4
-            self.ParamStart.append( struct.unpack_from( "=f", binheader, offset=offset )[0] )
-
-            offset += 4
-            self.ParamStep.append( struct.unpack_from( "=f", binheader, offset=offset )[0] )
-
-            offset += 4
-            self.ParamEnd.append( struct.unpack_from( "=f", binheader, offset=offset )[0] )
-            
-        offset += 4
-        self.RepeatMode = struct.unpack_from( "=l", binheader, offset=offset )[0]
-        if verbose: 
-            print "Repeat Mode:", self.RepeatMode
-        
-        offset += 4
-        self.RepeatsPerCurve = struct.unpack_from( "=l", binheader, offset=offset )[0]
-        if verbose: 
-            print "Repeat / Curve:", self.RepeatsPerCurve
-        
-        offset += 4
-        self.RepeatTime = struct.unpack_from( "=l", binheader, offset=offset )[0]
-        if verbose: 
-            print "Repeat Time:", self.RepeatTime
-        
-        offset += 4
-        self.RepeatWaitTime = struct.unpack_from( "=l", binheader, offset=offset )[0]
-        if verbose: 
-            print "Repeat Wait Time:", self.RepeatWaitTime
-        
-        offset += 4
-        self.ScriptName = struct.unpack_from( "=l", binheader, offset=offset )[0]
         if verbose: 
-            print "Script Name:", self.ScriptName
+            for name in PHD_BINARY_HEADER.names:
+                print "%s:" % name, self.binaryheader[name]
     
     
-
-
-
     def readboardheader( self, verbose=False ):
         """ read this after the ascii header and the binary header. """
 
@@ -615,126 +680,15 @@ class Trace():
         #
         ##################################################################################
 
-        boardheader = self.fobj.read( 156 )
-        # I don't actually do anything with this at this point. Just get it out of the way...
-
-
-        """
-        for i = 1:NumberOfBoards
-        fprintf(1,'-------------------------------------\n') 
-        fprintf(1,'            Board No: #d\n', i-1)
-
-        HardwareIdent(:,i) = char(fread(fid, 16, 'char'))
-        fprintf(1,' Hardware Identifier: #s\n', HardwareIdent(:,i))
-
-        HardwareVersion(:,i) = char(fread(fid, 8, 'char'))
-        fprintf(1,'    Hardware Version: #s\n', HardwareVersion(:,i))    
-            
-        HardwareSerial(i) = fread(fid, 1, 'int32')
-        fprintf(1,'    HW Serial Number: #d\n', HardwareSerial(i))
-
-        SyncDivider(i) = fread(fid, 1, 'int32')
-        fprintf(1,'        Sync divider: #d \n', SyncDivider(i))
-         
-        CFDZeroCross0(i) = fread(fid, 1, 'int32')
-        fprintf(1,'     CFD 0 ZeroCross: #3i mV\n', CFDZeroCross0(i))
-
-        CFDLevel0(i) = fread(fid, 1, 'int32')
-        fprintf(1,'     CFD 0 Discr.   : #3i mV\n', CFDLevel0(i))
-
-        CFDZeroCross1(i) = fread(fid, 1, 'int32')
-        fprintf(1,'     CFD 1 ZeroCross: #3i mV\n', CFDZeroCross1(i))
-
-        CFDLevel1(i) = fread(fid, 1, 'int32')
-        fprintf(1,'     CFD 1 Discr.   : #3i mV\n', CFDLevel1(i))
-
-        Resolution(i) = fread(fid, 1, 'float')
-        fprintf(1,'          Resolution: #2.6g ns\n', Resolution(i))
-
-        # below is new in format version 2.0
-
-        RouterModelCode(i)      = fread(fid, 1, 'int32')
-        RouterEnabled(i)        = fread(fid, 1, 'int32')
-
-        # Router Ch1
-        RtChan1_InputType(i)    = fread(fid, 1, 'int32')
-        RtChan1_InputLevel(i)   = fread(fid, 1, 'int32')
-        RtChan1_InputEdge(i)    = fread(fid, 1, 'int32')
-        RtChan1_CFDPresent(i)   = fread(fid, 1, 'int32')
-        RtChan1_CFDLevel(i)     = fread(fid, 1, 'int32')
-        RtChan1_CFDZeroCross(i) = fread(fid, 1, 'int32')
-        # Router Ch2
-        RtChan2_InputType(i)    = fread(fid, 1, 'int32')
-        RtChan2_InputLevel(i)   = fread(fid, 1, 'int32')
-        RtChan2_InputEdge(i)    = fread(fid, 1, 'int32')
-        RtChan2_CFDPresent(i)   = fread(fid, 1, 'int32')
-        RtChan2_CFDLevel(i)     = fread(fid, 1, 'int32')
-        RtChan2_CFDZeroCross(i) = fread(fid, 1, 'int32')
-        # Router Ch3
-        RtChan3_InputType(i)    = fread(fid, 1, 'int32')
-        RtChan3_InputLevel(i)   = fread(fid, 1, 'int32')
-        RtChan3_InputEdge(i)    = fread(fid, 1, 'int32')
-        RtChan3_CFDPresent(i)   = fread(fid, 1, 'int32')
-        RtChan3_CFDLevel(i)     = fread(fid, 1, 'int32')
-        RtChan3_CFDZeroCross(i) = fread(fid, 1, 'int32')
-        # Router Ch4
-        RtChan4_InputType(i)    = fread(fid, 1, 'int32')
-        RtChan4_InputLevel(i)   = fread(fid, 1, 'int32')
-        RtChan4_InputEdge(i)    = fread(fid, 1, 'int32')
-        RtChan4_CFDPresent(i)   = fread(fid, 1, 'int32')
-        RtChan4_CFDLevel(i)     = fread(fid, 1, 'int32')
-        RtChan4_CFDZeroCross(i) = fread(fid, 1, 'int32')
-
-        # Router settings are meaningful only for an existing router:
-
-        if RouterModelCode(i)>0
-
-
-            fprintf(1,'-------------------------------------\n') 
-            fprintf(1,'   Router Model Code: #d \n', RouterModelCode(i))
-            fprintf(1,'      Router Enabled: #d \n', RouterEnabled(i))
-            fprintf(1,'-------------------------------------\n') 
-            
-            # Router Ch1 
-            fprintf(1,'RtChan1 InputType   : #d \n', RtChan1_InputType(i))
-            fprintf(1,'RtChan1 InputLevel  : #4i mV\n', RtChan1_InputLevel(i))
-            fprintf(1,'RtChan1 InputEdge   : #d \n', RtChan1_InputEdge(i))
-            fprintf(1,'RtChan1 CFDPresent  : #d \n', RtChan1_CFDPresent(i))
-            fprintf(1,'RtChan1 CFDLevel    : #4i mV\n', RtChan1_CFDLevel(i))
-            fprintf(1,'RtChan1 CFDZeroCross: #4i mV\n', RtChan1_CFDZeroCross(i))
-            fprintf(1,'-------------------------------------\n') 
-
-            # Router Ch2
-            fprintf(1,'RtChan2 InputType   : #d \n', RtChan2_InputType(i))
-            fprintf(1,'RtChan2 InputLevel  : #4i mV\n', RtChan2_InputLevel(i))
-            fprintf(1,'RtChan2 InputEdge   : #d \n', RtChan2_InputEdge(i))
-            fprintf(1,'RtChan2 CFDPresent  : #d \n', RtChan2_CFDPresent(i))
-            fprintf(1,'RtChan2 CFDLevel    : #4i mV\n', RtChan2_CFDLevel(i))
-            fprintf(1,'RtChan2 CFDZeroCross: #4i mV\n', RtChan2_CFDZeroCross(i))
-            fprintf(1,'-------------------------------------\n') 
-
-            # Router Ch3
-            fprintf(1,'RtChan3 InputType   : #d \n', RtChan3_InputType(i))
-            fprintf(1,'RtChan3 InputLevel  : #4i mV\n', RtChan3_InputLevel(i))
-            fprintf(1,'RtChan3 InputEdge   : #d \n', RtChan3_InputEdge(i))
-            fprintf(1,'RtChan3 CFDPresent  : #d \n', RtChan3_CFDPresent(i))
-            fprintf(1,'RtChan3 CFDLevel    : #4i mV\n', RtChan3_CFDLevel(i))
-            fprintf(1,'RtChan3 CFDZeroCross: #4i mV\n', RtChan3_CFDZeroCross(i))
-            fprintf(1,'-------------------------------------\n') 
-
-            # Router Ch4
-            fprintf(1,'RtChan4 InputType   : #d \n', RtChan4_InputType(i))
-            fprintf(1,'RtChan4 InputLevel  : #4i mV\n', RtChan4_InputLevel(i))
-            fprintf(1,'RtChan4 InputEdge   : #d \n', RtChan4_InputEdge(i))
-            fprintf(1,'RtChan4 CFDPresent  : #d \n', RtChan4_CFDPresent(i))
-            fprintf(1,'RtChan4 CFDLevel    : #4i mV\n', RtChan4_CFDLevel(i))
-            fprintf(1,'RtChan4 CFDZeroCross: #4i mV\n', RtChan4_CFDZeroCross(i))
-            fprintf(1,'-------------------------------------\n') 
-         
-        end
-        end
-    """
+        boardheaders = numpy.frombuffer( self.fobj.read( self.NumberOfBoards*PHD_BOARD_HEADER.itemsize ),
+                                         dtype=PHD_BOARD_HEADER, count=self.NumberOfBoards )
+        self.boardheaders = [ _record_to_dict( board ) for board in boardheaders ]
 
+        if verbose:
+            for i, board in enumerate( self.boardheaders ):
+                print "Board No:", i
+                for name in PHD_BOARD_HEADER.names:
+                    print "  %s:" % name, board[name]
 
 
     def readcurveheaders( self, verbose=False ):
@@ -746,196 +700,22 @@ class Trace():
         #
         ##################################################################################
 
-        MAXCURVES = 512
-        binheader = self.fobj.read( 150*MAXCURVES )
+        #  The PicoHarp software saves the time of recording
+        #  in a 32 bit serial time value as defined in all C libraries.
+        #  This equals the number of seconds elapsed since midnight
+        #  (00:00:00), January 1, 1970, coordinated universal time.
+        #  (i.e. time.gmtime( ch['TimeOfRecording'] ) gives the date)
+        curveheaders = numpy.frombuffer( self.fobj.read( self.NumberOfCurves*PHD_CURVE_HEADER.itemsize ),
+                                         dtype=PHD_CURVE_HEADER, count=self.NumberOfCurves )
+        self.curveheaders = [ _record_to_dict( curve ) for curve in curveheaders ]
 
-        offset = 0
-        self.curveheaders = []
-
-        for i in range( self.NumberOfCurves ):
-            ch = dict()
-            
-            ch['CurveIndex'] = struct.unpack_from( "=l", binheader, offset=offset )[0]
-            if verbose:
-                print "Curve index:", ch['CurveIndex']
-            offset += 4
-                    
-            ch['TimeOfRecording'] = struct.unpack_from( "=l", binheader, offset=offset )[0] # supposed to be unsigned long...
-            if verbose: 
-                print "Repeat Wait Time:", ch['TimeOfRecording']
-            #  The PicoHarp software saves the time of recording
-            #  in a 32 bit serial time value as defined in all C libraries.
-            #  This equals the number of seconds elapsed since midnight
-            #  (00:00:00), January 1, 1970, coordinated universal time.
-            #  The conversion to normal date and time strings is tricky...
-            #  In matlab: (but we need it to be a uint32, which it's not, so I won't implement the conversion here)
-            #  TimeOfRecording(i) = TimeOfRecording(i)/24/60/60+25569+693960
-            #  fprintf(1,'  Time of Recording: #s \n', datestr(TimeOfRecording(i),'dd-mmm-yyyy HH:MM:SS'))
-            offset += 4
-
-            ch['HardwareIdent'] = struct.unpack_from( "=16s", binheader, offset=offset )[0]
-            if verbose: 
-                print "Repeat Wait Time:", ch['HardwareIdent']
-            offset += 16
-        
-            ch['HardwareVersion'] = struct.unpack_from( "=8s", binheader, offset=offset )[0]
-            if verbose: 
-                print "Hardware Version:", ch['HardwareVersion']
-            offset += 8
-        
-            ch['HardwareSerial'] = struct.unpack_from( "=l", binheader, offset=offset )[0]
-            if verbose: 
-                print "HW Serial Number:", ch['HardwareSerial']
-            offset += 4
-        
-            ch['SyncDivider'] = struct.unpack_from( "=l", binheader, offset=offset )[0]
-            if verbose: 
-                print "Sync divider:", ch['SyncDivider']
-            offset += 4
-        
-            ch['CFDZeroCross0'] = struct.unpack_from( "=l", binheader, offset=offset )[0]
-            if verbose: 
-                print "CFD 0 ZeroCross (mV):", ch['CFDZeroCross0']
-            offset += 4
-        
-            ch['CFDLevel0'] = struct.unpack_from( "=l", binheader, offset=offset )[0]
-            if verbose: 
-                print "CFD 0 Discr. (mV):", ch['CFDLevel0']
-            offset += 4
-        
-            ch['CFDZeroCross1'] = struct.unpack_from( "=l", binheader, offset=offset )[0]
-            if verbose: 
-                print "CFD 1 ZeroCross (mV):", ch['CFDZeroCross1']
-            offset += 4
-        
-            ch['CFDLevel1'] = struct.unpack_from( "=l", binheader, offset=offset )[0]
-            if verbose: 
-                print "CFD 1 Discr. (mV):", ch['CFDLevel1']
-            offset += 4
-        
-            ch['Offset'] = struct.unpack_from( "=l", binheader, offset=offset )[0]
-            if verbose: 
-                print "Offset:", ch['Offset']
-            offset += 4
-        
-            ch['RoutingChannel'] = struct.unpack_from( "=l", binheader, offset=offset )[0]
-            if verbose: 
-                print "Routing Channel:", ch['RoutingChannel']
-            offset += 4
-        
-            ch['ExtDevices'] = struct.unpack_from( "=l", binheader, offset=offset )[0]
-            if verbose: 
-                print "External Devices:", ch['ExtDevices']
-            offset += 4
-        
-            ch['MeasMode'] = struct.unpack_from( "=l", binheader, offset=offset )[0]
-            if verbose: 
-                print "Measure mode:", ch['MeasMode']
-            offset += 4
-        
-            ch['SubMode'] = struct.unpack_from( "=l", binheader, offset=offset )[0]
-            if verbose: 
-                print "Sub-Mode:", ch['SubMode']
-            offset += 4
-        
-            ch['P1'] = struct.unpack_from( "=f", binheader, offset=offset )[0]
-            if verbose: 
-                print "P1:", ch['P1']
-            offset += 4
-        
-            ch['P2'] = struct.unpack_from( "=f", binheader, offset=offset )[0]
-            if verbose: 
-                print "P2:", ch['P2']
-            offset += 4
-        
-            ch['P3'] = struct.unpack_from( "=f", binheader, offset=offset )[0]
-            if verbose: 
-                print "P3:", ch['P3']
-            offset += 4
-        
-            ch['RangeNo'] = struct.unpack_from( "=l", binheader, offset=offset )[0]
-            if verbose: 
-                print "Range No.:", ch['RangeNo']
-            offset += 4
-        
-            ch['Resolution'] = struct.unpack_from( "=f", binheader, offset=offset )[0]
-            if verbose: 
-                print "Resolution (ns):", ch['Resolution']
-            offset += 4
-        
-            ch['Channels'] = struct.unpack_from( "=l", binheader, offset=offset )[0]
-            if verbose: 
-                print "Channels:", ch['Channels']
-            offset += 4
-        
-            ch['Tacq'] = struct.unpack_from( "=l", binheader, offset=offset )[0]
-            if verbose: 
-                print "Acquisition Time (ms):", ch['Tacq']
-            offset += 4
-        
-            ch['StopAfter'] = struct.unpack_from( "=l", binheader, offset=offset )[0] 
-            if verbose: 
-                print "Stop After (ms):", ch['StopAfter']
-            offset += 4
-        
-            ch['StopReason'] = struct.unpack_from( "=l", binheader, offset=offset )[0] 
-            if verbose: 
-                print "Stop Reason (ms):", ch['StopReason']
-            offset += 4
-        
-            ch['InpRate0'] = struct.unpack_from( "=l", binheader, offset=offset )[0] 
-            if verbose: 
-                print "Input Rate 0 (Hz):", ch['InpRate0']
-            offset += 4
-        
-            ch['InpRate1'] = struct.unpack_from( "=l", binheader, offset=offset )[0] 
-            if verbose: 
-                print "Input Rate 1 (Hz):", ch['InpRate1']
-            offset += 4
-        
-            ch['HistCountRate'] = struct.unpack_from( "=l", binheader, offset=offset )[0] 
-            if verbose: 
-                print "Hist. Count Rate (cps):", ch['HistCountRate']
-            offset += 4
-        
-            ch['IntegralCount'] = struct.unpack_from( "=2l", binheader, offset=offset )[0] 
-            if verbose: 
-                print "Integral Count:", ch['IntegralCount']
-            offset += 8
-        
-            ch['Reserved'] = struct.unpack_from( "=l", binheader, offset=offset )[0]
-            if verbose: 
-                print "Reserved:", ch['Reserved']
-            offset += 4
-        
-            ch['DataOffset'] = struct.unpack_from( "=l", binheader, offset=offset )[0]
-            if verbose: 
-                print "Data Offset relative to the start of the file:", ch['DataOffset']
-            offset += 4
-        
-            # below is new in format version 2.0
-
-            ch['RouterModelCode'] = struct.unpack_from( "=l", binheader, offset=offset )[0]
-            offset += 4
-            ch['RouterEnabled'] = struct.unpack_from( "=l", binheader, offset=offset )[0]
-            offset += 4
-            ch['RtChan_InputType'] = struct.unpack_from( "=l", binheader, offset=offset )[0]
-            offset += 4
-            ch['RtChan_InputLevel'] = struct.unpack_from( "=l", binheader, offset=offset )[0]
-            offset += 4
-            ch['RtChan_InputEdge'] = struct.unpack_from( "=l", binheader, offset=offset )[0]
-            offset += 4
-            ch['RtChan_CFDPresent'] = struct.unpack_from( "=l", binheader, offset=offset )[0]
-            offset += 4
-            ch['RtChan_CFDLevel'] = struct.unpack_from( "=l", binheader, offset=offset )[0]
-            offset += 4
-            ch['RtChan_CFDZeroCross'] = struct.unpack_from( "=l", binheader, offset=offset )[0]
-            offset += 4
-        
-            self.curveheaders.append( ch )
+        if verbose:
+            for ch in self.curveheaders:
+                for name in PHD_CURVE_HEADER.names:
+                    print "%s:" % name, ch[name]
             
 
-    def readhistograms( self ):
+    def readhistograms( self, memmap=False ):
 
         ##################################################################################
         #
@@ -943,14 +723,16 @@ class Trace():
         #
         ##################################################################################
 
-        self.fobj.seek(0) # go back to beginning because 'DataOffset' is measured from there.
-        binarydata = self.fobj.read()
-        
+        # Only the bins we keep are read, straight from 'DataOffset' (measured from the
+        # beginning of the file). With memmap=True each curve is a read-only view
+        # (np.frombuffer) of the bytes read instead, so nothing is converted or copied
+        # until a method modifies the data (see self._writable_curve). A real np.memmap
+        # would hold a file descriptor per curve for as long as the Trace lives.
         self.curves = []
         
         for i,curve in enumerate( self.curveheaders ):
             
-            # This will typically be waaay too long and will be padded with zeros because it
+            # The stored histogram will typically be waaay too long and padded with zeros because it
             # can accomodate up to 2**16 histogram bins but our laser rep rate is ~76MHz, so
             # if you were set at 4ps resolution, that would only require 1/76MHz/4ps ~ 3281 bins
             #
@@ -963,24 +745,40 @@ class Trace():
             # the peak in lifetime occurrs at the very end of the un-wrapped curve. Then you should
             # insert enough BNC cable to bring the peak back toward the front of the un-wrapped curve.
 
-            zeropadded = pylab.np.array(
-                struct.unpack_from( "="+str(curve['Channels'])+"l", binarydata, offset=curve['DataOffset'] ),
-                dtype=pylab.np.int
-                         )
             nbins = 1.0/self.curveheaders[0]['InpRate0']/self.curveheaders[0]['Resolution']/1.0e-9
-            nfullbins = pylab.floor( nbins )
+            nfullbins = min( int( pylab.floor( nbins ) ), curve['Channels'] )
             npartialbins = pylab.mod( nbins, 1 )
             if npartialbins > 0.0:
                 # I think in this case (which is almost always the case), the first bin is sometimes
                 # the 'partial' bin, and the last bin is sometimes the 'partial' bin. So we'll delete them.
-                # (or uncomment other line to add them.)
-                ###zeropadded[0] += zeropadded[ nfullbins ] # add the partial bin to the first bin
-                self.curves.append( zeropadded[1:nfullbins] ) 
+                first = 1
+            else:
+                first = 0
+            offset = curve['DataOffset'] + first*PHD_HISTOGRAM_BIN.itemsize
+
+            self.fobj.seek( offset )
+            if memmap:
+                self.curves.append( numpy.frombuffer( self.fobj.read( (nfullbins-first)*PHD_HISTOGRAM_BIN.itemsize ),
+                                                      dtype=PHD_HISTOGRAM_BIN ) )
             else:
-                self.curves.append( zeropadded[:nfullbins] ) 
+                self.curves.append( numpy.fromfile( self.fobj, dtype=PHD_HISTOGRAM_BIN,
+                                                    count=nfullbins-first ).astype(numpy.int) )
         
         self.raw_curves = self.curves[:]
 
+    def _writable_curve( self, i ):
+        """ curves loaded with memmap=True are read-only views of the file.
+            Swap curve i for a float copy before modifying it in place, in
+            raw_curves too if it is the same array there (as it is after
+            loading), so both modes change the same curves.
+        """
+        if not self.curves[i].flags.writeable:
+            curve = numpy.array( self.curves[i], dtype=numpy.float )
+            if self.raw_curves[i] is self.curves[i]:
+                self.raw_curves[i] = curve
+            self.curves[i] = curve
+        return self.curves[i]
+
     def set_axes( self, axes ):
         """ this allows you to plot the data to a particular axes
         """
@@ -990,8 +788,9 @@ class Trace():
         """ blank curve[0] of a trace except within the given window.
             Useful for removing background and reflections from IRF.
         """
-        self.curves[0][pylab.find(self.t[0]<tstart)] = 0.0
-        self.curves[0][pylab.find(self.t[0]>tend)] = 0.0
+        curve = self._writable_curve(0)
+        curve[pylab.find(self.t[0]<tstart)] = 0.0
+        curve[pylab.find(self.t[0]>tend)] = 0.0
 
     def set_irf( self, irf=None, wraptime=None, dispersion=None ):
         """
@@ -26,6 +26,7 @@ import os.path
 import struct # deal with binary data
 import numpy
 from pylab import *
+import filecache
 
 class Spectrum():
     def __init__( self, fname, cts_per_sec=False ):
@@ -373,6 +374,7 @@ def getSpectrum( spefile, cts_per_sec=False ):
         wavelength = polyval( p, xrange( 1, 1+len(luminescence) ) )
     return wavelength, luminescence
 
+@filecache.cached( 'WinspecUtils.readSpe' )
 def readSpe(spefilename, verbose=False):
     """ 
     Read a binary PI SPE file into a python dictionary
@@ -0,0 +1,226 @@
+# Persistent cache of parsed data files.
+#
+# Parsing the same raw files (.phd, .SPE, Lumerical/spectrometer text exports)
+# every session is slow, so the loaders in PicoQuantUtils, winspec, WinspecUtils,
+# pyLumerical and NVanalysis store what they decoded (arrays plus header dicts)
+# here, as a binary pickle. The next load of an unchanged file is a single
+# binary read instead of a text or struct parse.
+#
+# Each entry is named by a hash of the file's absolute path followed by a hash of
+# (loader, loader version, file size, mtime), so editing or replacing a data file
+# automatically misses the old entry. The loader version is normally a hash of
+# the loader's source file (see source_version), so a fixed parser does not keep
+# serving what the old one decoded.
+# Results that are not tied to a single file (e.g. fits, see
+# PicoQuantUtils_FastFit.memoized_fit) are stored with load_key/store_key
+# under a hash of (tag, key) instead, where the key describes all the inputs.
+# Entries are evicted least-recently-used once the cache grows beyond
+# MAX_BYTES (checked against a running total of what this process stored, and
+# against a full listing every TRIM_INTERVAL stores, since other processes
+# share the directory); invalidate() and clear() remove entries explicitly.
+# Failing to write an entry (read-only or full disk, unpicklable value) only
+# means it isn't cached.
+#
+# The cache can be switched off for a session with
+#   import filecache; filecache.enabled = False
+
+import os
+import os.path
+import sys
+import hashlib
+import tempfile
+import cPickle
+
+enabled = True
+CACHE_DIR = os.path.join( os.path.expanduser('~'), '.cache', 'python_misc_modules' )
+MAX_BYTES = 2*1024**3 # evict least-recently-used entries above 2 GB
+TRIM_INTERVAL = 1000 # stores between full listings of the cache directory
+
+SUFFIX = '.pkl'
+
+
+def _path_prefix( fname ):
+    """ every entry for file `fname` starts with this (hash of the absolute path) """
+    return hashlib.sha1( os.path.abspath( fname ) ).hexdigest()[:20]
+
+def _entry_path( tag, fname, version ):
+    """ cache entry for loader `tag` (at `version`) reading the current version of file `fname` """
+    stat = os.stat( fname )
+    version = hashlib.sha1( repr( (tag, version, stat.st_size, stat.st_mtime) ) ).hexdigest()[:20]
+    return os.path.join( CACHE_DIR, _path_prefix( fname ) + '-' + version + SUFFIX )
+
+_source_versions = {}
+
+def source_version( filename ):
+    """ Hash of the source file `filename` (a module's __file__; for a .pyc the
+        .py next to it is hashed), to pass as the version of a loader defined
+        in it: changing the code then misses the entries the old code stored.
+    """
+    filename = os.path.abspath( filename )
+    if not _source_versions.has_key( filename ):
+        source = filename[:-1] if filename.endswith( ('.pyc', '.pyo') ) else filename
+        if not os.path.exists( source ): source = filename
+        try:
+            with open( source, 'rb' ) as f:
+                _source_versions[filename] = hashlib.sha1( f.read() ).hexdigest()[:20]
+        except IOError:
+            _source_versions[filename] = ''
+    return _source_versions[filename]
+
+def _entries():
+    """ list of (last access, size, path) for every cache entry, oldest first """
+    if not os.path.isdir( CACHE_DIR ):
+        return []
+    entries = []
+    for name in os.listdir( CACHE_DIR ):
+        if not name.endswith( SUFFIX ):
+            continue
+        path = os.path.join( CACHE_DIR, name )
+        try:
+            stat = os.stat( path )
+        except OSError:
+            continue # removed by another process meanwhile
+        entries.append( (stat.st_mtime, stat.st_size, path) )
+    entries.sort()
+    return entries
+
+def _key_path( tag, key ):
+    """ cache entry for `tag` and the string `key` """
+    return os.path.join( CACHE_DIR, 'key-' + hashlib.sha1( repr( (tag, key) ) ).hexdigest() + SUFFIX )
+
+def _load( path ):
+    try:
+        with open( path, 'rb' ) as f:
+            result = cPickle.load( f )
+    except (IOError, EOFError, cPickle.UnpicklingError):
+        return None
+    os.utime( path, None ) # mark as recently used
+    return result
+
+# size of the cache as far as this process knows (None: not listed yet),
+# and the number of stores since the last full listing
+_total_bytes = None
+_stores_since_trim = 0
+
+def _store( path, value ):
+    global _total_bytes, _stores_since_trim
+    # the cache is only an optimization: if the entry can't be written (read-only
+    # or full disk, unpicklable value), don't store it rather than fail the load
+    tmppath = None
+    try:
+        if not os.path.isdir( CACHE_DIR ):
+            os.makedirs( CACHE_DIR )
+        # write to a temporary file first so that a concurrent reader never
+        # sees a half-written entry
+        fd, tmppath = tempfile.mkstemp( dir=CACHE_DIR, suffix='.tmp' )
+        with os.fdopen( fd, 'wb' ) as f:
+            cPickle.dump( value, f, cPickle.HIGHEST_PROTOCOL )
+            size = f.tell()
+        os.rename( tmppath, path )
+    except (IOError, OSError, TypeError, cPickle.PicklingError): # TypeError: e.g. "can't pickle file objects"
+        if tmppath is not None and os.path.exists( tmppath ):
+            try:
+                os.remove( tmppath )
+            except OSError:
+                pass
+        return
+    # listing the directory on every store would make storing N entries O(N**2)
+    _stores_since_trim += 1
+    if _total_bytes is None or _stores_since_trim >= TRIM_INTERVAL:
+        trim()
+    else:
+        _total_bytes += size # overwritten entries are counted twice, which only trims early
+        if _total_bytes > MAX_BYTES:
+            trim()
+
+def load( tag, fname, version='' ):
+    """ Return what was stored for loader `tag` (at `version`, typically
+        source_version( __file__ ) of the loader's module) and file `fname`,
+        or None if the cache is disabled or has no (current) entry.
+    """
+    if not enabled:
+        return None
+    return _load( _entry_path( tag, fname, version ) )
+
+def store( tag, fname, value, version='' ):
+    """ Store `value` (anything picklable) for loader `tag` (at `version`, see
+        load) and file `fname`, then evict the least-recently-used entries if
+        the cache is too big.
+    """
+    if not enabled:
+        return
+    _store( _entry_path( tag, fname, version ), value )
+
+def load_key( tag, key ):
+    """ Return what was stored for `tag` and the string `key` (typically a hash
+        of all the inputs of a computation), or None. """
+    if not enabled:
+        return None
+    return _load( _key_path( tag, key ) )
+
+def store_key( tag, key, value ):
+    """ Store `value` for `tag` and the string `key`; see load_key. """
+    if not enabled:
+        return
+    _store( _key_path( tag, key ), value )
+
+def trim( max_bytes=None ):
+    """ delete least-recently-used entries until the cache is below max_bytes
+        (MAX_BYTES by default) """
+    global _total_bytes, _stores_since_trim
+    if max_bytes is None:
+        max_bytes = MAX_BYTES
+    entries = _entries()
+    total = sum( size for atime, size, path in entries )
+    for atime, size, path in entries:
+        if total <= max_bytes:
+            break
+        try:
+            os.remove( path )
+        except OSError:
+            pass
+        total -= size
+    _total_bytes, _stores_since_trim = total, 0
+
+def invalidate( fname ):
+    """ Remove every cache entry for file `fname` (for all loaders, and
+        including entries for older versions of the file). """
+    prefix = _path_prefix( fname )
+    for atime, size, path in _entries():
+        if os.path.basename( path ).startswith( prefix ):
+            try:
+                os.remove( path )
+            except OSError:
+                pass
+
+def clear():
+    """ remove every entry from the cache """
+    for atime, size, path in _entries():
+        try:
+            os.remove( path )
+        except OSError:
+            pass
+
+def cached( tag ):
+    """ Decorator for a loader function whose first argument is the name of
+        the file to load: the result is cached per (tag, file), so any other
+        arguments (verbose flags and the like) must not change the result.
+        The source of the loader's module is the version (see source_version).
+        usage:
+            @filecache.cached( 'winspec.read_spe' )
+            def read_spe( spefilename, verbose=False ):
+                ...
+    """
+    def decorator( loader ):
+        def cached_loader( fname, *args, **kwargs ):
+            version = source_version( sys.modules[loader.__module__].__file__ )
+            result = load( tag, fname, version )
+            if result is None:
+                result = loader( fname, *args, **kwargs )
+                store( tag, fname, result, version )
+            return result
+        cached_loader.__name__ = loader.__name__
+        cached_loader.__doc__ = loader.__doc__
+        cached_loader.uncached = loader
+        return cached_loader
+    return decorator
@@ -4,17 +4,64 @@
 ## this works but is only about 2x faster than pure python
 ## I guess because many of the expensive parts are either
 ## already in C or, like cspline1d_eval, not optimized with Cython.
+##
+## The IRF is now sampled (cspline1d_eval) and Fourier transformed only once
+## per time axis; tshift is applied as a phase ramp exp(-2 pi i f tshift) on
+## that spectrum, so each model evaluation costs one rfft/irfft pair.
+##
+## For multi-exponential models there is an O(N) alternative that needs no
+## transform of the model at all (convolution='recursive', the default for
+## Trace.fit_exponential): with q = exp(-dt/l), the circular convolution of
+## a*q**k/(1-exp(-tpulse/l)) with the IRF follows from the running sum
+## z_k = q*z_(k-1) + irf_k, see add_recursive_decay. The stretched model
+## always uses the FFT.
+##
+## The stretched model sums exp(-((t+j*tpulse)/l)**(1/h)) over previous laser
+## pulses j. Written as exp(-exp((log(t+j*tpulse)-log(l))/h)), the logarithms
+## only depend on the time axis: they are tabulated once per axis, shared by
+## both Kohlrausch components, and the sum stops at the first pulse whose
+## contribution is below KOHLRAUSCH_TOL (see add_kohlrausch_pulses).
+##
+## The model arithmetic runs in typed-memoryview loops without the GIL,
+## fused with the weighting into the residuals (Convolved.model_into), and
+## so does the phase ramp applied whenever tshift changes (phase_shift).
+## What is left are the numpy FFTs (the convolution, and the shifted IRF of
+## the recursive model): their transforms release the GIL too, and only the
+## calls around them hold it, so several fits can share the CPU cores from
+## threads. (leastsq keeps the arrays the residual function returns, so each
+## step gets a new one rather than a reused buffer.)
 
 import pylab
 import numpy as np
 cimport numpy as np
-from cpython cimport bool
 import cython
 from scipy.signal import cspline1d, cspline1d_eval
 from scipy.optimize import leastsq
 
-cdef extern from "math.h":
+cdef extern from "math.h" nogil:
     double exp(double)
+    double fabs(double)
+    double log(double)
+    double pow(double, double)
+    double cos(double)
+    double sin(double)
+
+# model variants (Function.model_id)
+cdef enum:
+    MULTI_EXP = 0
+    STRETCHED_EXP = 1
+
+# what the parameter after the lifetime/amplitude pairs of multi_exp means
+cdef enum:
+    OFFSET_B = 0     # offset b (not part of the convolved model)
+    OFFSET_T_AG = 1  # every lifetime l -> 1/(1/l + 1/t_ag)
+    OFFSET_T_D3 = 2  # every lifetime l -> l*t_d3
+    OFFSET_A_FIX = 3 # every amplitude a -> a*a_fix
+
+NO_DATA = np.empty(0, dtype=np.float) # y for Convolved.model_into when only the model is wanted
+
+KOHLRAUSCH_PULSES = 10 # most laser pulses included in the stretched models (also PicoQuantUtils_FastFit.kohlrausch_pulses)
+KOHLRAUSCH_TOL = 1.0e-10 # relative contribution below which further pulses are dropped
 
 
 cdef extern from "stdarg.h":
@@ -29,12 +76,158 @@ cdef extern from "stdarg.h":
 cdef extern from *:
     double double_type "double"
 
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef void add_recursive_decay(double[:] y, double[:] irf, double q, double scale) nogil:
+    """y += scale * (circular convolution of q**k with irf), in O(N).
+    With z_k = q*z_(k-1) + irf_k (z_-1 = 0) and Z = z_(N-1), that convolution is
+    z_k*(1-q**N) + q**(k+1)*Z: z_k holds the IRF bins up to k, and the bins after k
+    contribute through the previous period."""
+    cdef Py_ssize_t k, n = irf.shape[0]
+    cdef double z = 0.0, Z, qN, qk
+    for k in range(n):
+        z = q*z + irf[k]
+    Z = z
+    qN = pow(q, n)
+    z = 0.0
+    qk = q
+    for k in range(n):
+        z = q*z + irf[k]
+        y[k] += scale*(z*(1.0-qN) + qk*Z)
+        qk *= q
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef int add_kohlrausch_pulses(double[:] y, double[:,:] log_t, double a, double l, double h, double tol) nogil:
+    """y += sum over pulses j of a*exp(-((t+j*tpulse)/l)**(1/h)), where row j of log_t
+    holds log(t+j*tpulse). Stops after the first pulse whose largest term is below
+    tol*a (later pulses only contribute less). Returns the number of pulses added."""
+    cdef Py_ssize_t j, k, n = y.shape[0]
+    cdef double logl = log(l), invh = 1.0/h, term, largest
+    for j in range(log_t.shape[0]):
+        largest = 0.0
+        for k in range(n):
+            term = exp(-exp((log_t[j,k]-logl)*invh))
+            if term > largest: largest = term
+            y[k] += a*term
+        if largest < tol:
+            return j+1
+    return log_t.shape[0]
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef Py_ssize_t multi_exp_decays(double[:] params, Py_ssize_t n_exp, int offset_kind,
+        Py_ssize_t i_offset, Py_ssize_t i_trise, double tpulse,
+        double[:] rates, double[:] amplitudes) nogil:
+    """Fill rates (1/lifetime) and amplitudes with the decays that make up the
+    multi_exp model before convolution, sum_c amplitudes_c*exp(-t*rates_c), the
+    previous laser pulses included. A rise time adds a second decay with negative
+    amplitude to every exponential: exp(-t/l)*(1-exp(-t/trise)) = exp(-t/l) -
+    exp(-t*(1/l+1/trise)). Returns the number of decays."""
+    cdef Py_ssize_t i, n = 0
+    cdef double l, a, coefficient, offset = 0.0, rise = 0.0
+    if offset_kind != OFFSET_B:
+        offset = params[i_offset]
+    if i_trise >= 0:
+        rise = 1.0/fabs(params[i_trise])
+    for i in range(n_exp):
+        l = params[2*i]
+        a = params[2*i+1]
+        if offset_kind == OFFSET_T_AG: l = 1.0/(1.0/l + 1.0/fabs(offset))
+        elif offset_kind == OFFSET_T_D3: l *= fabs(offset)
+        elif offset_kind == OFFSET_A_FIX: a *= offset
+        l = fabs(l)
+        coefficient = fabs(a)/(1.0-exp(-tpulse/l))
+        rates[n] = 1.0/l
+        amplitudes[n] = coefficient
+        n += 1
+        if i_trise >= 0:
+            rates[n] = 1.0/l + rise
+            amplitudes[n] = -coefficient
+            n += 1
+    return n
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef void decay_sum(double[:] out, double[:] t, double[:] rates, double[:] amplitudes, Py_ssize_t n) nogil:
+    """out = sum_c amplitudes_c*exp(-t*rates_c)"""
+    cdef Py_ssize_t c, k
+    cdef double value
+    for k in range(t.shape[0]):
+        value = 0.0
+        for c in range(n):
+            value += amplitudes[c]*exp(-t[k]*rates[c])
+        out[k] = value
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef void recursive_decay_sum(double[:] out, double[:] irf, double[:] rates, double[:] amplitudes,
+        Py_ssize_t n, double dt, double t0, double[:,:] state, double[:] y, double[:] weight) nogil:
+    """out = circular convolution of sum_c amplitudes_c*exp(-t*rates_c) with irf:
+    add_recursive_decay for all decays at once, in two passes over irf. If y is
+    not empty, out gets the weighted residuals (y-model)*weight instead of the model.
+    state is scratch space of shape (n, 4) or larger."""
+    cdef Py_ssize_t c, k, m = irf.shape[0]
+    cdef double model, q, scale
+    cdef bint residual = y.shape[0] > 0
+    # per decay: q, the running sum z, scale*(1-q**m), and scale*q**(k+1)*Z
+    for c in range(n):
+        state[c,0] = exp(-dt*rates[c])
+        state[c,1] = 0.0
+    for k in range(m):
+        for c in range(n):
+            state[c,1] = state[c,0]*state[c,1] + irf[k]
+    for c in range(n):
+        q = state[c,0]
+        scale = amplitudes[c]*exp(-t0*rates[c])
+        state[c,2] = scale*(1.0-pow(q, m))
+        state[c,3] = scale*q*state[c,1]
+        state[c,1] = 0.0
+    for k in range(m):
+        model = 0.0
+        for c in range(n):
+            q = state[c,0]
+            state[c,1] = q*state[c,1] + irf[k]
+            model += state[c,2]*state[c,1] + state[c,3]
+            state[c,3] *= q
+        if residual:
+            out[k] = (y[k]-model)*weight[k]
+        else:
+            out[k] = model
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef void phase_shift(double[:] out, double[:] spectrum, double[:] omega, double tshift) nogil:
+    """out = spectrum*exp(-i*omega*tshift), for complex spectra stored as
+    (real, imaginary) pairs: the spectrum of a signal delayed by tshift"""
+    cdef Py_ssize_t k
+    cdef double c, s
+    for k in range(omega.shape[0]):
+        c = cos(omega[k]*tshift)
+        s = sin(omega[k]*tshift)
+        out[2*k] = spectrum[2*k]*c + spectrum[2*k+1]*s
+        out[2*k+1] = spectrum[2*k+1]*c - spectrum[2*k]*s
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef void weighted_residuals(double[:] out, double[:] y, double[:] model, double[:] weight) nogil:
+    cdef Py_ssize_t k
+    for k in range(y.shape[0]):
+        out[k] = (y[k]-model[k])*weight[k]
+
 cdef class Function:
-    cdef np.ndarray params, free_params, irf_generator, stddev
+    cdef np.ndarray params, free_params, irf_generator, stddev, weight
+    cdef np.ndarray t_grid, ideal, irf_spectrum, omega, shifted_spectrum, irf_shifted
+    cdef np.ndarray log_pulses, rates, amplitudes, state
+    cdef dict irf_spectra
     cdef Py_ssize_t i, arg_len
-    cdef double tpulse, irf_dt, irf_t0
-    cdef bool has_key_t_ag, has_key_t_d3, has_key_a_fix
-    cdef bool has_key_trise, has_key_tshift, has_key_l1
+    cdef Py_ssize_t n_exp, i_offset, i_tshift, i_trise
+    cdef double tpulse, irf_dt, irf_t0, last_tshift, last_irf_tshift
+    cdef bint recursive
+    cdef bint has_key_t_ag, has_key_t_d3, has_key_a_fix
+    cdef bint has_key_trise, has_key_tshift, has_key_l1
+    cdef int model_id, offset_kind
     cdef char* model
     def __init__( self,
             char* model,
@@ -45,10 +238,12 @@ cdef class Function:
             double irf_dt,
             double irf_t0,
             np.ndarray[np.float64_t, ndim=1] irf_generator,
-            np.ndarray[np.float64_t, ndim=1] stddev ):
+            np.ndarray[np.float64_t, ndim=1] stddev,
+            convolution='fft',
+            irf_spectra=None ):
         self.model = model
         self.params = params
-        self.free_params = free_params
+        self.free_params = free_params.astype(np.intp)
         self.arg_len = free_params.shape[0]
         self.has_key_t_ag = True if guess.has_key('t_ag') else False
         self.has_key_t_d3 = True if guess.has_key('t_d3') else False
@@ -60,13 +255,97 @@ cdef class Function:
         self.irf_generator = irf_generator
         self.irf_dt=irf_dt
         self.irf_t0=irf_t0
+        # sampled IRF and its spectrum per time axis, shared with other functions
+        # using the same IRF (see PicoQuantUtils_FastFit.registered_irf)
+        self.irf_spectra = {} if irf_spectra is None else irf_spectra
         self.stddev = stddev # used for weights during fitting
+        self.weight = 1.0/stddev
+        self.t_grid = None # see prepare_irf
+        if convolution not in ['fft', 'recursive']:
+            raise ValueError("convolution must be 'fft' or 'recursive', not %s" % convolution)
+        self.recursive = convolution == 'recursive'
+
+        # where things are in the full parameter list: the lifetime/amplitude
+        # pairs (l, a, h triples for stretched_exp) come first, then the offset
+        # (b, t_ag, t_d3 or a_fix; multi_exp only), tshift and trise
+        if model == b"multi_exp":
+            self.model_id = MULTI_EXP
+        elif model == b"stretched_exp":
+            self.model_id = STRETCHED_EXP
+        else:
+            raise ValueError("unknown model %s" % model)
+        self.i_trise = params.shape[0]-1 if self.has_key_trise else -1
+        self.i_tshift = params.shape[0]-1-self.has_key_trise if self.has_key_tshift else -1
+        self.i_offset = params.shape[0]-1-self.has_key_trise-self.has_key_tshift
+        if self.has_key_t_ag: self.offset_kind = OFFSET_T_AG
+        elif self.has_key_t_d3: self.offset_kind = OFFSET_T_D3
+        elif self.has_key_a_fix: self.offset_kind = OFFSET_A_FIX
+        else: self.offset_kind = OFFSET_B
+        self.n_exp = self.i_offset//2 if self.model_id == MULTI_EXP else 0
+        self.rates = np.empty(2*self.n_exp, dtype=np.float)
+        self.amplitudes = np.empty(2*self.n_exp, dtype=np.float)
+        self.state = np.empty((2*self.n_exp, 4), dtype=np.float)
         
     cpdef double set_params(self, np.ndarray params) except *:
         self.params = params
     
     cpdef double set_free_params(self, np.ndarray[np.float64_t, ndim=1] free_params) except *:
-        self.free_params = free_params
+        self.free_params = free_params.astype(np.intp)
+
+    cpdef prepare_irf(self, np.ndarray[np.float64_t, ndim=1] t):
+        """Sample the IRF on the (evenly spaced) time axis t and keep its spectrum,
+        along with the buffers every model evaluation on this axis reuses.
+        Called automatically whenever the model is evaluated on a new time axis."""
+        cdef Py_ssize_t n = t.shape[0]
+        self.t_grid = t.copy()
+        self.ideal = np.empty(n, dtype=np.float)
+        key = (n, t[0], t[1]-t[0])
+        if key not in self.irf_spectra:
+            irf = cspline1d_eval( self.irf_generator, t, dx=self.irf_dt, x0=self.irf_t0 )
+            self.irf_spectra[key] = (irf, np.fft.rfft(irf))
+        irf, self.irf_spectrum = self.irf_spectra[key]
+        self.omega = 2*np.pi*np.fft.rfftfreq(n, t[1]-t[0])
+        self.shifted_spectrum = self.irf_spectrum.copy()
+        self.last_tshift = 0.0
+        self.irf_shifted = np.array(irf, dtype=np.float)
+        self.last_irf_tshift = 0.0
+        self.log_pulses = None # see pulse_logarithms
+
+    cdef np.ndarray pulse_logarithms(self):
+        """log(t+j*tpulse) on the current time axis, one row per laser pulse j"""
+        if self.log_pulses is None:
+            with np.errstate(divide='ignore'):
+                self.log_pulses = np.log( self.t_grid[None,:] +
+                        self.tpulse*np.arange(KOHLRAUSCH_PULSES, dtype=np.float)[:,None] )
+        return self.log_pulses
+
+    cdef bint same_grid(self, np.ndarray[np.float64_t, ndim=1] t):
+        return (self.t_grid is not None and t.shape[0] == self.t_grid.shape[0]
+                and t[0] == self.t_grid[0] and t[t.shape[0]-1] == self.t_grid[t.shape[0]-1])
+
+    cdef shift_spectrum(self, double tshift):
+        """set self.shifted_spectrum to the spectrum of the IRF delayed by tshift"""
+        cdef double[:] out, spectrum, omega
+        if tshift != self.last_tshift:
+            out = self.shifted_spectrum.view(np.float)
+            spectrum = self.irf_spectrum.view(np.float)
+            omega = self.omega
+            with nogil:
+                phase_shift(out, spectrum, omega, tshift)
+            self.last_tshift = tshift
+
+    cdef np.ndarray convolve(self, np.ndarray ideal, double tshift):
+        """circular convolution of ideal with the IRF delayed by tshift"""
+        self.shift_spectrum(tshift)
+        return np.fft.irfft( np.fft.rfft(ideal)*self.shifted_spectrum, ideal.shape[0] )
+
+    cdef np.ndarray shifted_irf(self, double tshift):
+        """the IRF delayed by tshift, sampled on the time axis (kept until tshift changes)"""
+        if tshift != self.last_irf_tshift:
+            self.shift_spectrum(tshift)
+            self.irf_shifted = np.fft.irfft( self.shifted_spectrum, self.t_grid.shape[0] )
+            self.last_irf_tshift = tshift
+        return self.irf_shifted
     
     cpdef print_params(self):
         print self.params
@@ -74,97 +353,132 @@ cdef class Function:
         
 
 cdef class Convolved( Function ):
-    def __init__( self, *args ):
-        Function.__init__( self, *args )
-        
-    cdef np.ndarray[np.float64_t, ndim=1] multi_exponential( self, np.ndarray[np.float64_t, ndim=1] p, np.ndarray[np.float64_t, ndim=1] t ):
-        """Typical multi-exponential fit. This can accomodate rising exponential (for saturation fitting)."""
-        cdef Py_ssize_t i, arg_len, deduct
-        cdef double arg, tshift, trise, t_ag, t_d3, scale, b, a, l
-        cdef np.ndarray local_params, ideal, irf
-        deduct = 1
+    def __init__( self, *args, **kwargs ):
+        Function.__init__( self, *args, **kwargs )
+
+    cdef double update(self, np.ndarray[np.float64_t, ndim=1] p, np.ndarray[np.float64_t, ndim=1] t) except *:
+        """copy the free parameters p into the full parameter list, get ready for
+        the time axis t, and return tshift"""
+        self.params[self.free_params] = p
+        if not self.same_grid(t): self.prepare_irf(t)
+        return self.params[self.i_tshift] if self.i_tshift >= 0 else 0.0
+
+    cdef int model_into(self, np.ndarray[np.float64_t, ndim=1] p, np.ndarray[np.float64_t, ndim=1] t,
+            double[:] out, double[:] y) except -1:
+        """Write the convolved model at the free parameters p into out or, if y is
+        not empty, the weighted residuals (y-model)/stddev.
+        multi_exp: typical multi-exponential fit. This can accomodate rising exponential (for saturation fitting).
+        stretched_exp: stretched single-exponential fit (optionally plus a second one, l1, a1, h1).
+        See http://www.ncbi.nlm.nih.gov.ezp-prod1.hul.harvard.edu/pmc/articles/PMC1301608/pdf/11509343.pdf"""
+        cdef double tshift = self.update(p, t)
+        cdef double[:] params = self.params, ideal = self.ideal, weight = self.weight, tv = t
+        cdef double[:] rates = self.rates, amplitudes = self.amplitudes, irf, convolved
+        cdef double[:,:] log_t, state = self.state
+        cdef double tol = KOHLRAUSCH_TOL
+        cdef Py_ssize_t n
+        cdef bint residual = y.shape[0] > 0
+        if self.model_id == MULTI_EXP:
+            with nogil:
+                n = multi_exp_decays(params, self.n_exp, self.offset_kind, self.i_offset, self.i_trise,
+                                     self.tpulse, rates, amplitudes)
+            if self.recursive:
+                irf = self.shifted_irf(tshift)
+                with nogil:
+                    recursive_decay_sum(out, irf, rates, amplitudes, n, tv[1]-tv[0], tv[0], state, y, weight)
+                return 0
+            with nogil:
+                decay_sum(ideal, tv, rates, amplitudes, n)
+        else:
+            # Kohlrausch function; for the modified Kohlrausch function (Berberan-Santos et al., 2005)
+            # the terms would be exp(1-(1+(t+j*tpulse)/l)**(1.0/h))
+            log_t = self.pulse_logarithms()
+            with nogil:
+                ideal[:] = 0.0
+                add_kohlrausch_pulses(ideal, log_t, fabs(params[1]), fabs(params[0]), params[2], tol)
+                if self.has_key_l1:
+                    add_kohlrausch_pulses(ideal, log_t, fabs(params[4]), fabs(params[3]), params[5], tol)
+        convolved = self.convolve(self.ideal, tshift)
+        with nogil:
+            if residual:
+                weighted_residuals(out, y, convolved, weight)
+            else:
+                out[:] = convolved
+        return 0
+
+    cpdef np.ndarray basis(self,
+            np.ndarray[np.float64_t, ndim=1] p,
+            np.ndarray[np.float64_t, ndim=1] t):
+        """The multi-exponential model is linear in the amplitudes: return the matrix
+        whose column i is the convolved decay of lifetime pair i (in the order of
+        the parameters) with unit amplitude, at the free parameters p.
+        Used for variable projection (see Trace.fit_exponential( varpro=True ))."""
+        cdef Py_ssize_t i, j, deduct, n_exp
+        cdef double arg, l, tshift, coefficient, dt
+        cdef double trise=0.0, t_ag=0.0, t_d3=1.0
+        cdef np.ndarray local_params, columns, ideal, irf
+        if self.model_id != MULTI_EXP:
+            raise ValueError("basis is only defined for the multi_exp model")
         for i,arg in enumerate(p): self.params[ self.free_params[i] ] = arg
         local_params = self.params[:]
-        
+        deduct = 1
         if self.has_key_trise:
-            trise = local_params[-deduct]
+            trise = abs(local_params[-deduct])
             deduct += 1
-            
         if self.has_key_tshift:
             tshift = local_params[-deduct]
             deduct += 1
         else:
             tshift = 0.0
+        if self.has_key_t_ag: t_ag = abs(local_params[-deduct])
+        if self.has_key_t_d3: t_d3 = abs(local_params[-deduct])
 
-        if self.has_key_t_ag:
-            t_ag = abs(local_params[-deduct])
-        elif self.has_key_t_d3:
-            t_d3 = abs(local_params[-deduct])
-        elif self.has_key_a_fix:
-            scale = local_params[-deduct]
-        else:
-            b = local_params[-deduct]
-            
-        ideal = np.zeros(len(t), dtype=np.float)
-        for l,a in zip(local_params[:-2:2],local_params[1:-2:2]):
+        if not self.same_grid(t): self.prepare_irf(t)
+        lifetimes = local_params[:-deduct:2]
+        n_exp = (len(local_params)-deduct)//2
+        columns = np.zeros((t.shape[0], n_exp), dtype=np.float)
+        dt = t[1]-t[0]
+        if self.recursive: irf = self.shifted_irf(tshift)
+        for j from 0 <= j < n_exp:
+            l = lifetimes[j]
             if self.has_key_t_ag: l = 1.0/(1.0/l + 1.0/t_ag)
             if self.has_key_t_d3: l *= t_d3
-            if self.has_key_a_fix: a *= scale
-            ideal += abs(a)*np.exp(-t/abs(l))/(1.0-np.exp(-self.tpulse/abs(l)))
-        if self.has_key_trise: ideal *= 1.0-np.exp(-t/abs(trise))
-        irf = cspline1d_eval( self.irf_generator, t-tshift, dx=self.irf_dt, x0=self.irf_t0 )
-        return np.real(np.fft.ifft( np.fft.fft(ideal)*np.fft.fft(irf) ))
-        
+            l = abs(l)
+            coefficient = 1.0/(1.0-exp(-self.tpulse/l))
+            if self.recursive:
+                column = np.zeros(t.shape[0], dtype=np.float)
+                add_recursive_decay(column, irf, exp(-dt/l), coefficient*exp(-t[0]/l))
+                if self.has_key_trise:
+                    l = 1.0/(1.0/l + 1.0/trise)
+                    add_recursive_decay(column, irf, exp(-dt/l), -coefficient*exp(-t[0]/l))
+                columns[:,j] = column
+            else:
+                ideal = coefficient*np.exp(-t/l)
+                if self.has_key_trise: ideal *= 1.0-np.exp(-t/trise)
+                columns[:,j] = self.convolve(ideal, tshift)
+        return columns
 
-    cdef np.ndarray[np.float64_t, ndim=1] stretched_exponential( self, np.ndarray[np.float64_t, ndim=1] p, np.ndarray[np.float64_t, ndim=1] t ):
-        """Stretched single-exponential fit.
-        See http://www.ncbi.nlm.nih.gov.ezp-prod1.hul.harvard.edu/pmc/articles/PMC1301608/pdf/11509343.pdf"""
-        cdef Py_ssize_t i, arg_len, deduct
-        cdef double arg, tshift, h, a, l, a1, h1, l1
-        cdef np.ndarray local_params, ideal, irf
-        cdef int N=10 # number previous pulses to include
-        cdef int j
-        deduct = 1
-        for i,arg in enumerate(p): self.params[ self.free_params[i] ] = arg
-        local_params = self.params[:]
-        
-        if self.has_key_tshift:
-            tshift = local_params[-deduct]
-            deduct += 1
-        else:
-            tshift = 0.0
-        l, a, h = local_params[:3]
-        a = abs(a)
-        l = abs(l)
-        if self.has_key_l1:
-            l1, a1, h1 = local_params[3:6]
-            a1 = abs(a1)
-            l1 = abs(l1)
-        ideal = np.zeros(len(t), dtype=np.float)
-        for j from 0 <= j < N:
-            ideal += a*np.exp(-((t+j*self.tpulse)/l)**(1.0/h)) # Kohlrausch function
-            #ideal += a*np.exp(1-(1+(t+j*self.tpulse)/l)**(1.0/h))  # modified Kohlrausch function (see Berberan-Santos et al., 2005)
-            if self.has_key_l1:
-                ideal += a1*np.exp(-((t+j*self.tpulse)/l1)**(1.0/h1))
-        irf = cspline1d_eval( self.irf_generator, t-tshift, dx=self.irf_dt, x0=self.irf_t0 )
-        return np.real(np.fft.ifft( np.fft.fft(ideal)*np.fft.fft(irf) ))
-        
+    cpdef np.ndarray[np.float64_t, ndim=1] evaluate(self,
+            np.ndarray[np.float64_t, ndim=1] p,
+            np.ndarray[np.float64_t, ndim=1] t):
+        """the convolved model at the free parameters p (returns a new array)"""
+        cdef np.ndarray result = np.empty(t.shape[0], dtype=np.float)
+        self.model_into(p, t, result, NO_DATA)
+        return result
 
     cpdef np.ndarray[np.float64_t, ndim=1] residuals(self,
             np.ndarray[np.float64_t, ndim=1] p,
             np.ndarray[np.float64_t, ndim=1] y,
             np.ndarray[np.float64_t, ndim=1] t):
-        cdef np.ndarray res
-        if self.model.decode() == u'multi_exp':
-            res = (y-self.multi_exponential(p,np.array(t,dtype=np.float)))/self.stddev
-        elif self.model.decode() == u'stretched_exp':
-            res = (y-self.stretched_exponential(p,np.array(t,dtype=np.float)))/self.stddev
-        
-        return res
+        """weighted residuals (y-model)/stddev (returns a new array)"""
+        cdef np.ndarray result = np.empty(t.shape[0], dtype=np.float)
+        self.model_into(p, t, result, y)
+        return result
 
     def fit( self, np.ndarray[np.float64_t, ndim=1] t,
             np.ndarray[np.float64_t, ndim=1] data,
             np.ndarray[np.float64_t, ndim=1] initparams ):
+        t = np.array(t,dtype=np.float)
+        self.prepare_irf(t)
         return leastsq( self.residuals, initparams, args=( data, t ), full_output=1 )
         # leastsq returns: (popt, pcov, infodict, errmsg, ier) = res
         
@@ -12,11 +12,311 @@
 
 import sys
 import os.path
-import struct # deal with binary data
+import copy
+import time
+import hashlib
+import inspect
+import functools
 import pylab
 import numpy as np
-from scipy.optimize import curve_fit, leastsq
+import multiprocessing
+import filecache
+import PicoQuantUtils
+from scipy.optimize import curve_fit, leastsq, lsq_linear, nnls
 from scipy.signal import cspline1d, cspline1d_eval
+# the PHD v2.0 header layouts and the multi-exponential model are shared with PicoQuantUtils
+from PicoQuantUtils import PHD_BINARY_HEADER, PHD_BOARD_HEADER, PHD_CURVE_HEADER, \
+                           PHD_HISTOGRAM_BIN, _record_to_dict, exponential_keys, \
+                           multi_exponential, multi_exponential_jacobian
+
+# version of the parsed Traces in the file cache: changes with this file and
+# with the header layouts in PicoQuantUtils (see filecache.py)
+SOURCE_VERSION = filecache.source_version( __file__ ) + PicoQuantUtils.SOURCE_VERSION
+
+
+def multistart_guesses( guess, keys, starts, spread=4.0, seed=0 ):
+    """ `starts` initial guesses for a multi-start fit: the first is guess itself,
+        the others vary the parameters in keys over a Latin hypercube in log space,
+        between guess[key]/spread and guess[key]*spread (keeping the sign).
+        The other parameters stay at their guess.
+    """
+    rng = np.random.RandomState( seed )
+    n = starts-1
+    guesses = [ dict( guess ) ]
+    if n < 1: return guesses
+    # one stratum per start along every dimension, strata shuffled independently
+    u = np.array([ (rng.permutation( n ) + rng.uniform( size=n ))/n for key in keys ])
+    factors = spread**(2*u-1)
+    for i in range( n ):
+        g = dict( guess )
+        for key, factor in zip( keys, factors[:,i] ):
+            g[key] = guess[key]*factor
+        guesses.append( g )
+    return guesses
+
+def kohlrausch_pulses( t, tpulse, components ):
+    """ sum of stretched exponentials (Kohlrausch functions) over the current and
+        previous laser pulses,
+            sum_j sum_(l,a,h) |a|*exp(-((t+j*tpulse)/|l|)**(1/h))
+        for the (l, a, h) in components. The powers are computed as
+        exp((log(t+j*tpulse)-log|l|)/h), so log(t+j*tpulse) is shared by all
+        components, and a component stops at the first pulse j whose largest term
+        is below FastFit.KOHLRAUSCH_TOL (at most FastFit.KOHLRAUSCH_PULSES pulses).
+        Same model as FastFit.Convolved( "stretched_exp", ... ) before convolution.
+    """
+    import pyximport; pyximport.install()
+    import FastFit
+    t = np.asarray( t, dtype=np.float )
+    result = np.zeros( len(t) )
+    logt = np.empty( len(t) )
+    work = np.empty( len(t) )
+    active = [ (np.log(abs(l)), abs(a), 1.0/h) for l, a, h in components ]
+    with np.errstate( divide='ignore' ):
+        for j in range( FastFit.KOHLRAUSCH_PULSES ):
+            if not active: break
+            np.log( t + j*tpulse, out=logt )
+            remaining = []
+            for logl, a, invh in active:
+                np.subtract( logt, logl, out=work )
+                work *= invh
+                np.exp( work, out=work )
+                np.negative( work, out=work )
+                np.exp( work, out=work )
+                if work.max() >= FastFit.KOHLRAUSCH_TOL: remaining.append( (logl, a, invh) )
+                work *= a
+                result += work
+            active = remaining
+    return result
+
+def lifetime_basis( t, taus, tpulse ):
+    """ matrix whose column i is the decay exp(-t/tau_i)/(1-exp(-tpulse/tau_i)) of
+        lifetime taus[i] (including the previous laser pulses), so that a lifetime
+        distribution sampled at taus is basis.dot( weights ).
+    """
+    taus = np.asarray( taus, dtype=np.float )
+    basis = np.multiply.outer( np.asarray( t, dtype=np.float ), -1.0/taus )
+    np.exp( basis, out=basis )
+    basis /= 1.0-np.exp( -tpulse/abs(taus) )
+    return basis
+
+def rapid_lifetime( t, y ):
+    """ rapid lifetime determination: the lifetime of a single exponential from
+        the counts D0, D1 in the two halves (gates of width dt) of the
+        background-free decay y(t): dt/log(D0/D1). None if D0 <= D1 or D1 <= 0. """
+    half = len(y)//2
+    D0, D1 = np.sum( y[:half] ), np.sum( y[half:2*half] )
+    if D1 <= 0 or D0 <= D1: return None
+    return (t[half]-t[0])/np.log( D0/D1 )
+
+def moment_lifetime( t, y, iterations=20 ):
+    """ lifetime of a single exponential with the same first moment as the
+        background-free decay y(t), corrected for the finite window W:
+        the mean of exp(-t/tau) over [0, W] is tau - W/(exp(W/tau)-1). """
+    y = np.clip( y, 0.0, None )
+    if np.sum( y ) <= 0: return None
+    mean = np.sum( (t-t[0])*y )/np.sum( y )
+    W = t[-1]-t[0]
+    tau = mean
+    for i in range( iterations ):
+        tau = mean + W/np.expm1( min( W/tau, 700.0 ) )
+    return tau
+
+def tail_lifetimes( t, y, num_exp ):
+    """ lifetimes of num_exp exponentials "peeled" off the background-free
+        decay y(t) with log-linear fits (weighted by the counts): the longest
+        from the end of the decay, then, after subtracting it, the next one from
+        an earlier stretch, and so on (the stretches end at W*(k/num_exp)**2
+        of the window W where y is above its noise). Sorted shortest first;
+        None if a fit doesn't give a decay. """
+    y = np.asarray( y, dtype=np.float )
+    above = np.where( y > 3.0*np.sqrt( np.clip( y, 1.0, None ) ) )[0]
+    if len( above ) < 2*num_exp: return None
+    t, residual = t[:above[-1]+1], y[:above[-1]+1].copy()
+    W = t[-1]-t[0]
+    lifetimes = []
+    for k in range( num_exp, 0, -1 ):
+        inside = (t-t[0] >= W*((k-1.0)/num_exp)**2) & (t-t[0] <= W*(float(k)/num_exp)**2) & (residual > 0)
+        if np.sum( inside ) < 2: return None
+        slope, intercept = np.polyfit( t[inside], np.log( residual[inside] ), 1, w=np.sqrt( residual[inside] ) )
+        if slope >= 0: return None
+        lifetimes.append( -1.0/slope )
+        residual -= np.exp( intercept + slope*t )
+    return sorted( lifetimes )
+
+def phasor( curves, t, tpulse, harmonic=1, irf=None, background=None ):
+    """ Phasor (frequency-domain) transform of one decay histogram, or of one per
+        row of a 2D array `curves`, sampled at times t (ns): the normalized
+        Fourier coefficient at harmonic `harmonic` (an int or a list of them)
+        of the laser repetition rate 1/tpulse,
+            F = sum( curve*exp(i*w*t) )/sum( curve ),  w = 2*pi*harmonic/tpulse
+        Re(F) and Im(F) are the usual phasor coordinates g and s.
+        Passing the (equally wrapped) `irf` histogram divides out its phasor,
+        which calibrates phase and modulation. `background` (counts per bin,
+        a number or one per row) is subtracted first.
+        Returns a complex array with one entry per curve (and per harmonic,
+        along the last axis, if harmonic is a list).
+    """
+    curves = np.asarray( curves, dtype=np.float )
+    if background is not None:
+        curves = curves - np.asarray( background, dtype=np.float )[...,None]
+    omega = 2*np.pi*np.atleast_1d( harmonic )/tpulse
+    kernel = np.exp( 1j*np.asarray( t, dtype=np.float )[:,None]*omega )
+    result = np.dot( curves, kernel )/curves.sum( axis=-1 )[...,None]
+    if irf is not None:
+        irf = np.asarray( irf, dtype=np.float )
+        result /= np.dot( irf, kernel )/irf.sum()
+    if np.isscalar( harmonic ):
+        result = result[...,0]
+    return result
+
+def phasor_lifetimes( F, tpulse, harmonic=1 ):
+    """ (phase lifetime, modulation lifetime) in ns for the phasor F (see phasor).
+        For a single exponential F = 1/(1-i*w*tau) and both equal tau; for
+        multi-exponential decays tau_phase < tau_mod.
+    """
+    omega = 2*np.pi*np.asarray( harmonic, dtype=np.float )/tpulse
+    g, s = np.real( F ), np.imag( F )
+    tau_phase = s/g/omega
+    tau_mod = np.sqrt( np.maximum( 1.0/(g**2 + s**2) - 1.0, 0.0 ) )/omega
+    return tau_phase, tau_mod
+
+
+def gaussian_blur( curve, dt, std_dev, npoints=50 ):
+    """ circular convolution of curve (bins of dt) with a unit-area gaussian of
+        standard deviation std_dev (same units as dt), done in Fourier space.
+        Like the spline-shifted sum Trace.set_irf used to do, the gaussian is
+        npoints delays out to +-2 std_dev; its spectrum is exact for any delay. """
+    curve = np.asarray( curve, dtype=np.float )
+    delays = np.linspace( -2*std_dev, 2*std_dev, npoints )
+    weights = np.exp( -delays**2/2.0/std_dev**2 )
+    f = np.fft.rfftfreq( len(curve), dt )
+    kernel = np.dot( np.cos( 2*np.pi*np.outer( f, delays ) ), weights )/np.sum( weights )
+    return np.fft.irfft( np.fft.rfft( curve )*kernel, len(curve) )
+
+# IRFs prepared by registered_irf, keyed on (absolute file name, wraptime, dispersion)
+IRF_REGISTRY = dict()
+
+def _prepare_irf( irf, dispersion ):
+    """ blur (see Trace.set_irf) and normalize curve 0 of the IRF trace irf,
+        in place, and return the registry entry: a dict of the irf trace, the
+        spline coefficients ('generator') with their 'dt' and 't0', and
+        'spectra', the IRF sampled on a time axis and its spectrum, keyed on
+        (number of bins, first time, bin width) of the axis (see FastFit.pyx) """
+    if dispersion is not None and dispersion != 0:
+        # this is meant to address chromatic dispersion within the setup
+        # (e.g. optical fiber); dispersion is the standard deviation in ps
+        irf.curves[0] = gaussian_blur( irf.curves[0], irf.t[0][1]-irf.t[0][0], dispersion/1000.0 )
+    irf.curves[0] = irf.curves[0].astype(np.float)/float(np.sum(irf.curves[0])) # normalize integral to 1, just like delta-function!!!
+    dt = irf.t[0][1]-irf.t[0][0]
+    t0 = irf.t[0][0]
+    generator = cspline1d( irf.curves[0] )
+    # the spline goes through the curve, so on the IRF's own time axis that's what we sample
+    samples = irf.curves[0].copy()
+    spectra = { (len(samples), t0, dt): (samples, np.fft.rfft( samples )) }
+    return dict( irf=irf, generator=generator, dt=dt, t0=t0, spectra=spectra )
+
+def registered_irf( fname, wraptime=None, dispersion=None ):
+    """ the registry entry (see _prepare_irf) of the IRF in file fname,
+        wrapped at wraptime and blurred by dispersion; it is loaded and
+        prepared the first time it is asked for, then shared by every
+        Trace.set_irf in this process. IRF_REGISTRY.clear() forgets them all. """
+    key = ( os.path.abspath( fname ), wraptime, dispersion )
+    if not IRF_REGISTRY.has_key( key ):
+        irf = Trace( fname )
+        if wraptime is not None: irf.wrapcurves( wraptime )
+        IRF_REGISTRY[key] = _prepare_irf( irf, dispersion )
+    return IRF_REGISTRY[key]
+
+
+# what fit_exponential changes on a Trace; see _fit_start
+FIT_ATTRIBUTES = [ 'fitstart', 'deconvolved', 'bestparams', 'pcov', 'stderr', 'fitresults',
+                   'lifetime', 'bestfit', 'model', 'has_fit' ]
+
+# what a memoized fit may change on a Trace (and gets stored); see memoized_fit
+MEMO_ATTRIBUTES = FIT_ATTRIBUTES + [ 'multistart', 'coarse_to_fine', 'lifetime_distribution' ]
+
+# part of every memoized_fit key: changes with the fit code (this file and FastFit.pyx),
+# so that a change to the results of a fit misses the results stored before it
+FIT_CACHE_VERSION = SOURCE_VERSION + filecache.source_version(
+    os.path.join( os.path.dirname( os.path.abspath( __file__ ) ), 'FastFit.pyx' ) )
+
+def _fingerprint( value, h ):
+    """ feed a description of value (arrays, containers, functions, numbers...) into the hash h """
+    if isinstance( value, np.ndarray ):
+        h.update( repr( (value.dtype.str, value.shape) ) )
+        h.update( np.ascontiguousarray( value ).tostring() )
+    elif isinstance( value, dict ):
+        h.update( 'dict%d' % len(value) )
+        for key in sorted( value ):
+            _fingerprint( key, h )
+            _fingerprint( value[key], h )
+    elif isinstance( value, (list, tuple) ):
+        h.update( '%s%d' % (type(value).__name__, len(value)) )
+        for item in value: _fingerprint( item, h )
+    elif hasattr( value, 'func_code' ): # e.g. the Tdist of fit_lifetime_distribution
+        h.update( value.func_code.co_code )
+        h.update( repr([ c for c in value.func_code.co_consts if not hasattr( c, 'co_code' ) ]) )
+        _fingerprint( value.func_defaults, h )
+    else:
+        h.update( repr( value ) )
+
+def _fit_key( trace, name, call ):
+    """ hash of everything fit method `name` of trace depends on, called with the arguments in call """
+    h = hashlib.sha1( '%s %s' % (name, FIT_CACHE_VERSION) )
+    curve_num = call.get( 'curve_num', 0 )
+    # curve, time axis and noise (see Trace.sigma), and the laser period
+    _fingerprint( [ trace.curves[curve_num], trace.t[curve_num], trace.raw_curves[curve_num],
+                    trace.curves[0].max(), trace.raw_curves[0].max(), trace.curveheaders[0]['InpRate0'] ], h )
+    if trace.irf is not None:
+        _fingerprint( [ trace.irf_generator, trace.irf_dt, trace.irf_t0, trace.irf_dispersion ], h )
+    _fingerprint( call, h )
+    return h.hexdigest()
+
+def memoized_fit( method ):
+    """ Decorator for the Trace.fit_* methods: a fit whose inputs (curve, noise,
+        IRF and every argument except verbose and processes) match a previous
+        fit is loaded from the persistent cache (see filecache.py, which also
+        bounds its size) instead of being repeated. The key also holds
+        FIT_CACHE_VERSION, so editing the fit code misses the results stored
+        before. The attributes in MEMO_ATTRIBUTES are cleared before a fit, and
+        every one it leaves on the trace is stored, so a trace loaded from the
+        cache looks just like the one that was fit.
+        Pass memoize=False to bypass the cache (neither loading nor
+        storing); filecache.enabled = False switches it off.
+    """
+    argnames, varargs, varkw, defaults = inspect.getargspec( method )
+    defaults = dict( zip( argnames[-len(defaults):], defaults ) ) if defaults else dict()
+    tag = 'PicoQuantUtils_FastFit.Trace.' + method.__name__
+    @functools.wraps( method )
+    def memoized( self, *args, **kwargs ):
+        if not kwargs.pop( 'memoize', True ) or not filecache.enabled:
+            return method( self, *args, **kwargs )
+        call = dict( defaults )
+        call.update( zip( argnames[1:], args ) )
+        call.update( kwargs )
+        verbose = call.pop( 'verbose', False )
+        call.pop( 'processes', None ) # the same fit, whatever the size of the pool
+        key = _fit_key( self, method.__name__, call )
+        state = filecache.load_key( tag, key )
+        if state is not None:
+            self.__dict__.update( state )
+            if verbose:
+                print "(stored result of an identical fit)"
+                self.print_fitresults()
+            return
+        # clear the results of earlier fits, so that what is there afterwards (and
+        # gets stored) is exactly what this fit set, not e.g. a model left over
+        before = dict( (name, self.__dict__.pop( name )) for name in MEMO_ATTRIBUTES if self.__dict__.has_key( name ) )
+        try:
+            result = method( self, *args, **kwargs )
+        except Exception:
+            self.__dict__.update( before )
+            raise
+        filecache.store_key( tag, key, dict( (name, self.__dict__[name]) for name in MEMO_ATTRIBUTES
+                                             if self.__dict__.has_key( name ) ) )
+        return result
+    return memoized
+
 
 class Trace():
     """ A class for holding lifetime data. You pass
@@ -24,34 +324,86 @@ class Trace():
         and it will load it and offer various methods
         for plotting, wrapping (removing time offset)
         and fitting exponentials.
+
+        Pass memmap=True to skip the int conversion (and the cache):
+        each curve is then a read-only view of the bytes read from the
+        file, only copied (to float) when a method modifies it. This
+        saves time and memory when loading many traces, and keeps no
+        file open.
     """
-    def __init__( self, phdfile ):
+    def __init__( self, phdfile=None, memmap=False ):
         self.fname = phdfile
         self.has_fit = False
         self.ax = None
         self.irf = None
         self.wraptime = None
         self.in_counts_per_second = False
+        if phdfile is None:
+            return # empty trace, to be filled in by e.g. Trace.from_histogram
+
+        # a file that was parsed before is loaded from the cache (see filecache.py);
+        # memmap=True is for loading many traces cheaply, which skips the cache.
+        state = None if memmap else filecache.load( 'PicoQuantUtils_FastFit.Trace', phdfile, SOURCE_VERSION )
+        if state is not None:
+            self.__dict__.update( state )
+            return
+
+        unparsed = set( self.__dict__.keys() )
         with open( phdfile, 'rb' ) as self.fobj:
             self.readasciiheader( verbose=False )
             self.readbinaryheader( verbose=False )
             self.readboardheader()
             self.readcurveheaders( verbose=False )
-            self.readhistograms()
+            self.readhistograms( memmap=memmap )
             self.resolution = self.curveheaders[0]['Resolution'] # curve 0 resolution, actually (ns)
             self.t = []
             for i, curve in enumerate( self.curves ):
                 self.t.append( pylab.arange(len(curve))*self.curveheaders[i]['Resolution'] )# this is in ns
             self.raw_t = self.t[:]
-        
-    def fit_exponential( self, tstart=0.0, tend=None, guess=dict( l0=5.0, a0=1.0, b=0.0 ), num_exp=None,
+        if not memmap:
+            state = dict( (key, value) for key, value in self.__dict__.iteritems()
+                          if key not in unparsed and key != 'fobj' )
+            filecache.store( 'PicoQuantUtils_FastFit.Trace', phdfile, state, SOURCE_VERSION )
+        
+    def __getstate__( self ):
+        """ for pickling (e.g. to send a trace to worker processes):
+            leave out the (closed) file object and the plot axes """
+        state = self.__dict__.copy()
+        state.pop( 'fobj', None )
+        state['ax'] = None
+        return state
+
+    @classmethod
+    def from_histogram( cls, curve, resolution, inprate0, tacq, fname=None ):
+        """ Make a Trace out of a histogram that didn't come from a .phd file,
+            e.g. one built from time-tagged (.pt2/.pt3) data by PicoQuantTTTR.
+            resolution is the bin width (ns), inprate0 the laser repetition
+            rate (Hz) and tacq the acquisition time (ms), just like the
+            corresponding .phd header entries.
+        """
+        trace = cls()
+        trace.fname = fname
+        trace.Tacq = tacq
+        trace.NumberOfCurves = 1
+        trace.curveheaders = [ dict( Resolution=resolution, InpRate0=inprate0,
+                                     Tacq=tacq, Channels=len(curve) ) ]
+        trace.curves = [ np.asarray( curve ) ]
+        trace.raw_curves = trace.curves[:]
+        trace.resolution = resolution
+        trace.t = [ pylab.arange(len(curve))*resolution ]
+        trace.raw_t = trace.t[:]
+        return trace
+
+    @memoized_fit
+    def fit_exponential( self, tstart=0.0, tend=None, guess=None, num_exp=None,
                          verbose=True, deconvolve=False, fixed_params=[None], 
-                         curve_num=0 ):
+                         curve_num=0, convolution='recursive', varpro=False,
+                         starts=1, processes=None, coarsen=None ):
         """
         fit a function of exponentials to a single curve of the file
         (my files only have one curve at this point anyway,
         curve 0). 
-        The parameter num_exp (default is 1, max is 3) defines the number of
+        The parameter num_exp (default is 1) defines the number of
         exponentials in the funtion to be fitted.
         num_exp=1 yields:
         f(t) = a0*exp(-t/l0) + b
@@ -62,12 +414,10 @@ class Trace():
         
         If tend==None, we fit until the end of the curve.
         
-        If num_exp > 1, you will need to modify the initial
-        parameters for the fit (i.e. pass the method an explicit `guess`
-        parameter) because the default has only three parameters
-        but you will need two additional parameters for each additional
-        exponential (another lifetime and another amplitude) to describe
-        a multi-exponential fit. 
+        Without a guess, the initial parameters for num_exp exponentials
+        (default 1) are estimated from the data (see estimate_guess).
+        Otherwise the guess needs two parameters (a lifetime and an
+        amplitude) for each exponential of a multi-exponential fit.
         For num_exp=2:
         f(t) = a1*exp(-t/l1) + a0*exp(-t/l0) + b
         
@@ -75,61 +425,84 @@ class Trace():
         f(t) = a2*exp(-t/l2) + a1*exp(-t/l1) + a0*exp(-t/l0) + b
         
         verbose=True (default) results in printing of fitting results to terminal.
+
+        With deconvolve=True, `convolution` chooses how the model is convolved
+        with the IRF: 'recursive' (default) uses an O(N) recursion that is exact
+        for sums of exponentials, 'fft' the FFT (see FastFit.pyx).
+
+        varpro=True fits by variable projection: the optimizer only varies
+        the lifetimes (and tshift, trise, t_ag or t_d3), and for every trial the
+        amplitudes (and, without deconvolution, b) follow from a weighted linear
+        least-squares solve. This needs far fewer iterations for 3-5 exponentials.
+        With deconvolve=True the offset b is not part of the convolved model and
+        is left at its guess.
+
+        starts > 1 fits from that many initial guesses (see multistart_guesses:
+        the lifetimes and amplitudes vary over a factor of 4 around guess) in a
+        pool of `processes` worker processes (processes=1: in this process) and
+        keeps the fit with the lowest ReducedChi2. starts can also be a list of
+        guess dicts. self.multistart records how many starts found that optimum.
+
+        coarsen=8 (or a list of factors, e.g. [16, 4]) first fits copies of the
+        trace with the curve, the IRF and the noise rebinned by those factors
+        (see rebinned), coarsest first, each starting from the solution of the
+        one before, and then refines at full resolution. The starts are only
+        used for the coarsest stage. self.coarse_to_fine records every
+        stage's factor, number of bins, ReducedChi2 and time (s).
+
+        Fits are memoized (see memoized_fit); memoize=False fits again.
         
         """
+        if guess is None:
+            guess = self.estimate_guess( 1 if num_exp is None else num_exp, tstart=tstart, tend=tend,
+                                         curve_num=curve_num, deconvolve=deconvolve )
+        if coarsen is not None:
+            return self._fit_coarse_to_fine( coarsen, verbose,
+                        dict( tstart=tstart, tend=tend, guess=guess, num_exp=num_exp,
+                              deconvolve=deconvolve, fixed_params=fixed_params, curve_num=curve_num,
+                              convolution=convolution, varpro=varpro, starts=starts, processes=processes ) )
+        if not isinstance( starts, int ) or starts > 1:
+            return self._fit_multistart( starts, processes, verbose,
+                        dict( tstart=tstart, tend=tend, guess=guess, num_exp=num_exp,
+                              deconvolve=deconvolve, fixed_params=fixed_params, curve_num=curve_num,
+                              convolution=convolution, varpro=varpro ) )
         self.fitstart = tstart
         self.deconvolved = deconvolve
         tpulse = 1.0e9/self.curveheaders[0]['InpRate0'] # avg. time between pulses, in ns
 
         if num_exp is None:
-            num_exp = 1 + int(guess.has_key('l1')) + int(guess.has_key('l2')) + int(guess.has_key('l3')) + int(guess.has_key('l4'))
-            if num_exp != 1 + int(guess.has_key('a1')) + int(guess.has_key('a2')) + int(guess.has_key('a3')) + int(guess.has_key('a4')):
+            num_exp = 1
+            while guess.has_key( 'l%d' % num_exp ): num_exp += 1
+            num_a = 1
+            while guess.has_key( 'a%d' % num_a ): num_a += 1
+            if num_exp != num_a:
                 raise ValueError("Missing a parameter! Unequal number of lifetimes and amplitudes.")
 
-        keylist = [ "l0", "a0", "b" ]
-        errlist = [ "l0_err", "a0_err" ]
-        if num_exp == 2:
-            keylist = [ "l1", "a1", "l0", "a0", "b" ]
-            errlist = [ "l1_err", "a1_err", "l0_err", "a0_err" ]
-        elif num_exp == 3 and not guess.has_key('t_ag') and not guess.has_key('t_d3'):
-            keylist = [ "l2", "a2", "l1", "a1", "l0", "a0", "b" ]
-            errlist = [ "l2_err", "a2_err", "l1_err", "a1_err", "l0_err", "a0_err" ]
-        elif num_exp == 3 and guess.has_key('t_ag'):
-            keylist = [ "l2", "a2", "l1", "a1", "l0", "a0", "t_ag" ]
-            errlist = [ "l2_err", "a2_err", "l1_err", "a1_err", "l0_err", "a0_err" ]
-        elif num_exp == 3 and guess.has_key('t_d3'):
-            keylist = [ "l2", "a2", "l1", "a1", "l0", "a0", "t_d3" ]
-            errlist = [ "l2_err", "a2_err", "l1_err", "a1_err", "l0_err", "a0_err" ]
-        elif num_exp == 4:
-            keylist = [ "l3", "a3", "l2", "a2", "l1", "a1", "l0", "a0", "b" ]
-            errlist = [ "l3_err", "a3_err", "l2_err", "a2_err", "l1_err", "a1_err", "l0_err", "a0_err" ]
-        elif num_exp == 5:
-            keylist = [ "l4", "a4", "l3", "a3", "l2", "a2", "l1", "a1", "l0", "a0", "b" ]
-            errlist = [ "l4_err", "a4_err", "l3_err", "a3_err", "l2_err", "a2_err", "l1_err", "a1_err", "l0_err", "a0_err" ]
+        if guess.has_key('t_ag'):
+            keylist = exponential_keys( num_exp, offset='t_ag' )
+        elif guess.has_key('t_d3'):
+            keylist = exponential_keys( num_exp, offset='t_d3' )
+        else:
+            keylist = exponential_keys( num_exp )
+        errlist = [ key+"_err" for key in keylist[:-1] ]
                     
                     
-        # sigma (std dev.) is equal to sqrt of intensity, see
-        # Lakowicz, principles of fluorescence spectroscopy (2006)
-        # sigma gets inverted to find a weight for leastsq, so avoid zero
-        # and imaginary weight doesn't make sense.
-        trace_scaling = self.curves[0].max()/self.raw_curves[0].max()
-        sigma = pylab.sqrt(self.raw_curves[curve_num]*trace_scaling) # use raw curves for actual noise, scale properly
-        if pylab.any(sigma==0): # prevent division by zero
-            iz = pylab.find(sigma==0)
-            sigma[iz] = 1
+        sigma = self.sigma( curve_num )
 
         if deconvolve==False:
             params = [ guess[key] for key in keylist ]
             free_params = [ i for i,key in enumerate(keylist) if not key in fixed_params ]
             initparams = [ guess[key] for key in keylist if not key in fixed_params ]
-            def f(t, *args ):
-                for i,arg in enumerate(args): params[ free_params[i] ] = arg
-                local_params = params[:]
-                b = local_params.pop(-1)
-                result = pylab.zeros(len(t))
-                for l,a in zip(params[::2],params[1::2]):
-                    result += abs(a)*pylab.exp(-(t-tstart)/abs(l))
-                return result+b
+            # model and its analytic jacobian (columns of the free parameters only),
+            # so the solver doesn't need extra model evaluations for finite differences
+            all_params = np.array( params, dtype=np.float )
+            def f( t, *args ):
+                all_params[ free_params ] = args
+                return multi_exponential( t-tstart, all_params[0:-1:2], all_params[1:-1:2], all_params[-1] )
+
+            def jac( t, *args ):
+                all_params[ free_params ] = args
+                return multi_exponential_jacobian( t-tstart, all_params[0:-1:2], all_params[1:-1:2] )[:, free_params]
 
             istart = pylab.find( self.t[curve_num] >= tstart )[0]
             if tend is not None:
@@ -137,10 +510,21 @@ class Trace():
             else:
                 iend = len(self.t[curve_num])
 
-            self.bestparams, self.pcov = curve_fit( f, self.t[curve_num][istart:iend],
+            if varpro:
+                if keylist[-1] != 'b': raise ValueError("varpro=True needs the plain offset b (no t_ag or t_d3)")
+                t_fit = self.t[curve_num][istart:iend]-tstart
+                def basis( p ):
+                    decays = np.exp( -t_fit[:,None]/abs( np.array( p[0:-1:2], dtype=np.float ) ) )
+                    return np.hstack([ decays, np.ones( (len(t_fit),1) ) ])
+                self.bestparams, self.pcov = self._fit_varpro( keylist, params, free_params, keylist[1:-1:2]+['b'],
+                                        basis, self.curves[curve_num][istart:iend], sigma[istart:iend],
+                                        scale_pcov=True )
+            else:
+                self.bestparams, self.pcov = curve_fit( f, self.t[curve_num][istart:iend],
                                             self.curves[curve_num][istart:iend],
                                             p0=initparams,
-                                            sigma=sigma[istart:iend])
+                                            sigma=sigma[istart:iend],
+                                            jac=jac)
         else:
             if self.irf == None: raise AttributeError("No detector trace!!! Use self.set_detector() method.")
             t0 = tstart
@@ -161,17 +545,8 @@ class Trace():
             initparams = [ guess[key] for key in keylist if not key in fixed_params ]
 
             def f( t, *args ): # only gets used for bestfit line
-                for i,arg in enumerate(args): params[ free_params[i] ] = arg
-                local_params = params[:]
-                if guess.has_key("trise"): trise = local_params.pop(-1)
-                if guess.has_key("tshift"):
-                    tshift = local_params[-1]
-                else:
-                    tshift = 0.0
-                ideal = fmodel( t, *args )
-                irf = cspline1d_eval( self.irf_generator, t-tshift, dx=self.irf_dt, x0=self.irf_t0 )
-                convoluted = pylab.real(pylab.ifft( pylab.fft(ideal)*pylab.fft(irf) )) # very small imaginary anyway
-                return convoluted
+                # same convolution (cached IRF spectrum) as used during the fit
+                return Function.evaluate( np.array(args,dtype=np.float), np.array(t,dtype=np.float) )
 
             def fmodel( t, *args ):
                 for i,arg in enumerate(args): params[ free_params[i] ] = arg
@@ -208,9 +583,22 @@ class Trace():
                     self.irf_dt,
                     self.irf_t0,
                     self.irf_generator,
-                    sigma )
-            res = Function.fit( self.t[curve_num], self.curves[curve_num], np.array(initparams,dtype=np.float) )
-            (self.bestparams, self.pcov, infodict, errmsg, ier) = res
+                    sigma,
+                    convolution=convolution,
+                    irf_spectra=self.irf_spectra )
+            if varpro:
+                if guess.has_key('a_fix'): raise ValueError("varpro=True can't be combined with a_fix")
+                t_fit = np.array( self.t[curve_num], dtype=np.float )
+                def basis( p ):
+                    return Function.basis( np.array( [ p[i] for i in free_params ], dtype=np.float ), t_fit )
+                # b isn't part of the convolved model, so keep it out of the fit
+                inactive = [ 'b' ] if 'b' in keylist else []
+                self.bestparams, self.pcov = self._fit_varpro( keylist, params, free_params,
+                                        [ key for key in keylist if key[0] == 'a' and key[1:].isdigit() ],
+                                        basis, self.curves[curve_num], sigma, inactive=inactive )
+            else:
+                res = Function.fit( self.t[curve_num], self.curves[curve_num], np.array(initparams,dtype=np.float) )
+                (self.bestparams, self.pcov, infodict, errmsg, ier) = res
 
         if pylab.size(self.pcov) > 1 and len(pylab.find(self.pcov == pylab.inf))==0:
             self.stderr = pylab.sqrt( pylab.diag(self.pcov) ) # is this true?
@@ -257,12 +645,8 @@ class Trace():
         for l,a,lkey,akey in zip(stderr[::2],stderr[1::2],errlist[::2],errlist[1::2]):
             self.fitresults[lkey] = l
             self.fitresults[akey] = a
-        self.fitresults['l0_int'] = self.fitresults['l0']*self.fitresults['a0']
-
-        if num_exp > 1: self.fitresults['l1_int'] = self.fitresults['l1']*self.fitresults['a1']
-        if num_exp > 2: self.fitresults['l2_int'] = self.fitresults['l2']*self.fitresults['a2']
-        if num_exp > 3: self.fitresults['l3_int'] = self.fitresults['l3']*self.fitresults['a3']
-        if num_exp > 4: self.fitresults['l4_int'] = self.fitresults['l4']*self.fitresults['a4']
+        for i in range( num_exp ):
+            self.fitresults['l%d_int' % i] = self.fitresults['l%d' % i]*self.fitresults['a%d' % i]
 
         self.bestfit = f( self.t[curve_num], *self.bestparams )
         if deconvolve: self.model = fmodel( self.t[curve_num], *self.bestparams )
@@ -273,39 +657,308 @@ class Trace():
         self.fitresults['MSE'] = mean_squares/degrees_of_freedom
         self.fitresults['ReducedChi2'] = Chi2/degrees_of_freedom
 
-        if verbose:
-            print "Fit results: (Reduced Chi2 = %.3E)" % (self.fitresults['ReducedChi2'])
-            print "             (MSE = %.3E)" % (self.fitresults['MSE'])
-            print "  Offset/t_ag/scale = %.3f +-%.3e" % (self.fitresults['b'], self.fitresults['b_err'])
-            print "  l0=%.3f +-%.3f ns, a0=%.3e +-%.3e" % (self.fitresults['l0'],
-                                                            self.fitresults['l0_err'],
-                                                            self.fitresults['a0'],
-                                                            self.fitresults['a0_err'])
-            if num_exp > 1:
-                print "  l1=%.3f +-%.3f ns, a1=%.3e +-%.3e" % (self.fitresults['l1'],
-                                                            self.fitresults['l1_err'],
-                                                            self.fitresults['a1'],
-                                                            self.fitresults['a1_err'])
-            if num_exp > 2:
-                print "  l2=%.3f +-%.3f ns, a2=%.3e +-%.3e" % (self.fitresults['l2'],
-                                                            self.fitresults['l2_err'],
-                                                            self.fitresults['a2'],
-                                                            self.fitresults['a2_err'])
-            if num_exp > 3:
-                print "  l3=%.3f +-%.3f ns, a3=%.3e +-%.3e" % (self.fitresults['l3'],
-                                                            self.fitresults['l3_err'],
-                                                            self.fitresults['a3'],
-                                                            self.fitresults['a3_err'])
-            if num_exp > 4:
-                print "  l4=%.3f +-%.3f ns, a4=%.3e +-%.3e" % (self.fitresults['l4'],
-                                                            self.fitresults['l4_err'],
-                                                            self.fitresults['a4'],
-                                                            self.fitresults['a4_err'])
-            print " "
+        if verbose: self.print_exponential_fit()
 
         self.has_fit = True
 
+    def print_fitresults( self ):
+        """ print self.fitresults """
+        if self.fitresults.has_key( 'l0_int' ):
+            self.print_exponential_fit()
+            return
+        width = 15
+        for key, value in sorted(self.fitresults.iteritems()):
+            if value == None:
+                print '%s: None' % (key.rjust(width))
+            else:
+                print '%s: %.3f' % (key.rjust(width), value)
+        print " "
+
+    def print_exponential_fit( self ):
+        """ print the results of fit_exponential """
+        print "Fit results: (Reduced Chi2 = %.3E)" % (self.fitresults['ReducedChi2'])
+        print "             (MSE = %.3E)" % (self.fitresults['MSE'])
+        print "  Offset/t_ag/scale = %.3f +-%.3e" % (self.fitresults['b'], self.fitresults['b_err'])
+        i = 0
+        while self.fitresults.has_key( 'l%d' % i ):
+            print "  l%d=%.3f +-%.3f ns, a%d=%.3e +-%.3e" % (i, self.fitresults['l%d' % i],
+                                                         self.fitresults['l%d_err' % i],
+                                                         i, self.fitresults['a%d' % i],
+                                                         self.fitresults['a%d_err' % i])
+            i += 1
+        print " "
+
+    def _fit_multistart( self, starts, processes, verbose, kwargs ):
+        """ fit_exponential( starts=... ): fit from every start (in parallel),
+            keep the best fit and set self.multistart to a dict holding the
+            'guesses', the 'ReducedChi2' of each (NaN if the fit failed), and how
+            many starts 'converged' to the best fit (same ReducedChi2 within
+            0.01 % and same lifetimes within 1 %) or 'failed'.
+        """
+        guess = kwargs['guess']
+        if isinstance( starts, int ):
+            keys = sorted( key for key in guess if key[0] in 'la' and key[1:].isdigit()
+                           and key not in kwargs['fixed_params'] )
+            guesses = multistart_guesses( guess, keys, starts )
+        else:
+            guesses = list( starts )
+        results = _pool_map( _fit_start, [ (self, dict( kwargs, guess=g )) for g in guesses ], processes )
+
+        chi2 = np.array([ np.NaN if r is None else r['fitresults']['ReducedChi2'] for r in results ])
+        if np.all( np.isnan( chi2 ) ):
+            raise RuntimeError("None of the %d starts of the fit converged" % len( guesses ))
+        ibest = np.nanargmin( chi2 )
+        best = results[ibest]
+        def lifetimes( r ):
+            return np.sort([ value for key, value in r['fitresults'].iteritems()
+                             if key[0] == 'l' and key[1:].isdigit() ])
+        converged = [ i for i, r in enumerate( results ) if r is not None
+                      and abs( chi2[i]-chi2[ibest] ) <= 1.0e-4*chi2[ibest]
+                      and np.allclose( lifetimes( r ), lifetimes( best ), rtol=1.0e-2, atol=0.0 ) ]
+        self.__dict__.update( best )
+        self.multistart = dict( guesses=guesses, ReducedChi2=chi2, best=ibest,
+                                converged=len( converged ), failed=int( np.sum( np.isnan( chi2 ) ) ) )
+        if verbose:
+            print "%d of %d starts converged to the best fit (%d failed)" % (len( converged ), len( guesses ),
+                                                                           self.multistart['failed'])
+            self.print_exponential_fit()
+
+
+    def estimate_guess( self, num_exp=1, tstart=None, tend=None, curve_num=0, deconvolve=False ):
+        """ Initial parameters for fit_exponential (l0, a0, ..., b and, with
+            deconvolve=True, tshift) from the data alone:
+              b           -- mean of the counts just before the rise (which
+                             may have been wrapped to the end of the curve),
+                             less what is left there of the previous decay
+              lifetimes   -- from the decay after the peak (three rise times
+                             after it, or from tstart) to tend or the wrapped
+                             rise: rapid lifetime
+                             determination for one exponential (moment
+                             analysis if that fails), repeated over six
+                             lifetimes of decay, log-linear fits peeling
+                             off one exponential after the other for more
+                             (lifetimes spread around that one if those fail)
+              tshift      -- delay of the data relative to the model convolved
+                             with the IRF, from their cross-correlation
+              amplitudes  -- non-negative least squares for those lifetimes
+                             (and that tshift), weighted like the fit
+        """
+        t = np.asarray( self.t[curve_num], dtype=np.float )
+        y = np.asarray( self.curves[curve_num], dtype=np.float )
+        sigma = self.sigma( curve_num )
+        tpulse = 1.0e9/self.curveheaders[0]['InpRate0'] # avg. time between pulses, in ns
+        n, ipeak = len(y), int( np.argmax( y ) )
+        # The curve is periodic, and after wrapcurves the rise is (partly) at its
+        # end, so look for the rise going back from the peak, wrapping around:
+        # it starts three rise times (peak to half maximum) before the peak, and
+        # the background is the mean of the lowest stretch, just before that.
+        floor = np.percentile( y, 5 )
+        behind = y[ (ipeak - np.arange( n )) % n ]
+        rise = max( int( np.argmax( behind <= floor + 0.5*(y[ipeak]-floor) ) ), 1 )
+        ifoot = (ipeak - 3*rise) % n
+        b = float( np.mean( y[ (ifoot - np.arange( 1, max( n//20, 1 )+1 )) % n ] ) )
+        istart = min( ipeak + 3*rise, n-2 )
+        if tstart is not None: istart = max( istart, np.searchsorted( t, tstart ) )
+        iend = n if tend is None else np.searchsorted( t, tend, side='right' )
+        if ifoot > istart: iend = min( iend, ifoot ) # the decay ends at the wrapped rise
+        tail_t, dt = t[istart:iend], t[1]-t[0]
+
+        def single_lifetime( tail ):
+            # over the whole period the noise of the background swamps a short decay,
+            # so repeat the estimate over the first six lifetimes of the decay
+            tau, window = None, len(tail)
+            for i in range( 3 ):
+                estimate = rapid_lifetime( tail_t[:window], tail[:window] ) or moment_lifetime( tail_t[:window], tail[:window] )
+                if not estimate: break
+                tau, window = estimate, min( max( int( 6*estimate/dt ), 8 ), len(tail) )
+            return tau or (tail_t[-1]-tail_t[0])/3.0
+
+        lifetimes = tail_lifetimes( tail_t, y[istart:iend]-b, num_exp ) if num_exp > 1 else None
+        if lifetimes is None:
+            # before the rise, what is left of the decay after (almost) a period
+            # adds to the background: take it out of b and estimate again
+            pre_rise = b
+            tau = single_lifetime( y[istart:iend]-b )
+            for i in range( 3 ):
+                q = np.exp( -((ifoot-istart) % n)*dt/tau )
+                if q < 1.0e-3: break
+                level = np.mean( y[istart:istart+max( int( 0.1*tau/dt ), 1 )] )
+                b = max( (pre_rise - level*q)/(1.0-q), 0.0 )
+                tau = single_lifetime( y[istart:iend]-b )
+            lifetimes = [ tau*4.0**(k-(num_exp-1)/2.0) for k in range( num_exp ) ]
+
+        guess = dict( b=b )
+        if deconvolve and self.irf is not None:
+            def convolved( tshift ):
+                irf = cspline1d_eval( self.irf_generator, t-tshift, dx=self.irf_dt, x0=self.irf_t0 )
+                return np.fft.irfft( np.fft.rfft( lifetime_basis( t, lifetimes, tpulse ), axis=0 )*
+                                     np.fft.rfft( irf )[:,None], len(t), axis=0 )
+            basis = convolved( 0.0 )
+            model = basis.dot( nnls( basis/sigma[:,None], y/sigma )[0] )
+            xcorr = np.fft.irfft( np.fft.rfft( y-b )*np.conj( np.fft.rfft( model ) ), len(t) )
+            k = int( np.argmax( xcorr ) )
+            c0, c1, c2 = xcorr[k-1], xcorr[k], xcorr[(k+1) % len(t)]
+            lag = k + (0.5*(c0-c2)/(c0-2*c1+c2) if c0-2*c1+c2 < 0 else 0.0) # parabola through the peak
+            if lag > len(t)/2: lag -= len(t)
+            guess['tshift'] = lag*(t[1]-t[0])
+            amplitudes = nnls( convolved( guess['tshift'] )/sigma[:,None], y/sigma )[0]
+        else:
+            t0 = t[istart] if tstart is None else tstart
+            fit = (t >= t0) & (t <= (t[-1] if tend is None else tend))
+            basis = np.exp( -np.outer( t[fit]-t0, 1.0/np.array( lifetimes ) ) )
+            amplitudes = nnls( basis/sigma[fit][:,None], (y[fit]-b)/sigma[fit] )[0]
+        # a zero amplitude would leave its lifetime without any effect on the fit
+        amplitudes = np.maximum( amplitudes, 1.0e-3*amplitudes.max() if amplitudes.max() > 0 else 1.0 )
+        for i, (l, a) in enumerate( zip( lifetimes, amplitudes ) ):
+            guess['l%d' % i] = l
+            guess['a%d' % i] = a
+        return guess
+
+    def _fit_coarse_to_fine( self, factors, verbose, kwargs ):
+        """ fit_exponential( coarsen=... ): fit rebinned copies of the trace,
+            coarsest first, then this trace, each from the previous solution;
+            set self.coarse_to_fine to the list of stages (see fit_exponential) """
+        guess = kwargs.pop( 'guess' )
+        for key in ['t_ag', 't_d3', 'a_fix']:
+            if guess.has_key( key ): raise ValueError("coarsen can't be combined with %s" % key)
+        if isinstance( factors, int ): factors = [ factors ]
+        stages = []
+        scale = 1 # rebinning factor of the current guess: counts per bin scale with it
+        for factor in sorted( factors, reverse=True ) + [1]:
+            start = time.time()
+            stage_guess = dict( guess )
+            for key in guess:
+                if key == 'b' or (key[0] == 'a' and key[1:].isdigit()):
+                    stage_guess[key] = guess[key]*factor/float( scale )
+            trace = self if factor == 1 else self.rebinned( factor )
+            trace.fit_exponential( guess=stage_guess, verbose=False, memoize=False, **kwargs )
+            guess = dict( (key, trace.fitresults[key]) for key in guess )
+            scale = factor
+            stages.append( dict( factor=factor, bins=len( trace.curves[kwargs['curve_num']] ),
+                                 ReducedChi2=trace.fitresults['ReducedChi2'], time=time.time()-start ) )
+            kwargs.update( starts=1 )
+        self.coarse_to_fine = stages
+        if verbose:
+            for stage in stages:
+                label = "%dx rebinned" % stage['factor'] if stage['factor'] > 1 else "full resolution"
+                print "%15s (%5d bins): ReducedChi2 = %.3E in %.3f s" % (label, stage['bins'],
+                                                                        stage['ReducedChi2'], stage['time'])
+            self.print_exponential_fit()
+
+    def rebinned( self, factor ):
+        """ a copy of this trace with every `factor` bins (of the curves, the
+            raw curves that set the noise, and the IRF) summed into one,
+            at the mean time of the bins; a remainder of fewer than factor
+            bins at the end is dropped. Used by fit_exponential( coarsen=... ). """
+        trace = copy.copy( self )
+        def rebin( curves ):
+            return [ np.asarray( curve[:len(curve)//factor*factor], dtype=np.float ).reshape( -1, factor ).sum( axis=1 )
+                     for curve in curves ]
+        def rebin_time( times ):
+            return [ np.asarray( t[:len(t)//factor*factor], dtype=np.float ).reshape( -1, factor ).mean( axis=1 )
+                     for t in times ]
+        trace.curves = rebin( self.curves )
+        trace.raw_curves = rebin( self.raw_curves )
+        trace.t = rebin_time( self.t )
+        trace.raw_t = rebin_time( self.raw_t )
+        trace.resolution = self.resolution*factor
+        trace.curveheaders = [ dict( header, Resolution=header['Resolution']*factor ) for header in self.curveheaders ]
+        if self.irf is not None:
+            trace.irf = self.irf.rebinned( factor )
+            trace.irf_generator = cspline1d( trace.irf.curves[0] )
+            trace.irf_dt = trace.irf.t[0][1]-trace.irf.t[0][0]
+            trace.irf_t0 = trace.irf.t[0][0]
+            trace.irf_spectra = dict()
+        return trace
+
+    def sigma( self, curve_num=0 ):
+        """ standard deviation of every bin of curve curve_num, used to weight the fits """
+        # sigma (std dev.) is equal to sqrt of intensity, see
+        # Lakowicz, principles of fluorescence spectroscopy (2006)
+        # sigma gets inverted to find a weight for leastsq, so avoid zero
+        # and imaginary weight doesn't make sense.
+        trace_scaling = self.curves[0].max()/self.raw_curves[0].max()
+        sigma = pylab.sqrt(self.raw_curves[curve_num]*trace_scaling) # use raw curves for actual noise, scale properly
+        if pylab.any(sigma==0): # prevent division by zero
+            iz = pylab.find(sigma==0)
+            sigma[iz] = 1
+        return sigma
 
+    def _fit_varpro( self, keylist, params, free_params, linear_keys, basis, y, sigma,
+                     inactive=[], scale_pcov=False ):
+        """
+        Variable projection least squares for a model that is linear in the
+        parameters `linear_keys`: model = basis( p ) . [ p[key] for key in linear_keys ],
+        where basis( p ) returns one column per linear key and depends only on
+        the other (nonlinear) parameters in the full parameter list p.
+        leastsq only varies the free nonlinear parameters; for each trial the free
+        linear ones come from a weighted linear least-squares solve. The models
+        use abs(a), so if that leaves a negative amplitude, the fit is continued
+        with the amplitudes constrained to be >= 0. Keys in `inactive` are
+        not varied at all.
+        Returns (bestparams, pcov) for the parameters free_params, like leastsq/curve_fit;
+        pcov is computed from the jacobian of the full model at the solution and
+        multiplied by the reduced chi^2 if scale_pcov (as curve_fit does).
+        """
+        params = list( params )
+        weights = 1.0/np.asarray( sigma, dtype=np.float )
+        y = np.asarray( y, dtype=np.float )
+        columns = [ keylist.index( key ) for key in linear_keys ]
+        free_set = set( free_params ) - set( keylist.index( key ) for key in inactive )
+        free_linear = [ j for j, i in enumerate( columns ) if i in free_set ]
+        fixed_linear = [ j for j, i in enumerate( columns ) if i not in free_set ]
+        nonlinear = [ i for i in sorted( free_set ) if i not in columns ]
+        lower = [ 0.0 if linear_keys[j] != 'b' else -np.inf for j in free_linear ]
+
+        def project( args, bounded=False ):
+            for i, arg in zip( nonlinear, args ): params[i] = arg
+            phi = basis( params )
+            target = y - np.dot( phi[:, fixed_linear], [ params[columns[j]] for j in fixed_linear ] )
+            A = phi[:, free_linear]*weights[:,None]
+            if bounded:
+                c = lsq_linear( A, target*weights, bounds=(lower, np.inf) ).x
+            else:
+                c = np.linalg.lstsq( A, target*weights )[0]
+            for j, value in zip( free_linear, c ): params[columns[j]] = value
+            return (target - np.dot( phi[:, free_linear], c ))*weights
+
+        best = [ params[i] for i in nonlinear ]
+        if len( nonlinear ) > 0:
+            best = np.atleast_1d( leastsq( project, best )[0] )
+        residuals = project( best )
+        if any( params[columns[j]] < bound for j, bound in zip( free_linear, lower ) ):
+            if len( nonlinear ) > 0:
+                best = np.atleast_1d( leastsq( project, best, args=(True,) )[0] )
+            residuals = project( best, bounded=True )
+
+        # covariance of all free parameters from the jacobian of the weighted model
+        def model( p ):
+            return np.dot( basis( p ), [ p[i] for i in columns ] )*weights
+        active = [ i for i in free_params if i in free_set ]
+        J = np.empty( (len(y), len(active)) )
+        phi = basis( params )
+        for k, i in enumerate( active ):
+            if i in columns:
+                J[:,k] = phi[:, columns.index(i)]*weights
+            else:
+                step = 1.0e-6*max( abs( params[i] ), 1.0e-3 )
+                p_up, p_down = params[:], params[:]
+                p_up[i] += step
+                p_down[i] -= step
+                J[:,k] = (model( p_up ) - model( p_down ))/(2*step)
+        pcov = np.empty( (len(free_params), len(free_params)) )
+        pcov.fill( np.nan )
+        index = [ free_params.index( i ) for i in active ]
+        try:
+            cov = np.linalg.inv( np.dot( J.T, J ) )
+        except np.linalg.LinAlgError:
+            cov = np.inf*np.ones( (len(active), len(active)) )
+        if scale_pcov:
+            cov *= np.sum( residuals**2 )/(len(y) - len(active))
+        pcov[ np.ix_( index, index ) ] = cov
+        return np.array( [ params[i] for i in free_params ] ), pcov
+
+    @memoized_fit
     def fit_stretched_exponential( self, tstart=0.0, tend=None, guess=dict( l0=5.0, a0=1.0, h0=1.0 ),
                          verbose=True, deconvolve=False, fixed_params=[None], 
                          curve_num=0 ):
@@ -328,11 +981,7 @@ class Trace():
             keylist.append("h1")
                     
         errlist = [key+"_err" for key in keylist]
-        trace_scaling = self.curves[0].max()/self.raw_curves[0].max()
-        sigma = pylab.sqrt(self.raw_curves[curve_num]*trace_scaling) # use raw curves for actual noise, scale properly
-        if pylab.any(sigma==0): # prevent division by zero
-            iz = pylab.find(sigma==0)
-            sigma[iz] = 1
+        sigma = self.sigma( curve_num )
 
         if deconvolve==False:
             raise ValueError("Not yet implemented.")
@@ -351,25 +1000,14 @@ class Trace():
             initparams = [ guess[key] for key in keylist if not key in fixed_params ]
 
             def f( t, *args ): # only gets used for bestfit line
-                for i,arg in enumerate(args): params[ free_params[i] ] = arg
-                local_params = params[:]
-                tshift = local_params[-1]
-                ideal = fmodel( t, *args )
-                irf = cspline1d_eval( self.irf_generator, t-tshift, dx=self.irf_dt, x0=self.irf_t0 )
-                convoluted = pylab.real(pylab.ifft( pylab.fft(ideal)*pylab.fft(irf) )) # very small imaginary anyway
-                return convoluted
+                # same convolution (cached IRF spectrum) as used during the fit
+                return Function.evaluate( np.array(args,dtype=np.float), np.array(t,dtype=np.float) )
 
             def fmodel( t, *args ):
                 for i,arg in enumerate(args): params[ free_params[i] ] = arg
-                l, a, h = params[:3]
-                if guess.has_key('l1'): l1, a1, h1 = params[3:6]
-                result = pylab.zeros(len(t))
-                for j in range(10): # sum over current and previous pulses
-                    result += abs(a)*pylab.exp(-((t+j*tpulse)/abs(l))**(1.0/h)) # Kohlrausch function
-                    #result += abs(a)*pylab.exp(1-(1+(t+j*tpulse)/abs(l))**(1.0/h)) # modified Kohlrausch function (see Berberan-Santos et al., 2005)
-                    if guess.has_key('l1'):
-                        result += abs(a1)*pylab.exp(-((t+j*tpulse)/abs(l1))**(1.0/h1))
-                return result
+                components = [ params[:3] ]
+                if guess.has_key('l1'): components.append( params[3:6] )
+                return kohlrausch_pulses( t, tpulse, components ) # sum over current and previous pulses
 
             import pyximport; pyximport.install()
             import FastFit
@@ -383,7 +1021,8 @@ class Trace():
                     self.irf_dt,
                     self.irf_t0,
                     self.irf_generator,
-                    sigma )
+                    sigma,
+                    irf_spectra=self.irf_spectra )
             res = Function.fit( self.t[curve_num], self.curves[curve_num], np.array(initparams,dtype=np.float) )
             (self.bestparams, self.pcov, infodict, errmsg, ier) = res
 
@@ -436,6 +1075,7 @@ class Trace():
         self.has_fit = True
         
             
+    @memoized_fit
     def fit_lifetime_distribution( self,
                     tstart=0.0, tend=None,
                     Tdist=lambda tau, tc, a0, dt: a0*pylab.exp(-(1/tau-1/tc)**2/2*dt**2),
@@ -467,11 +1107,7 @@ class Trace():
             keylist.append("hss")
         errlist = [key+"_err" for key in keylist]
                     
-        trace_scaling = self.curves[0].max()/self.raw_curves[0].max()
-        sigma = pylab.sqrt(self.raw_curves[curve_num]*trace_scaling) # use raw curves for actual noise, scale properly
-        if pylab.any(sigma==0): # prevent division by zero
-            iz = pylab.find(sigma==0)
-            sigma[iz] = 1
+        sigma = self.sigma( curve_num )
 
         if deconvolve==False:
             raise ValueError("Not yet implemented.")
@@ -497,6 +1133,8 @@ class Trace():
                 convoluted = pylab.real(pylab.ifft( pylab.fft(ideal)*pylab.fft(irf) )) # very small imaginary anyway
                 return convoluted
 
+            fixed_basis = [ None, None ] # (t, basis) when the lifetimes in time_array do not depend on the parameters
+
             def fmodel( t, *args ):
                 for i,arg in enumerate(args): params[ free_params[i] ] = arg
                 local_params = params[:]
@@ -504,17 +1142,18 @@ class Trace():
                     p = local_params[:4]
                     fp0, tR, tNR, a0 = p
                     fp_array = pylab.linspace(1.0,fp0,Npts)
-                    time_array = 1/(fp_array/tR + 1/tNR)
+                    taus = 1/(fp_array/tR + 1/tNR)
+                    basis = lifetime_basis( t, taus, tpulse )
                 else:
                     p = local_params[:3]
+                    taus = time_array
+                    if fixed_basis[0] is None or not np.array_equal( fixed_basis[0], t ):
+                        fixed_basis[:] = [ np.array( t ), lifetime_basis( t, taus, tpulse ) ]
+                    basis = fixed_basis[1]
                 
-                result = pylab.zeros(len(t))
-                for tau in time_array:
-                    result += Tdist(tau,*p)*pylab.exp(-t/tau)/(1-pylab.exp(-tpulse/abs(tau)))
+                result = basis.dot( [ Tdist(tau,*p) for tau in taus ] )
                 if guess.has_key('lss'):
-                    lss, ass, hss = local_params[-4:-1]
-                    for j in range(10): # sum over previous pulses
-                        result += abs(ass)*pylab.exp(-((t+j*tpulse)/abs(lss))**(1.0/hss))
+                    result += kohlrausch_pulses( t, tpulse, [ local_params[-4:-1] ] ) # sum over previous pulses
 
                 return result
 
@@ -551,6 +1190,111 @@ class Trace():
 
         self.has_fit = True
 
+    def recover_lifetime_distribution( self, time_array=None, Npts=100, regularization=0.0,
+                    tstart=0.0, tend=None, tshift=0.0, offset=True,
+                    deconvolve=False, curve_num=0, verbose=True ):
+        """
+        Recover a lifetime distribution without a parametric Tdist: the curve is
+        modelled as a non-negative weight for each lifetime in time_array
+        (default: Npts lifetimes spaced logarithmically from the bin width to the
+        laser period) plus an offset b (offset=True), and all weights are found
+        at once by non-negative least squares.
+
+        regularization > 0 adds a Tikhonov penalty on the second difference of
+        the weights, which favours smooth distributions over a few sharp lines.
+        It is relative to the size of the (weighted) basis columns; values
+        around 1e-3 to 1e-1 are typical.
+
+        With deconvolve=True every lifetime is convolved with the IRF (see
+        set_irf) delayed by tshift, e.g. the tshift found by
+        fit_exponential( deconvolve=True ). Otherwise the curve is fit from
+        tstart to tend, like fit_exponential does.
+
+        The result is stored in self.lifetime_distribution = (time_array, weights);
+        self.fitresults holds b, the amplitude- and intensity-weighted mean
+        lifetimes tau_mean and tau_intensity, MSE and ReducedChi2.
+        """
+        self.fitstart = tstart
+        self.deconvolved = deconvolve
+        tpulse = 1.0e9/self.curveheaders[0]['InpRate0'] # avg. time between pulses, in ns
+        t = np.array( self.t[curve_num], dtype=np.float )
+        y = np.asarray( self.curves[curve_num], dtype=np.float )
+        sigma = self.sigma( curve_num )
+        if time_array is None:
+            time_array = np.logspace( np.log10( t[1]-t[0] ), np.log10( tpulse ), Npts )
+        time_array = np.asarray( time_array, dtype=np.float )
+
+        if deconvolve:
+            if self.irf == None: raise AttributeError("No detector trace!!! Use self.set_detector() method.")
+            istart, iend = 0, len(t)
+            irf = cspline1d_eval( self.irf_generator, t-tshift, dx=self.irf_dt, x0=self.irf_t0 )
+            basis = np.fft.irfft( np.fft.rfft( lifetime_basis( t, time_array, tpulse ), axis=0 )*
+                                  np.fft.rfft( irf )[:,None], len(t), axis=0 )
+        else:
+            istart = pylab.find( t >= tstart )[0]
+            if tend is not None:
+                iend = pylab.find( t <= tend )[-1]
+            else:
+                iend = len(t)
+            basis = lifetime_basis( t-tstart, time_array, tpulse )
+        if offset:
+            basis = np.hstack([ basis, np.ones( (len(t),1) ) ])
+
+        # weighted problem on the fitting window, with the penalty rows appended
+        A = basis[istart:iend]/sigma[istart:iend,None]
+        rhs = y[istart:iend]/sigma[istart:iend]
+        if regularization > 0:
+            D = np.diff( np.eye( len(time_array) ), 2, axis=0 )
+            D *= np.sqrt( regularization )*np.mean( np.sqrt( np.sum( A**2, axis=0 ) ) )
+            if offset: D = np.hstack([ D, np.zeros( (len(D),1) ) ])
+            A = np.vstack([ A, D ])
+            rhs = np.concatenate([ rhs, np.zeros( len(D) ) ])
+        coefficients, rnorm = nnls( A, rhs )
+        weights = coefficients[:len(time_array)]
+
+        self.lifetime_distribution = (time_array, weights)
+        self.bestparams = coefficients
+        self.bestfit = basis.dot( coefficients )
+        if deconvolve: self.model = lifetime_basis( t, time_array, tpulse ).dot( weights )
+        self.fitresults = dict()
+        self.fitresults['b'] = coefficients[-1] if offset else 0.0
+        self.fitresults['tau_mean'] = np.sum( weights*time_array )/np.sum( weights )
+        self.fitresults['tau_intensity'] = np.sum( weights*time_array**2 )/np.sum( weights*time_array )
+        if deconvolve:
+            self.fitresults['tshift'] = tshift
+            self.fitresults['irf_dispersion'] = self.irf_dispersion
+
+        residuals = self.bestfit[istart:iend] - y[istart:iend]
+        Chi2 = np.sum( residuals**2/sigma[istart:iend]**2 )
+        Chi2 *= self.raw_curves[0].max()/self.curves[0].max() # undo any scaling
+        degrees_of_freedom = len(residuals) - np.count_nonzero( coefficients )
+        self.fitresults['MSE'] = np.mean( residuals**2 )/degrees_of_freedom
+        self.fitresults['ReducedChi2'] = Chi2/degrees_of_freedom
+
+        if verbose:
+            width = 15
+            for key, value in sorted(self.fitresults.iteritems()):
+                print '%s: %.3f' % (key.rjust(width), value)
+            print " "
+
+        self.has_fit = True
+
+    def phasor( self, harmonic=1, curve_num=0, calibrate=True, background=None ):
+        """ Phasor screening of curve curve_num instead of a fit: returns a dict with
+            the phasor coordinates 'g' and 's' and the phase and modulation
+            lifetimes 'tau_phase' and 'tau_mod' (ns) at the given harmonic of
+            the laser repetition rate. With calibrate=True (and an IRF set with
+            set_irf) the IRF's phasor is divided out. See the module function phasor.
+        """
+        tpulse = 1.0e9/self.curveheaders[0]['InpRate0']
+        irf = None
+        if calibrate and self.irf is not None:
+            irf = self.irf.curves[0][:len(self.curves[curve_num])]
+        F = phasor( self.curves[curve_num], self.t[curve_num], tpulse, harmonic=harmonic,
+                    irf=irf, background=background )
+        tau_phase, tau_mod = phasor_lifetimes( F, tpulse, harmonic )
+        return dict( g=np.real(F), s=np.imag(F), tau_phase=tau_phase, tau_mod=tau_mod, harmonic=harmonic )
+
     def autocorr( self ):
         x = self.residuals()
         result = pylab.correlate( x, x, mode='full' )
@@ -737,147 +1481,32 @@ class Trace():
         #
         ##################################################################################
         """
-            I use the struct module to unpack the binary SPE data.
-            Some useful formats for struct.unpack_from() include:
-            fmt   c type          python
-            c     char            string of length 1
-            s     char[]          string (Ns is a string N characters long)
-            h     short           integer 
-            H     unsigned short  integer
-            l     long            integer
-            f     float           float
-            d     double          float
-            
-            precede these with '=' to force usage of standard python sizes,
-            not native sizes (to make usage the same on 32 and 64-bit systems)
+            The layout of the header is declared once in PHD_BINARY_HEADER
+            (a numpy structured dtype, see top of this module), so the whole
+            208-byte block is decoded with a single np.frombuffer call.
+            Every scalar field becomes an attribute of the same name, e.g.
+            self.NumberOfCurves or self.Tacq (acquisition time in ms).
         """
         
-        binheader = self.fobj.read( 208 ) # should take up 208 bytes in memory...
+        binheader = np.frombuffer( self.fobj.read( PHD_BINARY_HEADER.itemsize ),
+                                      dtype=PHD_BINARY_HEADER, count=1 )[0]
+        self.binaryheader = _record_to_dict( binheader )
 
-        self.NumberOfCurves = struct.unpack_from( "=l", binheader, offset=0 )[0]
-        if verbose: 
-            print "Number of curves:", self.NumberOfCurves
-        
-        self.BitsPerHistogramBin = struct.unpack_from( "=l", binheader, offset=4 )[0]
-        if verbose: 
-            print "Bits per histogram bin:", self.BitsPerHistogramBin
-        
-        self.RoutingChannels = struct.unpack_from( "=l", binheader, offset=8 )[0]
-        if verbose: 
+        for name in PHD_BINARY_HEADER.names:
+            if PHD_BINARY_HEADER[name].shape == ():
+                setattr( self, name, self.binaryheader[name] )
+
+        self.DispCurveMapTo = binheader['DispCurves']['MapTo'].tolist()
+        self.DispCurveShow = binheader['DispCurves']['Show'].tolist()
+        self.ParamStart = binheader['Params']['Start'].tolist()
+        self.ParamStep = binheader['Params']['Step'].tolist()
+        self.ParamEnd = binheader['Params']['End'].tolist()
 
-            print "Number of routing channels:", self.RoutingChannels
-        
-        self.NumberOfBoards = struct.unpack_from( "=l", binheader, offset=12 )[0]
-        if verbose: 
-            print "Number of boards:", self.NumberOfBoards
-        
-        self.ActiveCurve = struct.unpack_from( "=l", binheader, offset=16 )[0]
-        if verbose: 
-            print "Active curve:", self.ActiveCurve
-        
-        self.MeasurementMode = struct.unpack_from( "=l", binheader, offset=20 )[0]
-        if verbose: 
-            print "Measurement mode:", self.MeasurementMode
-        
-        self.SubMode = struct.unpack_from( "=l", binheader, offset=24 )[0]
-        if verbose: 
-            print "Sub mode:", self.SubMode
-        
-        self.RangeNo = struct.unpack_from( "=l", binheader, offset=28 )[0]
-        if verbose: 
-            print "Range number:", self.RangeNo
-        
-        self.Offset = struct.unpack_from( "=l", binheader, offset=32 )[0]
-        if verbose: 
-            print "Offset:", self.Offset
-        
-        self.Tacq = struct.unpack_from( "=l", binheader, offset=36 )[0]
-        if verbose: 
-            print "Acquisition time (ms):", self.Tacq
-        
-        self.StopAt = struct.unpack_from( "=l", binheader, offset=40 )[0]
-        if verbose: 
-            print "Stop at (counts):", self.StopAt
-        
-        self.StopOnOverflow = struct.unpack_from( "=l", binheader, offset=44 )[0]
-        if verbose: 
-            print "Stop on overflow:", self.StopOnOverflow
-        
-        self.Restart = struct.unpack_from( "=l", binheader, offset=48 )[0]
-        if verbose: 
-            print "Restart:", self.Restart
-        
-        self.DispLinLog = struct.unpack_from( "=l", binheader, offset=52 )[0]
-        if verbose: 
-            print "Display lin/log:", self.DispLinLog
-        
-        self.DispTimeAxisFrom = struct.unpack_from( "=l", binheader, offset=56 )[0]
-        if verbose: 
-            print "Time axis from (ns):", self.DispTimeAxisFrom
-        
-        self.DispTimeAxisTo = struct.unpack_from( "=l", binheader, offset=60 )[0]
-        if verbose: 
-            print "Time axis to (ns):", self.DispTimeAxisTo
-        
-        self.DispCountAxisFrom = struct.unpack_from( "=l", binheader, offset=64 )[0]
-        if verbose: 
-            print "Count Axis From:", self.DispCountAxisFrom
-        
-        offset = 68
-        self.DispCountAxisTo = struct.unpack_from( "=l", binheader, offset=offset )[0]
-        if verbose: 
-            print "Count Axis To:", self.DispCountAxisTo
-        
-        self.DispCurveMapTo = []
-        self.DispCurveShow = []    
-        for i in range(8):
-            offset += 4
-            self.DispCurveMapTo.append( struct.unpack_from( "=l", binheader, offset=offset )[0] )
-            offset += 4
-            self.DispCurveShow.append( struct.unpack_from( "=l", binheader, offset=offset+4 )[0] )
-
-        self.ParamStart = []
-        self.ParamStep = []
-        self.ParamEnd = []    
-        for i in range(3):
-            offset += 4
-            self.ParamStart.append( struct.unpack_from( "=f", binheader, offset=offset )[0] )
-
-            offset += 4
-            self.ParamStep.append( struct.unpack_from( "=f", binheader, offset=offset )[0] )
-
-            offset += 4
-            self.ParamEnd.append( struct.unpack_from( "=f", binheader, offset=offset )[0] )
-            
-        offset += 4
-        self.RepeatMode = struct.unpack_from( "=l", binheader, offset=offset )[0]
-        if verbose: 
-            print "Repeat Mode:", self.RepeatMode
-        
-        offset += 4
-        self.RepeatsPerCurve = struct.unpack_from( "=l", binheader, offset=offset )[0]
-        if verbose: 
-            print "Repeat / Curve:", self.RepeatsPerCurve
-        
-        offset += 4
-        self.RepeatTime = struct.unpack_from( "=l", binheader, offset=offset )[0]
-        if verbose: 
-            print "Repeat Time:", self.RepeatTime
-        
-        offset += 4
-        self.RepeatWaitTime = struct.unpack_from( "=l", binheader, offset=offset )[0]
-        if verbose: 
-            print "Repeat Wait Time:", self.RepeatWaitTime
-        
-        offset += 4
-        self.ScriptName = struct.unpack_from( "=l", binheader, offset=offset )[0]
         if verbose: 
-            print "Script Name:", self.ScriptName
+            for name in PHD_BINARY_HEADER.names:
+                print "%s:" % name, self.binaryheader[name]
     
     
-
-
-
     def readboardheader( self, verbose=False ):
         """ read this after the ascii header and the binary header. """
 
@@ -887,126 +1516,15 @@ class Trace():
         #
         ##################################################################################
 
-        boardheader = self.fobj.read( 156 )
-        # I don't actually do anything with this at this point. Just get it out of the way...
-
-
-        """
-        for i = 1:NumberOfBoards
-        fprintf(1,'-------------------------------------\n') 
-        fprintf(1,'            Board No: #d\n', i-1)
-
-        HardwareIdent(:,i) = char(fread(fid, 16, 'char'))
-        fprintf(1,' Hardware Identifier: #s\n', HardwareIdent(:,i))
-
-        HardwareVersion(:,i) = char(fread(fid, 8, 'char'))
-        fprintf(1,'    Hardware Version: #s\n', HardwareVersion(:,i))    
-            
-        HardwareSerial(i) = fread(fid, 1, 'int32')
-        fprintf(1,'    HW Serial Number: #d\n', HardwareSerial(i))
-
-        SyncDivider(i) = fread(fid, 1, 'int32')
-        fprintf(1,'        Sync divider: #d \n', SyncDivider(i))
-         
-        CFDZeroCross0(i) = fread(fid, 1, 'int32')
-        fprintf(1,'     CFD 0 ZeroCross: #3i mV\n', CFDZeroCross0(i))
-
-        CFDLevel0(i) = fread(fid, 1, 'int32')
-        fprintf(1,'     CFD 0 Discr.   : #3i mV\n', CFDLevel0(i))
-
-        CFDZeroCross1(i) = fread(fid, 1, 'int32')
-        fprintf(1,'     CFD 1 ZeroCross: #3i mV\n', CFDZeroCross1(i))
-
-        CFDLevel1(i) = fread(fid, 1, 'int32')
-        fprintf(1,'     CFD 1 Discr.   : #3i mV\n', CFDLevel1(i))
-
-        Resolution(i) = fread(fid, 1, 'float')
-        fprintf(1,'          Resolution: #2.6g ns\n', Resolution(i))
-
-        # below is new in format version 2.0
-
-        RouterModelCode(i)      = fread(fid, 1, 'int32')
-        RouterEnabled(i)        = fread(fid, 1, 'int32')
-
-        # Router Ch1
-        RtChan1_InputType(i)    = fread(fid, 1, 'int32')
-        RtChan1_InputLevel(i)   = fread(fid, 1, 'int32')
-        RtChan1_InputEdge(i)    = fread(fid, 1, 'int32')
-        RtChan1_CFDPresent(i)   = fread(fid, 1, 'int32')
-        RtChan1_CFDLevel(i)     = fread(fid, 1, 'int32')
-        RtChan1_CFDZeroCross(i) = fread(fid, 1, 'int32')
-        # Router Ch2
-        RtChan2_InputType(i)    = fread(fid, 1, 'int32')
-        RtChan2_InputLevel(i)   = fread(fid, 1, 'int32')
-        RtChan2_InputEdge(i)    = fread(fid, 1, 'int32')
-        RtChan2_CFDPresent(i)   = fread(fid, 1, 'int32')
-        RtChan2_CFDLevel(i)     = fread(fid, 1, 'int32')
-        RtChan2_CFDZeroCross(i) = fread(fid, 1, 'int32')
-        # Router Ch3
-        RtChan3_InputType(i)    = fread(fid, 1, 'int32')
-        RtChan3_InputLevel(i)   = fread(fid, 1, 'int32')
-        RtChan3_InputEdge(i)    = fread(fid, 1, 'int32')
-        RtChan3_CFDPresent(i)   = fread(fid, 1, 'int32')
-        RtChan3_CFDLevel(i)     = fread(fid, 1, 'int32')
-        RtChan3_CFDZeroCross(i) = fread(fid, 1, 'int32')
-        # Router Ch4
-        RtChan4_InputType(i)    = fread(fid, 1, 'int32')
-        RtChan4_InputLevel(i)   = fread(fid, 1, 'int32')
-        RtChan4_InputEdge(i)    = fread(fid, 1, 'int32')
-        RtChan4_CFDPresent(i)   = fread(fid, 1, 'int32')
-        RtChan4_CFDLevel(i)     = fread(fid, 1, 'int32')
-        RtChan4_CFDZeroCross(i) = fread(fid, 1, 'int32')
-
-        # Router settings are meaningful only for an existing router:
-
-        if RouterModelCode(i)>0
-
-
-            fprintf(1,'-------------------------------------\n') 
-            fprintf(1,'   Router Model Code: #d \n', RouterModelCode(i))
-            fprintf(1,'      Router Enabled: #d \n', RouterEnabled(i))
-            fprintf(1,'-------------------------------------\n') 
-            
-            # Router Ch1 
-            fprintf(1,'RtChan1 InputType   : #d \n', RtChan1_InputType(i))
-            fprintf(1,'RtChan1 InputLevel  : #4i mV\n', RtChan1_InputLevel(i))
-            fprintf(1,'RtChan1 InputEdge   : #d \n', RtChan1_InputEdge(i))
-            fprintf(1,'RtChan1 CFDPresent  : #d \n', RtChan1_CFDPresent(i))
-            fprintf(1,'RtChan1 CFDLevel    : #4i mV\n', RtChan1_CFDLevel(i))
-            fprintf(1,'RtChan1 CFDZeroCross: #4i mV\n', RtChan1_CFDZeroCross(i))
-            fprintf(1,'-------------------------------------\n') 
-
-            # Router Ch2
-            fprintf(1,'RtChan2 InputType   : #d \n', RtChan2_InputType(i))
-            fprintf(1,'RtChan2 InputLevel  : #4i mV\n', RtChan2_InputLevel(i))
-            fprintf(1,'RtChan2 InputEdge   : #d \n', RtChan2_InputEdge(i))
-            fprintf(1,'RtChan2 CFDPresent  : #d \n', RtChan2_CFDPresent(i))
-            fprintf(1,'RtChan2 CFDLevel    : #4i mV\n', RtChan2_CFDLevel(i))
-            fprintf(1,'RtChan2 CFDZeroCross: #4i mV\n', RtChan2_CFDZeroCross(i))
-            fprintf(1,'-------------------------------------\n') 
-
-            # Router Ch3
-            fprintf(1,'RtChan3 InputType   : #d \n', RtChan3_InputType(i))
-            fprintf(1,'RtChan3 InputLevel  : #4i mV\n', RtChan3_InputLevel(i))
-            fprintf(1,'RtChan3 InputEdge   : #d \n', RtChan3_InputEdge(i))
-            fprintf(1,'RtChan3 CFDPresent  : #d \n', RtChan3_CFDPresent(i))
-            fprintf(1,'RtChan3 CFDLevel    : #4i mV\n', RtChan3_CFDLevel(i))
-            fprintf(1,'RtChan3 CFDZeroCross: #4i mV\n', RtChan3_CFDZeroCross(i))
-            fprintf(1,'-------------------------------------\n') 
-
-            # Router Ch4
-            fprintf(1,'RtChan4 InputType   : #d \n', RtChan4_InputType(i))
-            fprintf(1,'RtChan4 InputLevel  : #4i mV\n', RtChan4_InputLevel(i))
-            fprintf(1,'RtChan4 InputEdge   : #d \n', RtChan4_InputEdge(i))
-            fprintf(1,'RtChan4 CFDPresent  : #d \n', RtChan4_CFDPresent(i))
-            fprintf(1,'RtChan4 CFDLevel    : #4i mV\n', RtChan4_CFDLevel(i))
-            fprintf(1,'RtChan4 CFDZeroCross: #4i mV\n', RtChan4_CFDZeroCross(i))
-            fprintf(1,'-------------------------------------\n') 
-         
-        end
-        end
-    """
+        boardheaders = np.frombuffer( self.fobj.read( self.NumberOfBoards*PHD_BOARD_HEADER.itemsize ),
+                                         dtype=PHD_BOARD_HEADER, count=self.NumberOfBoards )
+        self.boardheaders = [ _record_to_dict( board ) for board in boardheaders ]
 
+        if verbose:
+            for i, board in enumerate( self.boardheaders ):
+                print "Board No:", i
+                for name in PHD_BOARD_HEADER.names:
+                    print "  %s:" % name, board[name]
 
 
     def readcurveheaders( self, verbose=False ):
@@ -1018,196 +1536,22 @@ class Trace():
         #
         ##################################################################################
 
-        MAXCURVES = 512
-        binheader = self.fobj.read( 150*MAXCURVES )
-
-        offset = 0
-        self.curveheaders = []
+        #  The PicoHarp software saves the time of recording
+        #  in a 32 bit serial time value as defined in all C libraries.
+        #  This equals the number of seconds elapsed since midnight
+        #  (00:00:00), January 1, 1970, coordinated universal time.
+        #  (i.e. time.gmtime( ch['TimeOfRecording'] ) gives the date)
+        curveheaders = np.frombuffer( self.fobj.read( self.NumberOfCurves*PHD_CURVE_HEADER.itemsize ),
+                                         dtype=PHD_CURVE_HEADER, count=self.NumberOfCurves )
+        self.curveheaders = [ _record_to_dict( curve ) for curve in curveheaders ]
 
-        for i in range( self.NumberOfCurves ):
-            ch = dict()
-            
-            ch['CurveIndex'] = struct.unpack_from( "=l", binheader, offset=offset )[0]
-            if verbose:
-                print "Curve index:", ch['CurveIndex']
-            offset += 4
-                    
-            ch['TimeOfRecording'] = struct.unpack_from( "=l", binheader, offset=offset )[0] # supposed to be unsigned long...
-            if verbose: 
-                print "Repeat Wait Time:", ch['TimeOfRecording']
-            #  The PicoHarp software saves the time of recording
-            #  in a 32 bit serial time value as defined in all C libraries.
-            #  This equals the number of seconds elapsed since midnight
-            #  (00:00:00), January 1, 1970, coordinated universal time.
-            #  The conversion to normal date and time strings is tricky...
-            #  In matlab: (but we need it to be a uint32, which it's not, so I won't implement the conversion here)
-            #  TimeOfRecording(i) = TimeOfRecording(i)/24/60/60+25569+693960
-            #  fprintf(1,'  Time of Recording: #s \n', datestr(TimeOfRecording(i),'dd-mmm-yyyy HH:MM:SS'))
-            offset += 4
-
-            ch['HardwareIdent'] = struct.unpack_from( "=16s", binheader, offset=offset )[0]
-            if verbose: 
-                print "Repeat Wait Time:", ch['HardwareIdent']
-            offset += 16
-        
-            ch['HardwareVersion'] = struct.unpack_from( "=8s", binheader, offset=offset )[0]
-            if verbose: 
-                print "Hardware Version:", ch['HardwareVersion']
-            offset += 8
-        
-            ch['HardwareSerial'] = struct.unpack_from( "=l", binheader, offset=offset )[0]
-            if verbose: 
-                print "HW Serial Number:", ch['HardwareSerial']
-            offset += 4
-        
-            ch['SyncDivider'] = struct.unpack_from( "=l", binheader, offset=offset )[0]
-            if verbose: 
-                print "Sync divider:", ch['SyncDivider']
-            offset += 4
-        
-            ch['CFDZeroCross0'] = struct.unpack_from( "=l", binheader, offset=offset )[0]
-            if verbose: 
-                print "CFD 0 ZeroCross (mV):", ch['CFDZeroCross0']
-            offset += 4
-        
-            ch['CFDLevel0'] = struct.unpack_from( "=l", binheader, offset=offset )[0]
-            if verbose: 
-                print "CFD 0 Discr. (mV):", ch['CFDLevel0']
-            offset += 4
-        
-            ch['CFDZeroCross1'] = struct.unpack_from( "=l", binheader, offset=offset )[0]
-            if verbose: 
-                print "CFD 1 ZeroCross (mV):", ch['CFDZeroCross1']
-            offset += 4
-        
-            ch['CFDLevel1'] = struct.unpack_from( "=l", binheader, offset=offset )[0]
-            if verbose: 
-                print "CFD 1 Discr. (mV):", ch['CFDLevel1']
-            offset += 4
-        
-            ch['Offset'] = struct.unpack_from( "=l", binheader, offset=offset )[0]
-            if verbose: 
-                print "Offset:", ch['Offset']
-            offset += 4
-        
-            ch['RoutingChannel'] = struct.unpack_from( "=l", binheader, offset=offset )[0]
-            if verbose: 
-                print "Routing Channel:", ch['RoutingChannel']
-            offset += 4
-        
-            ch['ExtDevices'] = struct.unpack_from( "=l", binheader, offset=offset )[0]
-            if verbose: 
-                print "External Devices:", ch['ExtDevices']
-            offset += 4
-        
-            ch['MeasMode'] = struct.unpack_from( "=l", binheader, offset=offset )[0]
-            if verbose: 
-                print "Measure mode:", ch['MeasMode']
-            offset += 4
-        
-            ch['SubMode'] = struct.unpack_from( "=l", binheader, offset=offset )[0]
-            if verbose: 
-                print "Sub-Mode:", ch['SubMode']
-            offset += 4
-        
-            ch['P1'] = struct.unpack_from( "=f", binheader, offset=offset )[0]
-            if verbose: 
-                print "P1:", ch['P1']
-            offset += 4
-        
-            ch['P2'] = struct.unpack_from( "=f", binheader, offset=offset )[0]
-            if verbose: 
-                print "P2:", ch['P2']
-            offset += 4
-        
-            ch['P3'] = struct.unpack_from( "=f", binheader, offset=offset )[0]
-            if verbose: 
-                print "P3:", ch['P3']
-            offset += 4
-        
-            ch['RangeNo'] = struct.unpack_from( "=l", binheader, offset=offset )[0]
-            if verbose: 
-                print "Range No.:", ch['RangeNo']
-            offset += 4
-        
-            ch['Resolution'] = struct.unpack_from( "=f", binheader, offset=offset )[0]
-            if verbose: 
-                print "Resolution (ns):", ch['Resolution']
-            offset += 4
-        
-            ch['Channels'] = struct.unpack_from( "=l", binheader, offset=offset )[0]
-            if verbose: 
-                print "Channels:", ch['Channels']
-            offset += 4
-        
-            ch['Tacq'] = struct.unpack_from( "=l", binheader, offset=offset )[0]
-            if verbose: 
-                print "Acquisition Time (ms):", ch['Tacq']
-            offset += 4
-        
-            ch['StopAfter'] = struct.unpack_from( "=l", binheader, offset=offset )[0] 
-            if verbose: 
-                print "Stop After (ms):", ch['StopAfter']
-            offset += 4
-        
-            ch['StopReason'] = struct.unpack_from( "=l", binheader, offset=offset )[0] 
-            if verbose: 
-                print "Stop Reason (ms):", ch['StopReason']
-            offset += 4
-        
-            ch['InpRate0'] = struct.unpack_from( "=l", binheader, offset=offset )[0] 
-            if verbose: 
-                print "Input Rate 0 (Hz):", ch['InpRate0']
-            offset += 4
-        
-            ch['InpRate1'] = struct.unpack_from( "=l", binheader, offset=offset )[0] 
-            if verbose: 
-                print "Input Rate 1 (Hz):", ch['InpRate1']
-            offset += 4
-        
-            ch['HistCountRate'] = struct.unpack_from( "=l", binheader, offset=offset )[0] 
-            if verbose: 
-                print "Hist. Count Rate (cps):", ch['HistCountRate']
-            offset += 4
-        
-            ch['IntegralCount'] = struct.unpack_from( "=2l", binheader, offset=offset )[0] 
-            if verbose: 
-                print "Integral Count:", ch['IntegralCount']
-            offset += 8
-        
-            ch['Reserved'] = struct.unpack_from( "=l", binheader, offset=offset )[0]
-            if verbose: 
-                print "Reserved:", ch['Reserved']
-            offset += 4
-        
-            ch['DataOffset'] = struct.unpack_from( "=l", binheader, offset=offset )[0]
-            if verbose: 
-                print "Data Offset relative to the start of the file:", ch['DataOffset']
-            offset += 4
-        
-            # below is new in format version 2.0
-
-            ch['RouterModelCode'] = struct.unpack_from( "=l", binheader, offset=offset )[0]
-            offset += 4
-            ch['RouterEnabled'] = struct.unpack_from( "=l", binheader, offset=offset )[0]
-            offset += 4
-            ch['RtChan_InputType'] = struct.unpack_from( "=l", binheader, offset=offset )[0]
-            offset += 4
-            ch['RtChan_InputLevel'] = struct.unpack_from( "=l", binheader, offset=offset )[0]
-            offset += 4
-            ch['RtChan_InputEdge'] = struct.unpack_from( "=l", binheader, offset=offset )[0]
-            offset += 4
-            ch['RtChan_CFDPresent'] = struct.unpack_from( "=l", binheader, offset=offset )[0]
-            offset += 4
-            ch['RtChan_CFDLevel'] = struct.unpack_from( "=l", binheader, offset=offset )[0]
-            offset += 4
-            ch['RtChan_CFDZeroCross'] = struct.unpack_from( "=l", binheader, offset=offset )[0]
-            offset += 4
-        
-            self.curveheaders.append( ch )
+        if verbose:
+            for ch in self.curveheaders:
+                for name in PHD_CURVE_HEADER.names:
+                    print "%s:" % name, ch[name]
             
 
-    def readhistograms( self ):
+    def readhistograms( self, memmap=False ):
 
         ##################################################################################
         #
@@ -1215,14 +1559,16 @@ class Trace():
         #
         ##################################################################################
 
-        self.fobj.seek(0) # go back to beginning because 'DataOffset' is measured from there.
-        binarydata = self.fobj.read()
-        
+        # Only the bins we keep are read, straight from 'DataOffset' (measured from the
+        # beginning of the file). With memmap=True each curve is a read-only view
+        # (np.frombuffer) of the bytes read instead, so nothing is converted or copied
+        # until a method modifies the data (see self._writable_curve). A real np.memmap
+        # would hold a file descriptor per curve for as long as the Trace lives.
         self.curves = []
         
         for i,curve in enumerate( self.curveheaders ):
             
-            # This will typically be waaay too long and will be padded with zeros because it
+            # The stored histogram will typically be waaay too long and padded with zeros because it
             # can accomodate up to 2**16 histogram bins but our laser rep rate is ~76MHz, so
             # if you were set at 4ps resolution, that would only require 1/76MHz/4ps ~ 3281 bins
             #
@@ -1235,24 +1581,40 @@ class Trace():
             # the peak in lifetime occurrs at the very end of the un-wrapped curve. Then you should
             # insert enough BNC cable to bring the peak back toward the front of the un-wrapped curve.
 
-            zeropadded = pylab.np.array(
-                struct.unpack_from( "="+str(curve['Channels'])+"l", binarydata, offset=curve['DataOffset'] ),
-                dtype=pylab.np.int
-                         )
             nbins = 1.0/self.curveheaders[0]['InpRate0']/self.curveheaders[0]['Resolution']/1.0e-9
-            nfullbins = pylab.floor( nbins )
+            nfullbins = min( int( pylab.floor( nbins ) ), curve['Channels'] )
             npartialbins = pylab.mod( nbins, 1 )
             if npartialbins > 0.0:
                 # I think in this case (which is almost always the case), the first bin is sometimes
                 # the 'partial' bin, and the last bin is sometimes the 'partial' bin. So we'll delete them.
-                # (or uncomment other line to add them.)
-                ###zeropadded[0] += zeropadded[ nfullbins ] # add the partial bin to the first bin
-                self.curves.append( zeropadded[1:nfullbins] ) 
+                first = 1
+            else:
+                first = 0
+            offset = curve['DataOffset'] + first*PHD_HISTOGRAM_BIN.itemsize
+
+            self.fobj.seek( offset )
+            if memmap:
+                self.curves.append( np.frombuffer( self.fobj.read( (nfullbins-first)*PHD_HISTOGRAM_BIN.itemsize ),
+                                                   dtype=PHD_HISTOGRAM_BIN ) )
             else:
-                self.curves.append( zeropadded[:nfullbins] ) 
+                self.curves.append( np.fromfile( self.fobj, dtype=PHD_HISTOGRAM_BIN,
+                                                    count=nfullbins-first ).astype(np.int) )
         
         self.raw_curves = self.curves[:]
 
+    def _writable_curve( self, i ):
+        """ curves loaded with memmap=True are read-only views of the file.
+            Swap curve i for a float copy before modifying it in place, in
+            raw_curves too if it is the same array there (as it is after
+            loading), so both modes change the same curves.
+        """
+        if not self.curves[i].flags.writeable:
+            curve = np.array( self.curves[i], dtype=np.float )
+            if self.raw_curves[i] is self.curves[i]:
+                self.raw_curves[i] = curve
+            self.curves[i] = curve
+        return self.curves[i]
+
     def set_axes( self, axes ):
         """ this allows you to plot the data to a particular axes
         """
@@ -1262,8 +1624,9 @@ class Trace():
         """ blank curve[0] of a trace except within the given window.
             Useful for removing background and reflections from IRF.
         """
-        self.curves[0][pylab.find(self.t[0]<tstart)] = 0.0
-        self.curves[0][pylab.find(self.t[0]>tend)] = 0.0
+        curve = self._writable_curve(0)
+        curve[pylab.find(self.t[0]<tstart)] = 0.0
+        curve[pylab.find(self.t[0]>tend)] = 0.0
 
     def set_irf( self, irf=None, wraptime=None, dispersion=None ):
         """
@@ -1275,43 +1638,26 @@ class Trace():
         the mult-exponential model before fitting (thereby taking this
         convolution into account without doing nearly-impossible
         numerical deconvolution).
+
+        dispersion (ps) blurs the IRF with a gaussian of that standard deviation.
+        IRFs loaded from a file are prepared once per (file, wraptime,
+        dispersion) and shared by all traces, see registered_irf.
         """
-        if isinstance( irf, Trace ):
-            self.irf = irf
-        elif type(irf) == str:
-            self.irf = Trace( irf )
-            if wraptime is not None:
-                self.irf.wrapcurves( wraptime )
-            elif self.wraptime is not None:
-                self.irf.wrapcurves( self.wraptime )
-        
+        if wraptime is None: wraptime = self.wraptime
         self.irf_dispersion = dispersion
-        if dispersion is not None and dispersion != 0:
-            # this is meant to address chromatic dispersion within the setup
-            # (e.g. optical fiber)
-            # don't bother with normalization b/c it gets normalized to unit area below anyway.
-            #original = self.irf.curves[0].copy()
-            #self.irf.curves[0][dispersion:] += original[:-dispersion]
-            #self.irf.curves[0][:-dispersion] += original[dispersion:]
-            len1 = len(self.irf.curves[0])
-            chain_of_three = pylab.zeros( 3*len1 ) # stack three curves end-to-end so cspline1d_eval doesn't have to extrapolate beyond data
-            chain_of_three[:len1] = self.irf.curves[0][:]
-            chain_of_three[len1:2*len1] = self.irf.curves[0][:]
-            chain_of_three[-len1:] = self.irf.curves[0][:]
-            g = cspline1d(chain_of_three)
-            smoothed = pylab.zeros( len1 )
-            std_dev = dispersion/1000.0
-            for t0 in pylab.linspace(-2*std_dev, 2*std_dev, 50):
-                weight = pylab.exp( -t0**2/2.0/std_dev**2 )
-                smoothed += weight * cspline1d_eval( g, self.irf.t[0]-t0, dx=self.irf.t[0][1], x0=-self.irf.t[0][-1] )
-            self.irf.curves[0] = smoothed
-            
-        normalized = self.irf.curves[0].astype(np.float)/float(sum(self.irf.curves[0])) # normalize integral to 1, just like delta-function!!!
-        self.irf.curves[0] = normalized.copy()
-
-        self.irf_generator = cspline1d(self.irf.curves[0])
-        self.irf_dt = self.irf.t[0][1]-self.irf.t[0][0]
-        self.irf_t0 = self.irf.t[0][0]
+        if type(irf) == str:
+            entry = registered_irf( irf, wraptime, dispersion )
+            # a Trace of its own (wrapcurves of this trace re-wraps it), sharing the arrays
+            self.irf = copy.copy( entry['irf'] )
+            self.irf.curves = entry['irf'].curves[:]
+            self.irf.t = entry['irf'].t[:]
+        else:
+            if isinstance( irf, Trace ): self.irf = irf
+            entry = _prepare_irf( self.irf, dispersion )
+        self.irf_generator = entry['generator']
+        self.irf_dt = entry['dt']
+        self.irf_t0 = entry['t0']
+        self.irf_spectra = entry['spectra']
         
         if False:
             """not sure this matters if we do interpolation
@@ -1397,6 +1743,164 @@ class Trace():
 
             
 
+def _pool_map( worker, tasks, processes=None ):
+    """ map(worker, tasks) over a pool of `processes` worker processes (by
+        default one per cpu), or in this process for processes=1 or fewer
+        than two tasks. worker must be a module-level function. """
+    if processes == 1 or len( tasks ) < 2:
+        return map( worker, tasks )
+    pool = multiprocessing.Pool( processes )
+    try:
+        return pool.map( worker, tasks )
+    finally:
+        pool.close()
+        pool.join()
+
+def _fit_start( task ):
+    """ worker for Trace.fit_exponential( starts=... ): one fit from one initial guess.
+        Returns the fit's attributes (see FIT_ATTRIBUTES), or None if it failed. """
+    trace, kwargs = task
+    try:
+        trace.fit_exponential( verbose=False, memoize=False, **kwargs )
+    except (RuntimeError, np.linalg.LinAlgError):
+        return None
+    return dict( (key, trace.__dict__[key]) for key in FIT_ATTRIBUTES if trace.__dict__.has_key( key ) )
+
+def _load_curve( phdfile ):
+    """ worker for TraceCollection: load curve 0 of one file in a separate process """
+    trace = Trace( phdfile )
+    header = dict( trace.curveheaders[0] )
+    header.update( Tacq=trace.Tacq, Comment=trace.Comment )
+    return np.asarray( trace.curves[0] ), header
+
+class TraceCollection():
+    """ Many traces (curve 0 of each of the .phd files `phdfiles`) held as one
+        (files x bins) array, self.curves, with one shared time axis, self.t.
+        The files are loaded by a pool of `processes` worker processes (by default
+        one per cpu; processes=1 loads them in this process) and
+        wrapcurves, normalize_curves, counts_per_second, get_max and zero_except
+        work on all rows at once, so batch preprocessing doesn't go
+        through hundreds of Trace objects.
+
+        All files must share the same resolution; curves of different lengths
+        are cut to the shortest one. Use self[i] to get row i as a Trace
+        (e.g. to fit it).
+
+        usage:
+            traces = TraceCollection( glob.glob( 'wire*.phd' ) )
+            traces.wrapcurves( 1.17 )
+            traces.counts_per_second()
+            t_max, cts_max = traces.get_max()
+    """
+    def __init__( self, phdfiles, processes=None ):
+        self.fnames = list( phdfiles )
+        loaded = _pool_map( _load_curve, self.fnames, processes )
+        curves = [ curve for curve, header in loaded ]
+        self.headers = [ header for curve, header in loaded ]
+        if len( curves ) == 0:
+            raise ValueError("TraceCollection needs at least one file")
+
+        resolutions = np.array([ header['Resolution'] for header in self.headers ])
+        if np.any( abs( resolutions - resolutions[0] ) > 1.0e-6 ):
+            raise ValueError("All traces in a TraceCollection must have the same resolution")
+        self.resolution = resolutions[0]
+        nbins = min( len(curve) for curve in curves )
+        self.curves = np.empty( (len(curves), nbins), dtype=np.float )
+        for i, curve in enumerate( curves ):
+            self.curves[i] = curve[:nbins]
+        self.raw_curves = self.curves.copy()
+        self.raw_t = np.arange( nbins )*self.resolution # ns
+        self.t = self.raw_t.copy()
+        self.Tacq = np.array([ header['Tacq'] for header in self.headers ], dtype=np.float) # ms
+        self.wraptime = None
+        self.in_counts_per_second = False
+
+    def __len__( self ):
+        return len( self.fnames )
+
+    def __getitem__( self, i ):
+        """ row i as a Trace, with the preprocessing done so far """
+        header = self.headers[i]
+        trace = Trace.from_histogram( self.curves[i].copy(), self.resolution, header['InpRate0'],
+                                      header['Tacq'], fname=self.fnames[i] )
+        trace.raw_curves = [ self.raw_curves[i].copy() ]
+        trace.raw_t = [ self.raw_t.copy() ]
+        trace.t = [ self.t.copy() ]
+        trace.Comment = header['Comment']
+        trace.wraptime = self.wraptime
+        trace.in_counts_per_second = self.in_counts_per_second
+        return trace
+
+    def traces( self ):
+        """ iterate over all rows as Traces """
+        for i in range( len(self) ):
+            yield self[i]
+
+    def wrapcurves( self, time, delete_firstpoints=0, delete_lastpoints=0, use_raw=False ):
+        """ Trace.wrapcurves for every row at once; see there for the arguments. """
+        self.wraptime = time
+        curves = self.raw_curves if use_raw else self.curves
+        threshold = np.sum( self.raw_t[:curves.shape[1]] < time ) - 1
+        if threshold < 0:
+            self.curves = curves.copy()
+            self.t = self.raw_t.copy()
+            return True
+        wrapped = np.roll( curves, -threshold, axis=1 )
+        if delete_firstpoints > 0 or delete_lastpoints > 0:
+            nbins = wrapped.shape[1]
+            keep = np.r_[ 0:nbins-threshold-delete_lastpoints, nbins-threshold+delete_firstpoints:nbins ]
+            wrapped = wrapped[:, keep]
+            self.t = self.raw_t[keep]
+        self.curves = wrapped
+
+    def counts_per_second( self ):
+        """ divide each row by its acquisition time (self.Tacq is in ms) """
+        self.curves = self.curves/(self.Tacq[:,None]/1000.0)
+        self.in_counts_per_second = True
+
+    def get_max( self ):
+        """ arrays of the time and height of the maximum of every row:
+            t_max,cts_max = self.get_max()
+        """
+        imax = self.curves.argmax( axis=1 )
+        return self.t[imax], self.curves[ np.arange(len(imax)), imax ]
+
+    def normalize( self, value=None ):
+        # just a wrapper around normalize_curves
+        self.normalize_curves( value=value )
+
+    def normalize_curves( self, value=None ):
+        """ Normalize every row to its maximum (default), or
+            divide all rows by some arbitrary value (if value != None).
+        """
+        if value is None:
+            self.curves = self.curves/self.curves.max( axis=1 )[:,None]
+        else:
+            self.curves = self.curves/np.float( value )
+
+    def phasor( self, harmonic=1, irf=None, background=None ):
+        """ Trace.phasor for every row at once: a dict of arrays 'g', 's',
+            'tau_phase' and 'tau_mod' (ns). irf is an IRF Trace (or file name,
+            which is then loaded and wrapped like the rows) used for calibration.
+        """
+        tpulse = 1.0e9/self.headers[0]['InpRate0']
+        if isinstance( irf, str ):
+            irf = Trace( irf )
+            if self.wraptime is not None: irf.wrapcurves( self.wraptime )
+        if irf is not None:
+            irf = irf.curves[0][:self.curves.shape[1]]
+        F = phasor( self.curves, self.t, tpulse, harmonic=harmonic, irf=irf, background=background )
+        tau_phase, tau_mod = phasor_lifetimes( F, tpulse, harmonic )
+        return dict( g=np.real(F), s=np.imag(F), tau_phase=tau_phase, tau_mod=tau_mod, harmonic=harmonic )
+
+    def zero_except( self, tstart=None, tend=None ):
+        """ blank every row except within the given window. """
+        if tstart is not None:
+            self.curves[:, self.t < tstart] = 0.0
+        if tend is not None:
+            self.curves[:, self.t > tend] = 0.0
+
+
 if __name__ == '__main__':
     # example usage:
     d = datafile( 'examplefile.phd' ) # doesn't actually exist in this directory...
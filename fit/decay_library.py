@@ -0,0 +1,154 @@
+# Library of precomputed model decays for instant approximate lifetime fits.
+#
+# For FLIM-like batches (tens of thousands of curves measured with the same
+# setup) a full fit_exponential per curve is slow, and most of the time goes
+# into getting near the optimum. DecayLibrary convolves multi-exponential
+# decays over a grid of lifetimes, amplitude fractions and tshift with the IRF
+# of one set_irf configuration, once. Every decay is normalized to unit area
+# and square-rooted, so that euclidean distances approximate the Poisson
+# chi-square between shapes. An SVD compresses them to a few coordinates, and
+# a cKDTree indexes those. lookup() then finds the nearest library decay for
+# every curve at once; its parameters are a screening result, or a warm start
+# for fit_exponential.
+#
+# example usage:
+#   trace = pq.Trace( 'pixel0.phd' )
+#   trace.wrapcurves( 10.0 )
+#   trace.set_irf( irffile, wraptime=10.0, dispersion=20 )
+#   library = DecayLibrary( trace, num_exp=2 )
+#   collection = pq.TraceCollection( glob.glob( 'pixel*.phd' ) )
+#   collection.wrapcurves( 10.0 )
+#   params = library.lookup( collection.curves )  # arrays: params['l0'][i] is l0 of file i
+#   trace.fit_exponential( guess=library.guess( trace ), deconvolve=True )
+
+import itertools
+import numpy as np
+from scipy.spatial import cKDTree
+from scipy.signal import cspline1d_eval
+import PicoQuantUtils_FastFit as pq
+
+CHUNKSIZE = 4096 # library decays computed at once while building the index
+
+
+def leading_components( X, ncomponents, oversampling=10, iterations=2, seed=0 ):
+    """ the ncomponents leading right singular vectors of X (as columns) by a
+        randomized SVD (Halko, Martinsson & Tropp 2011): only products of X
+        with thin matrices, instead of a full SVD of X """
+    Y = X.dot( np.random.RandomState( seed ).randn( X.shape[1], min( ncomponents+oversampling, min( X.shape ) ) ) )
+    Q = np.linalg.qr( Y )[0]
+    for i in range( iterations ): # power iterations sharpen the spectrum
+        Q = np.linalg.qr( X.dot( X.T.dot( Q ) ) )[0]
+    u, s, vt = np.linalg.svd( Q.T.dot( X ), full_matrices=False )
+    return vt[:ncomponents].T
+
+
+class DecayLibrary():
+    """ IRF-convolved decays of num_exp exponentials (the model of
+        fit_exponential( deconvolve=True )) on the time axis of `trace`,
+        which must have its IRF set, for
+            every combination of num_exp different lifetimes out of `lifetimes`
+                (default: 16 spaced logarithmically from two bins to the laser period),
+            every split of the amplitude into fractions that are multiples
+                of 1/fraction_steps (none of them zero), and
+            every tshift in `tshifts` (default: -6 to 6 bins in steps of 2).
+        The index keeps `ncomponents` SVD coordinates of each decay, with
+        the SVD computed from a random sample of `nsample` of them.
+    """
+    def __init__( self, trace, num_exp=2, lifetimes=None, fraction_steps=8, tshifts=None,
+                  ncomponents=20, nsample=4000, curve_num=0, seed=0 ):
+        if trace.irf is None: raise AttributeError("No detector trace for %s!!! Use set_irf() first." % trace.fname)
+        self.t = np.array( trace.t[curve_num], dtype=np.float )
+        dt = self.t[1]-self.t[0]
+        self.tpulse = 1.0e9/trace.curveheaders[0]['InpRate0'] # avg. time between pulses, in ns
+        if lifetimes is None:
+            lifetimes = np.logspace( np.log10( 2*dt ), np.log10( self.tpulse ), 16 )
+        if tshifts is None:
+            tshifts = np.arange( -6, 7, 2 )*dt
+        self.lifetimes = np.asarray( lifetimes, dtype=np.float )
+        self.tshifts = np.asarray( tshifts, dtype=np.float )
+        self.num_exp = num_exp
+
+        # unit-amplitude decays convolved with the IRF, one (bins x lifetimes) matrix per tshift
+        decays = np.fft.rfft( pq.lifetime_basis( self.t, self.lifetimes, self.tpulse ), axis=0 )
+        self.convolved = []
+        for tshift in self.tshifts:
+            irf = cspline1d_eval( trace.irf_generator, self.t-tshift, dx=trace.irf_dt, x0=trace.irf_t0 )
+            self.convolved.append( np.fft.irfft( decays*np.fft.rfft( irf )[:,None], len(self.t), axis=0 ) )
+
+        # the library entries: lifetime combination x amplitude fractions x tshift
+        combos = np.array( list( itertools.combinations( range( len(self.lifetimes) ), num_exp ) ) )
+        fractions = np.array([ np.diff( (0,) + cuts + (fraction_steps,) )
+                               for cuts in itertools.combinations( range( 1, fraction_steps ), num_exp-1 ) ],
+                             dtype=np.float )/fraction_steps
+        if len( combos ) == 0 or len( fractions ) == 0:
+            raise ValueError("Need at least num_exp lifetimes and fraction_steps")
+        ishift, icombo, ifraction = [ i.ravel() for i in np.indices( (len(self.tshifts), len(combos), len(fractions)) ) ]
+        self.entry_tshift = ishift
+        self.entry_lifetimes = combos[icombo]    # indices into self.lifetimes, shortest first
+        self.entry_fractions = fractions[ifraction]
+        nentries = len( ishift )
+
+        # SVD of a sample of the (square-rooted, unit-area) decays, then the coordinates of all of them
+        sample = np.sort( np.random.RandomState( seed ).permutation( nentries )[:nsample] )
+        shapes, areas = self.shapes( sample )
+        self.mean = shapes.mean( axis=0 )
+        self.components = leading_components( shapes - self.mean, ncomponents, seed=seed )
+        self.coordinates = np.empty( (nentries, self.components.shape[1]) )
+        self.areas = np.empty( nentries )
+        for start in range( 0, nentries, CHUNKSIZE ):
+            entries = np.arange( start, min( start+CHUNKSIZE, nentries ) )
+            shapes, self.areas[entries] = self.shapes( entries )
+            self.coordinates[entries] = (shapes - self.mean).dot( self.components )
+        self.tree = cKDTree( self.coordinates )
+        # where the background is measured (see background): before the rise of the mean decay
+        ipeak = int( np.argmax( self.mean ) )
+        self.background_bins = slice( 0, ipeak//2 ) if ipeak >= 20 else slice( -max( len(self.t)//20, 1 ), None )
+
+    def __len__( self ):
+        return len( self.entry_tshift )
+
+    def shapes( self, entries ):
+        """ square roots of the unit-area decays of the library entries (rows) and their areas """
+        rows = np.empty( (len(entries), len(self.t)) )
+        tshift = self.entry_tshift[entries]
+        for s in np.unique( tshift ):
+            which = np.where( tshift == s )[0]
+            weights = np.zeros( (len(which), len(self.lifetimes)) )
+            weights[ np.arange( len(which) )[:,None], self.entry_lifetimes[entries[which]] ] = self.entry_fractions[entries[which]]
+            rows[which] = weights.dot( self.convolved[s].T )
+        areas = rows.sum( axis=1 )
+        return np.sqrt( np.clip( rows/areas[:,None], 0.0, None ) ), areas
+
+    def background( self, curves ):
+        """ background (counts per bin) of each row of curves: the median before the rise """
+        return np.median( np.atleast_2d( curves )[:, self.background_bins], axis=1 )
+
+    def lookup( self, curves, background=None ):
+        """ Nearest library decay of every curve (a 1D curve or one per row of a
+            2D array, e.g. TraceCollection.curves, on the library's time axis).
+            The background (a number, one per curve, or by default estimated,
+            see background) is subtracted first.
+            Returns a dict of arrays with one entry per curve: l0, a0, ... in
+            the units of fit_exponential( deconvolve=True ), b, tshift, and
+            'distance' to the library decay (4*counts*distance**2 is roughly the
+            chi-square of the data against it).
+        """
+        curves = np.atleast_2d( np.asarray( curves, dtype=np.float ) )
+        if curves.shape[1] != len( self.t ):
+            raise ValueError("Curves have %d bins, the library %d" % (curves.shape[1], len( self.t )))
+        b = self.background( curves ) if background is None else np.zeros( len(curves) ) + background
+        signal = np.clip( curves - b[:,None], 0.0, None )
+        counts = signal.sum( axis=1 )
+        shapes = np.sqrt( signal/np.maximum( counts, 1.0e-300 )[:,None] )
+        distance, nearest = self.tree.query( (shapes - self.mean).dot( self.components ) )
+        result = dict( b=b, tshift=self.tshifts[ self.entry_tshift[nearest] ], distance=distance )
+        scale = counts/self.areas[nearest]
+        for i in range( self.num_exp ):
+            result['l%d' % i] = self.lifetimes[ self.entry_lifetimes[nearest, i] ]
+            result['a%d' % i] = self.entry_fractions[nearest, i]*scale
+        return result
+
+    def guess( self, trace, curve_num=0 ):
+        """ lookup() of one curve of trace, as a guess dict for fit_exponential """
+        result = self.lookup( trace.curves[curve_num] )
+        return dict( (key, float( value[0] )) for key, value in result.iteritems() if key != 'distance' )
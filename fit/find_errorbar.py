@@ -4,8 +4,9 @@ import PicoQuantUtils_FastFit as pq
 import glob
 import sys
 import cPickle
+import multiprocessing
 from scipy.signal import cspline1d, cspline1d_eval
-from scipy.optimize import fmin
+from scipy.optimize import fmin, brentq
 
 infile=None
 
@@ -54,7 +55,111 @@ def do_fit( bestfittrace, l, a, fixed, dispersion, force_guess ):
 
 
 
-def get_errorbar( fv, fname=None, trace=None, frac=0.1, additional_fixed=None, plotresult=False, guess=dict() ):
+def _start_guess( params ):
+    """ fit_exponential guess (l0, a0, ..., b, tshift) from a fitresults-like dict, with do_fit's defaults """
+    guess = dict( b=params.get( 'b', 1.0 ), tshift=params.get( 'tshift', -0.5 ) )
+    i = 0
+    while params.has_key( 'l%d' % i ):
+        guess['l%d' % i] = params['l%d' % i]
+        guess['a%d' % i] = params['a%d' % i]
+        i += 1
+    return guess
+
+def _fit_chain( task ):
+    """ worker for FitSession.run_chains, see there """
+    session, fv, values, start, fixed, Fx, bestChi2, step = task
+    results = []
+    params = dict( start )
+    for i in xrange( sys.maxint ):
+        if i < len( values ):
+            val = values[i]
+        elif Fx is None or results and results[-1][1]['ReducedChi2']/bestChi2 >= Fx:
+            break
+        else:
+            val = (results[-1][0] if results else start[fv]) + step
+            if val < 0: break
+        params[ fv ] = val
+        fitresults = session.fit( params, fixed )
+        results.append( (val, fitresults) )
+        params = session.solution( params, fixed ) # warm start for the next value
+    return results
+
+class FitSession():
+    """ What do_fit rebuilds for every single fit -- the trace read from disk,
+        wrapped, in counts per second if the best fit was, and its IRF with
+        the dispersion smoothing, spline and weights -- prepared once from the
+        best-fit trace, so that an error-bar scan only pays for the fits.
+
+        run_chains() spreads independent chains of fits over a pool of
+        `processes` worker processes (by default one per cpu; processes=1 fits
+        in this process); within a chain every fit starts from the solution
+        of the previous one.
+    """
+    def __init__( self, bestfittrace, processes=None ):
+        trace = pq.Trace( bestfittrace.fname )
+        if bestfittrace.in_counts_per_second: trace.counts_per_second()
+        trace.wrapcurves( time=bestfittrace.wraptime )
+        trace.set_irf( bestfittrace.irf.fname, wraptime=bestfittrace.irf.wraptime, dispersion=bestfittrace.irf_dispersion )
+        self.trace = trace
+        self.tstart = trace.get_max()[0]+0.01
+        self.processes = processes
+        self.nfits = 0 # fits done in this process (not counting workers)
+
+    def fit( self, params, fixed, memoize=False ):
+        """ deconvolved fit (like do_fit) starting from the lifetimes, amplitudes,
+            b and tshift in params, holding the parameters in fixed at their
+            values in params. Returns the fitresults. Scan points are not
+            worth keeping, so the fit is only memoized with memoize=True. """
+        self.trace.fit_exponential( tstart=self.tstart, guess=_start_guess( params ),
+                                    deconvolve=True, verbose=False, fixed_params=fixed,
+                                    memoize=memoize )
+        self.nfits += 1
+        return self.trace.fitresults
+
+    def solution( self, params, fixed ):
+        """ params with the free values replaced by the solution of the last
+            fit (which started from params), to warm-start the next one. The
+            values are taken by position, not from the fitresults: those number
+            the lifetimes by size, so once a held lifetime crosses another one
+            their labels would swap. """
+        guess = _start_guess( params )
+        keys = pq.exponential_keys( len( [ key for key in guess if key[0] == 'l' ] ) ) + [ 'tshift' ]
+        solution = dict( params )
+        for key, value in zip( [ key for key in keys if key not in fixed ], self.trace.bestparams ):
+            solution[key] = abs( value ) if key[0] in 'la' else value
+        return solution
+
+    def run_chains( self, chains ):
+        """ Run chains of fits, each given as a tuple
+                (fv, values, start, fixed, Fx, bestChi2, step):
+            fit with fv (which should be in fixed) set to each of values in
+            turn, the first fit starting from the fitresults-like dict start and
+            every later one from the previous solution. With Fx not None, the
+            chain then keeps going in steps of step (negative: downward) until
+            ReducedChi2/bestChi2 reaches Fx or the value would become negative.
+            Returns one list of (value, fitresults) per chain.
+        """
+        return self.map( _fit_chain, [ (self,) + tuple( chain ) for chain in chains ] )
+
+    def map( self, worker, tasks ):
+        """ map(worker, tasks) over the pool of worker processes (in this
+            process for processes=1 or a single task) """
+        return pq._pool_map( worker, tasks, self.processes )
+
+    def profile( self, fv, values, start, fixed ):
+        """ fit at every value of fv in values (fv held fixed, along with the
+            rest of fixed), in two chains walking down and up from start[fv]
+            that run in parallel. Returns a list of (value, fitresults) sorted by value. """
+        below = sorted( [ val for val in values if val < start[fv] ], reverse=True )
+        above = sorted( [ val for val in values if val >= start[fv] ] )
+        chains = [ (fv, vals, start, fixed, None, None, None) for vals in [below, above] if vals ]
+        results = []
+        for chain in self.run_chains( chains ): results += chain
+        return sorted( results, key=lambda x: x[0] )
+
+
+def get_errorbar( fv, fname=None, trace=None, frac=0.1, additional_fixed=None, plotresult=False, guess=dict(),
+                  session=None, processes=None ):
     """ Use Lakowicz's f-statistic method to find the 95% confidence interval on a fitting parameter.
         fv -- a string/dictionary key identifying the parameter to find a confidence interval on.
         fname -- (optional, can use trace instead) fname of data file to fit.
@@ -62,7 +167,11 @@ def get_errorbar( fv, fname=None, trace=None, frac=0.1, additional_fixed=None, p
         frac -- the fractional change in the parameter to use for the intial 5-point mesh
         additional_fixed -- any parameters you want to hold fixed during the fitting
         plotresult -- plot the f-statistic curve?
-        guess -- dictionary of initial parameters for the fit (by default, best-fit values are used)
+        guess -- dictionary of initial parameters for the fit (by default, best-fit values are used);
+                 only the fits next to the best-fit value start from it, the others from their neighbour's solution
+        session -- a FitSession for trace to reuse (e.g. across parameters); by default one is made
+        processes -- number of worker processes of a new session
+        See adaptive_errorbar for a version that needs far fewer fits.
     """
     #bestfit, bestacorr = load_wire( fname )
     if fname is not None:
@@ -100,58 +209,39 @@ def get_errorbar( fv, fname=None, trace=None, frac=0.1, additional_fixed=None, p
     val_step = frac*fv_best/2
     argvals = arange( fv_best*(1.0-frac), fv_best*(1.0+frac)+val_step, val_step )
 
-    # do a coarse (5-pt) run across the data
-    for val in argvals:
-        bestfit[ fv ] = val
-        l = [ bestfit[key] for key in lkeys ]
-        a = [ bestfit[key] for key in akeys ]
-        params = do_fit( trace, l, a, fixedparams, irf, guess )
-        Fx_list.append( [val, params['ReducedChi2']/bestChi2] )
+    if session is None: session = FitSession( trace, processes=processes )
+    start = bestfit.copy()
+    for k, v in guess.iteritems():
+        if k not in fixedparams: start[k] = v
+
+    # do a coarse (5-pt) run across the data, warm-starting outward from the best fit
+    scan = session.profile( fv, argvals, start, fixedparams )
+    Fx_list = [ [val, params['ReducedChi2']/bestChi2] for val, params in scan ]
 
     if all(array(Fx_list)[:,1]>Fx):
-        Fx_list = []
-        for val in argvals:
-            bestfit[ fv ] = val
-            cpy = bestfit.copy()
-            for key in lkeys:
-                if key not in fixedparams: cpy[key] = 1.25*bestfit[key]
-            for key in akeys:
-                if key not in fixedparams: cpy[key] = 1.5*bestfit[key]
-            l = [ cpy[key] for key in lkeys ]
-            a = [ cpy[key] for key in akeys ]
-            params = do_fit( trace, l, a, fixedparams, irf, guess )
-            Fx_list.append( [val, params['ReducedChi2']/bestChi2] )
+        cpy = start.copy()
+        for key in lkeys:
+            if key not in fixedparams: cpy[key] = 1.25*bestfit[key]
+        for key in akeys:
+            if key not in fixedparams: cpy[key] = 1.5*bestfit[key]
+        scan = session.profile( fv, argvals, cpy, fixedparams )
+        Fx_list = [ [val, params['ReducedChi2']/bestChi2] for val, params in scan ]
 
     if all(array(Fx_list)[:,1]>Fx): raise ValueError("Problem fitting: always above Fx. Min: %f" % (array(Fx_list)[:,1].min()))
     
-
-    # if the left side (low param value) didn't exceed Fx threshold, extend
-    val = argvals[0]
-    while Fx_list[0][1] < Fx:
-        val -= val_step
-        if val < 0: 
-            if fv in ['l1', 'l2', 'l3']:
-                raise ValueError("long-time component just went negative...")
-            else:
-                break
-        bestfit[ fv ] = val
-        l = [ bestfit[key] for key in lkeys ]
-        a = [ bestfit[key] for key in akeys ]
-        params = do_fit( trace, l, a, fixedparams, irf, guess )
-        Fx_list.append( [val, params['ReducedChi2']/bestChi2] )
-        Fx_list.sort( key=lambda x: x[0] ) # sort by first element (parameter value)
-
-    # if the right side (high param value) didn't exceed Fx threshold, extend
-    val = argvals[-1]
-    while Fx_list[-1][1] < Fx:
-        val += val_step
-        bestfit[ fv ] = val
-        l = [ bestfit[key] for key in lkeys ]
-        a = [ bestfit[key] for key in akeys ]
-        params = do_fit( trace, l, a, fixedparams, irf, guess )
-        Fx_list.append( [val, params['ReducedChi2']/bestChi2] )
-        Fx_list.sort( key=lambda x: x[0] ) # sort by first element (parameter value)
-
+    # if either side didn't exceed the Fx threshold, extend it (both sides at once),
+    # starting from the solution at the outermost value
+    chains = []
+    if Fx_list[0][1] < Fx:
+        chains.append( (fv, [], scan[0][1], fixedparams, Fx, bestChi2, -val_step) )
+    if Fx_list[-1][1] < Fx:
+        chains.append( (fv, [], scan[-1][1], fixedparams, Fx, bestChi2, val_step) )
+    for chain in session.run_chains( chains ):
+        scan += chain
+    scan.sort( key=lambda x: x[0] ) # sort by parameter value
+    Fx_list = [ [val, params['ReducedChi2']/bestChi2] for val, params in scan ]
+    if Fx_list[0][1] < Fx and Fx_list[0][0]-val_step < 0 and fv in ['l1', 'l2', 'l3']:
+        raise ValueError("long-time component just went negative...")
 
     # interpolate to find values at threshold
     Fx_array = array( Fx_list )
@@ -176,6 +266,134 @@ def get_errorbar( fv, fname=None, trace=None, frac=0.1, additional_fixed=None, p
 
     return error_bar
 
+def _find_crossing( task ):
+    """ worker for adaptive_errorbar: find where the profile ReducedChi2/bestChi2
+        of fv crosses Fx on one side (direction -1 or +1) of the best fit.
+        Returns (crossing or None if the parameter would have to go negative, number of fits). """
+    session, fv, start, fixed, Fx, bestChi2, direction, step, rtol = task
+    best = start[fv]
+    evaluated = [ (best, 1.0, start) ] # (value, F-ratio, warm start for a fit nearby)
+
+    def excess( val ):
+        # warm start from the solution at the nearest value fit so far
+        nearest = min( evaluated, key=lambda e: abs( e[0]-val ) )
+        if nearest[0] == val: return nearest[1] - Fx # e.g. brentq starting at the bracket
+        params = dict( nearest[2] )
+        params[ fv ] = val
+        fitresults = session.fit( params, fixed )
+        evaluated.append( (val, fitresults['ReducedChi2']/bestChi2, session.solution( params, fixed )) )
+        return evaluated[-1][1] - Fx
+
+    # bracket the crossing: assume a parabolic profile through the best fit and the
+    # last point below Fx to guess where it crosses, but grow by at most 4x per step
+    inside, val = best, best + direction*step
+    for i in range( 20 ):
+        if val <= 0:
+            if fv[0] == 'l': return None, len(evaluated)-1
+            val = 0.0
+        if excess( val ) >= 0: break
+        if val == 0.0: return 0.0, len(evaluated)-1 # still below Fx at zero amplitude
+        inside, ratio = val, evaluated[-1][1]
+        distance = abs( inside-best )
+        if ratio > 1.0:
+            distance = min( 4.0*distance, 1.1*distance*sqrt( (Fx-1.0)/(ratio-1.0) ) )
+        else:
+            distance *= 4.0
+        val = best + direction*distance
+    else:
+        raise ValueError("Could not bracket the Fx crossing of %s (profile too flat?)" % fv)
+    crossing = brentq( excess, inside, val, xtol=rtol*abs( val-best ) )
+    return crossing, len(evaluated)-1
+
+def adaptive_errorbar( fv, trace, frac=0.1, additional_fixed=None, guess=dict(),
+                       session=None, processes=None, rtol=0.02, Fx=1.001858 ):
+    """ Same confidence interval as get_errorbar (the F-statistic threshold Fx on
+        ReducedChi2 relative to the best fit, with fv fixed and the rest refit),
+        but found with far fewer fits: each side of the interval is bracketed
+        starting from a step of frac/2 (times the best-fit value) and guided by
+        a parabolic profile, then the crossing is located with brentq to within
+        rtol times the distance from the best-fit value. Both sides run at once
+        (see FitSession).
+        Returns (error_bar, nfits). A lower bound of 0.0 means the amplitude
+        can go to zero; a lifetime that would have to go negative raises ValueError.
+    """
+    bestfit = trace.fitresults.copy()
+    bestChi2 = bestfit['ReducedChi2']
+    fixedparams = [fv]
+    if additional_fixed is not None: fixedparams += additional_fixed
+    if session is None: session = FitSession( trace, processes=processes )
+    start = bestfit.copy()
+    for k, v in guess.iteritems():
+        if k not in fixedparams: start[k] = v
+    step = frac*abs( start[fv] )/2
+    tasks = [ (session, fv, start, fixedparams, Fx, bestChi2, direction, step, rtol)
+              for direction in [-1, 1] ]
+    (lower, nlower), (upper, nupper) = session.map( _find_crossing, tasks )
+    if lower is None:
+        raise ValueError("long-time component just went negative...")
+    return [lower, upper], nlower+nupper
+
+def _fit_replicates( task ):
+    """ worker for bootstrap_errorbars: draw n Poisson resamples of the best
+        fit at once and fit each of them, starting from start. Returns a list
+        of fitresults (None for a fit that failed). """
+    session, bestfit, start, fixed, seed, n = task
+    trace = session.trace
+    curve = trace.curves[0]
+    scaling = curve.max()/trace.raw_curves[0].max() # counts -> units of the curve
+    counts = np.random.RandomState( seed ).poisson( np.clip( bestfit, 0.0, None )/scaling,
+                                                    size=(n, len(bestfit)) )
+    results = []
+    try:
+        for resample in counts:
+            trace.curves[0] = resample*scaling
+            try:
+                results.append( session.fit( start, fixed ).copy() )
+            except (RuntimeError, np.linalg.LinAlgError):
+                results.append( None )
+    finally:
+        trace.curves[0] = curve
+    return results
+
+def bootstrap_errorbars( trace, nboot=200, confidence=0.95, additional_fixed=None, batch=None,
+                         session=None, processes=None, seed=0 ):
+    """ Parametric bootstrap: fit nboot Poisson resamples of trace.bestfit
+        (in counts, weighted like the data), every one starting from the best
+        fit, and take the central `confidence` percentile interval of each
+        parameter over the replicates -- for all of fitresults at once, where
+        get_errorbar/adaptive_errorbar give one parameter per scan.
+        The replicates are drawn and fit in batches of `batch` (by default
+        enough batches to keep every worker process busy) spread over the
+        session's pool (see FitSession). Resamples are reproducible for a
+        given seed and batch.
+        Returns (error_bars, replicates): dicts of [lower, upper] and of the
+        array of replicate values for each fitresults key (not the *_err
+        ones). Failed fits are dropped; replicates['failed'] counts them.
+    """
+    bestfit = trace.fitresults.copy()
+    fixedparams = [] if additional_fixed is None else list( additional_fixed )
+    if session is None: session = FitSession( trace, processes=processes )
+    if batch is None:
+        workers = session.processes or multiprocessing.cpu_count()
+        batch = max( 1, int( ceil( nboot/(4.0*workers) ) ) )
+    sizes = [ min( batch, nboot-i ) for i in range( 0, nboot, batch ) ]
+    tasks = [ (session, trace.bestfit, bestfit, fixedparams, seed+i, n) for i, n in enumerate( sizes ) ]
+    fits = []
+    for results in session.map( _fit_replicates, tasks ): fits += results
+    succeeded = [ r for r in fits if r is not None ]
+    if len( succeeded ) == 0:
+        raise RuntimeError("None of the %d bootstrap fits converged" % nboot)
+
+    keys = [ key for key, value in bestfit.iteritems() if not key.endswith( '_err' )
+             and isinstance( value, (int, float, np.number) ) ]
+    replicates = dict( (key, np.array([ r[key] for r in succeeded ])) for key in keys )
+    tail = 50.0*(1.0-confidence)
+    error_bars = dict( (key, list( np.percentile( values, [tail, 100.0-tail] ) ))
+                       for key, values in replicates.iteritems() )
+    replicates['failed'] = len( fits ) - len( succeeded )
+    return error_bars, replicates
+
+
 def long_time_errorbars( fnames, fv, frac=0.1, additional_fixed=None, plotresult=False ):
     # finding error bar in the "fixed" parameters... I think this is similar to what
     # I did above but with average RChi2 across all traces
@@ -0,0 +1,190 @@
+# Fluorescence-lifetime imaging (FLIM) from raster scans of .phd files.
+#
+# kasey_utils.plot_raster maps the intensity of a raster scan of SPE spectra,
+# one file per position, named ..._x<horiz>_y<vert> (positions in nm).
+# FLIMRaster does the same for a raster of PicoHarp histograms: it loads all
+# pixels at once into one (rows x columns x bins) array (through
+# TraceCollection), can sum neighbouring pixels to raise the counts per pixel,
+# and analyzes every pixel in a pool of worker processes -- a full
+# fit_exponential, the quick estimate_guess, or one lookup of a DecayLibrary
+# for all pixels -- giving lifetime, amplitude and chi-square images on the
+# grid of plot_raster.
+#
+# example usage:
+#   raster = FLIMRaster( 'sample01_' )
+#   raster.wrapcurves( 10.0 )
+#   raster.bin( 2 )  # 2x2 pixels per image pixel
+#   images = raster.images( irf=irffile, dispersion=20, num_exp=2, min_counts=1000 )
+#   hcorners, vcorners = raster.corners()
+#   pcolormesh( hcorners, vcorners, images['l0'] )
+
+import glob
+import numpy as np
+import PicoQuantUtils_FastFit as pq
+import kasey_utils
+
+
+def _analyze_pixel( task ):
+    """ worker for FLIMRaster.images: analyze one pixel's Trace with method
+        'fit' or 'estimate'. Returns a dict of results, or None if the fit failed. """
+    trace, method, kwargs = task
+    if method == 'estimate':
+        return trace.estimate_guess( **kwargs )
+    try:
+        trace.fit_exponential( verbose=False, memoize=False, **kwargs )
+    except (RuntimeError, np.linalg.LinAlgError):
+        return None
+    return trace.fitresults
+
+
+class FLIMRaster():
+    """ A raster scan of .phd files (all of them matching fname_base, which may
+        contain wildcards, or fname_base*.phd), one per position, named like
+        the files of kasey_utils.plot_raster. The files are loaded by a pool
+        of `processes` worker processes (by default one per cpu; processes=1
+        works in this process), which also analyze the pixels (see images).
+
+        self.hlist and self.vlist are the positions (nm) of the columns and
+        rows of the images, self.fname_matrix the file of every pixel (0 where
+        the scan has none).
+    """
+    def __init__( self, fname_base, processes=None ):
+        files = glob.glob( fname_base if '*' in fname_base else fname_base + '*.phd' )
+        if len( files ) == 0:
+            raise ValueError("No .phd files match %s" % fname_base)
+        files.sort()
+        self.processes = processes
+        self.collection = pq.TraceCollection( files, processes=processes )
+        self.hlist, self.vlist = kasey_utils.raster_grid( files )
+        self.fname_matrix = [ [0]*len(self.hlist) for i in range(len(self.vlist)) ]
+        self.pixels = [] # (row, column) of every file
+        for fullfname in files:
+            horiz, vert = kasey_utils.raster_position( fullfname )
+            self.pixels.append( (self.vlist.index( vert ), self.hlist.index( horiz )) )
+            self.fname_matrix[ self.pixels[-1][0] ][ self.pixels[-1][1] ] = fullfname
+        self.binning = 1
+
+    def wrapcurves( self, time, **kwargs ):
+        """ wrap every pixel, see TraceCollection.wrapcurves """
+        self.collection.wrapcurves( time, **kwargs )
+
+    def counts_per_second( self ):
+        self.collection.counts_per_second()
+
+    def bin( self, binning ):
+        """ From now on, sum blocks of binning x binning pixels into one image
+            pixel (at their mean position); bin( 1 ) undoes it. """
+        self.binning = int( binning )
+
+    def cube( self, raw=False ):
+        """ (rows x columns x bins) array of the (binned) pixel curves, or of the
+            raw curves that set their noise; zero where the scan has no file """
+        curves = self.collection.raw_curves if raw else self.collection.curves
+        cube = np.zeros( (len(self.vlist), len(self.hlist), curves.shape[1]) )
+        rows, columns = zip( *self.pixels )
+        cube[ rows, columns ] = curves
+        return self._binned( cube )
+
+    def _binned( self, cube ):
+        """ sum cube (rows x columns x ...) over blocks of self.binning x self.binning """
+        b = self.binning
+        if b == 1: return cube
+        nrows, ncolumns = -(-cube.shape[0]//b), -(-cube.shape[1]//b)
+        padded = np.zeros( (nrows*b, ncolumns*b) + cube.shape[2:] )
+        padded[ :cube.shape[0], :cube.shape[1] ] = cube
+        return padded.reshape( (nrows, b, ncolumns, b) + cube.shape[2:] ).sum( axis=3 ).sum( axis=1 )
+
+    def positions( self ):
+        """ positions (nm) of the columns and rows of the (binned) images """
+        b = self.binning
+        return ( [ np.mean( self.hlist[i:i+b] ) for i in range( 0, len(self.hlist), b ) ],
+                 [ np.mean( self.vlist[i:i+b] ) for i in range( 0, len(self.vlist), b ) ] )
+
+    def corners( self, relative=True ):
+        """ pixel corners (um) of the images for pcolormesh, like plot_raster's
+            (relative to the first pixel if relative=True) """
+        hlist, vlist = self.positions()
+        hcorners, vcorners = kasey_utils.centers_to_corners( hlist ), kasey_utils.centers_to_corners( vlist )
+        if relative:
+            hcorners, vcorners = hcorners-hcorners.min(), vcorners-vcorners.min()
+        return hcorners/1000, vcorners/1000
+
+    def trace( self, row, column, curves=None, raw_curves=None ):
+        """ pixel (row, column) of the (binned) images as a Trace, e.g. to fit it """
+        if curves is None: curves = self.cube()
+        if raw_curves is None: raw_curves = self.cube( raw=True )
+        collection = self.collection
+        header = collection.headers[0]
+        b = self.binning
+        # the first file in the block (binned pixels may be missing some)
+        fnames = [ fname for fnames in self.fname_matrix[row*b:(row+1)*b]
+                         for fname in fnames[column*b:(column+1)*b] if fname ]
+        trace = pq.Trace.from_histogram( curves[row, column].copy(), collection.resolution, header['InpRate0'],
+                                         header['Tacq'], fname=fnames[0] if fnames else None )
+        trace.raw_curves = [ raw_curves[row, column].copy() ]
+        trace.raw_t = [ collection.raw_t.copy() ]
+        trace.t = [ collection.t.copy() ]
+        trace.wraptime = collection.wraptime
+        trace.in_counts_per_second = collection.in_counts_per_second
+        return trace
+
+    def images( self, method='fit', num_exp=1, irf=None, dispersion=None, library=None,
+                min_counts=0, **kwargs ):
+        """ Analyze every (binned) pixel with at least min_counts counts and
+            return a dict of images (rows x columns arrays, NaN where a pixel
+            was skipped or its fit failed): 'counts', and l0, a0, ..., b (and
+            tshift) and, for fits, ReducedChi2, their errors, etc.
+            method --
+                'fit'       fit_exponential of num_exp exponentials (keyword
+                            arguments go to it). Without a guess, each pixel
+                            starts from the DecayLibrary `library` if given,
+                            otherwise from its own estimate_guess.
+                'estimate'  just estimate_guess (much faster).
+                'library'   nearest decay of `library` for all pixels at once
+                            (chi-square approximated from its distance).
+            irf -- IRF file name or Trace: deconvolve with it (blurred by
+                dispersion), see Trace.set_irf.
+        """
+        curves, raw_curves = self.cube(), self.cube( raw=True )
+        counts = raw_curves.sum( axis=2 )
+        pixels = zip( *np.where( counts >= max( min_counts, 1 ) ) )
+        images = dict( counts=counts )
+        def image( key ):
+            if not images.has_key( key ): images[key] = np.NaN*np.ones( counts.shape )
+            return images[key]
+
+        if method == 'library':
+            if library is None: raise ValueError("method='library' needs a DecayLibrary")
+            result = library.lookup( np.array([ curves[pixel] for pixel in pixels ]) )
+            result['ReducedChi2'] = 4*np.array([ counts[pixel] for pixel in pixels ])*result['distance']**2/curves.shape[2]
+            for key, values in result.iteritems():
+                for pixel, value in zip( pixels, values ): image( key )[pixel] = value
+            return images
+        if method not in ['fit', 'estimate']:
+            raise ValueError("method must be 'fit', 'estimate' or 'library', not %s" % method)
+
+        traces = [ self.trace( row, column, curves, raw_curves ) for row, column in pixels ]
+        deconvolve = kwargs.pop( 'deconvolve', irf is not None )
+        if irf is not None and traces:
+            traces[0].set_irf( irf, dispersion=dispersion )
+            for trace in traces[1:]: # share the prepared IRF
+                for name in ['irf', 'irf_dispersion', 'irf_generator', 'irf_dt', 'irf_t0', 'irf_spectra']:
+                    setattr( trace, name, getattr( traces[0], name ) )
+        if method == 'estimate':
+            tasks = [ (trace, method, dict( num_exp=num_exp, deconvolve=deconvolve, **kwargs )) for trace in traces ]
+        else:
+            if library is not None and not kwargs.has_key( 'guess' ):
+                start = library.lookup( np.array([ curves[pixel] for pixel in pixels ]) )
+                guesses = [ dict( (key, float( start[key][i] )) for key in start if key != 'distance' )
+                            for i in range( len(pixels) ) ]
+            else:
+                guesses = [ kwargs.get( 'guess' ) ]*len(pixels)
+            kwargs.pop( 'guess', None )
+            tasks = [ (trace, method, dict( guess=guess, num_exp=None if guess else num_exp,
+                                            deconvolve=deconvolve, **kwargs ))
+                      for trace, guess in zip( traces, guesses ) ]
+        for pixel, result in zip( pixels, pq._pool_map( _analyze_pixel, tasks, self.processes ) ):
+            if result is None: continue
+            for key, value in result.iteritems():
+                if isinstance( value, (int, float, np.number) ): image( key )[pixel] = value
+        return images
@@ -0,0 +1,206 @@
+# Global lifetime analysis: fit many traces at once, with some parameters
+# (typically the lifetimes) shared by all of them and the rest (amplitudes,
+# tshift, ...) fit separately for each trace.
+#
+# find_errorbar.long_time_errorbars approximates this with an fmin over the
+# shared lifetimes wrapped around a separate fit of every trace. GlobalFit
+# instead solves one least-squares problem for all traces together. Trace k
+# only depends on the shared parameters and its own, so the jacobian is
+# block-sparse; scipy's least_squares is told so (jac_sparsity) and only needs
+# (number of shared + number of per-trace parameters) evaluations of all
+# models per jacobian, however many traces there are.
+#
+# example usage:
+#   traces = []
+#   for fname in glob.glob( 'wire*.phd' ):
+#       trace = pq.Trace( fname )
+#       trace.wrapcurves( 10.0 )
+#       trace.set_irf( irffile, wraptime=10.0 )
+#       traces.append( trace )
+#   g = GlobalFit( traces, guess=dict( l0=0.1, a0=1.0e3, l1=0.8, a1=1.0e3, l2=3.0, a2=1.0e2, b=0.0, tshift=-0.5 ),
+#                  shared=['l1', 'l2'] )
+#   g.fit()
+#   print g.shared_values, g.shared_err, g.ReducedChi2
+#   print traces[0].fitresults  # per-trace results, just like after trace.fit_exponential()
+
+import numpy as np
+from scipy.optimize import least_squares
+from scipy.sparse import lil_matrix
+import PicoQuantUtils_FastFit as pq
+
+
+def count_exponentials( guess ):
+    """ number of exponentials in a fit_exponential-style guess (l0, a0, l1, a1, ...) """
+    num_exp = 1
+    while guess.has_key( 'l%d' % num_exp ): num_exp += 1
+    num_a = 1
+    while guess.has_key( 'a%d' % num_a ): num_a += 1
+    if num_exp != num_a:
+        raise ValueError("Missing a parameter! Unequal number of lifetimes and amplitudes.")
+    return num_exp
+
+
+class GlobalFit():
+    """ A multi-exponential fit of all `traces` (PicoQuantUtils_FastFit.Trace
+        objects, already wrapped and, for deconvolve=True, with their IRF set)
+        in which the parameters named in `shared` take the same value for
+        every trace.
+
+        guess is one fit_exponential-style dict used for every trace, or a list
+        with one dict per trace (the shared parameters start from the first).
+        Parameters in fixed_params are held at their guess. With
+        deconvolve=True the offset b is not part of the convolved model and
+        is not fit (as with fit_exponential( varpro=True )).
+    """
+    def __init__( self, traces, guess, shared, fixed_params=[None], deconvolve=True,
+                  tstart=0.0, tend=None, curve_num=0, convolution='recursive' ):
+        self.traces = list( traces )
+        if isinstance( guess, dict ):
+            guesses = [ guess ]*len( self.traces )
+        else:
+            guesses = list( guess )
+        if len( guesses ) != len( self.traces ):
+            raise ValueError("Need one guess per trace (or a single guess for all of them)")
+        self.deconvolve = deconvolve
+        self.tstart = tstart
+        self.curve_num = curve_num
+
+        self.num_exp = count_exponentials( guesses[0] )
+        keylist = pq.exponential_keys( self.num_exp )
+        if deconvolve:
+            for key in ['tshift', 'trise']:
+                if guesses[0].has_key( key ): keylist.append( key )
+        inactive = [ 'b' ] if deconvolve else []
+        self.keylist = keylist
+        self.shared = [ key for key in keylist if key in shared and key not in fixed_params and key not in inactive ]
+        self.local = [ key for key in keylist if key not in shared and key not in fixed_params and key not in inactive ]
+        self.shared_index = [ keylist.index( key ) for key in self.shared ]
+        self.local_index = [ keylist.index( key ) for key in self.local ]
+
+        self.params = [ np.array( [ g[key] for key in keylist ], dtype=np.float ) for g in guesses ]
+        self.data = []    # (y, sigma) on the fitting window of each trace
+        self.models = []  # model of each trace on its fitting window, as a function of the full parameter list
+        for trace, g in zip( self.traces, guesses ):
+            t = np.array( trace.t[curve_num], dtype=np.float )
+            sigma = trace.sigma( curve_num )
+            if deconvolve:
+                if trace.irf is None: raise AttributeError("No detector trace for %s!!! Use set_irf() first." % trace.fname)
+                import pyximport; pyximport.install()
+                import FastFit
+                function = FastFit.Convolved( "multi_exp",
+                        np.array( [ g[key] for key in keylist ], dtype=np.float ),
+                        np.arange( len(keylist), dtype=np.float ), # evaluate() takes the full parameter list
+                        g,
+                        1.0e9/trace.curveheaders[0]['InpRate0'],
+                        trace.irf_dt,
+                        trace.irf_t0,
+                        trace.irf_generator,
+                        sigma,
+                        convolution=convolution,
+                        irf_spectra=trace.irf_spectra )
+                function.prepare_irf( t )
+                self.models.append( lambda p, function=function, t=t: function.evaluate( p, t ) )
+                self.data.append( (np.asarray( trace.curves[curve_num], dtype=np.float ), sigma) )
+            else:
+                istart = np.where( t >= tstart )[0][0]
+                iend = np.where( t <= tend )[0][-1] if tend is not None else len(t)
+                t_fit = t[istart:iend]-tstart
+                self.models.append( lambda p, t=t_fit: pq.multi_exponential( t, p[0:-1:2], p[1:-1:2], p[-1] ) )
+                self.data.append( (np.asarray( trace.curves[curve_num][istart:iend], dtype=np.float ), sigma[istart:iend]) )
+
+        # parameter vector: shared parameters, then the local ones of trace 0, trace 1, ...
+        nshared, nlocal = len( self.shared ), len( self.local )
+        self.x0 = np.concatenate( [ self.params[0][self.shared_index] ] +
+                                  [ p[self.local_index] for p in self.params ] )
+        self.rows = np.cumsum( [0] + [ len(y) for y, sigma in self.data ] )
+        self.sparsity = lil_matrix( (self.rows[-1], len(self.x0)), dtype=np.int8 )
+        for k in range( len( self.traces ) ):
+            self.sparsity[ self.rows[k]:self.rows[k+1], :nshared ] = 1
+            self.sparsity[ self.rows[k]:self.rows[k+1], nshared+k*nlocal:nshared+(k+1)*nlocal ] = 1
+
+    def unpack( self, x ):
+        """ copy the parameter vector x into the full parameter list of every trace """
+        nshared, nlocal = len( self.shared ), len( self.local )
+        for k, p in enumerate( self.params ):
+            p[self.shared_index] = x[:nshared]
+            p[self.local_index] = x[nshared+k*nlocal:nshared+(k+1)*nlocal]
+
+    def residuals( self, x ):
+        self.unpack( x )
+        return np.concatenate( [ (y - model( p ))/sigma for p, model, (y, sigma)
+                                 in zip( self.params, self.models, self.data ) ] )
+
+    def fit( self, verbose=False, **kwargs ):
+        """ Run the joint fit (keyword arguments go to scipy.optimize.least_squares).
+            Sets self.shared_values and self.shared_err (dicts), self.ReducedChi2
+            (all traces together) and, for every trace, trace.fitresults,
+            trace.bestfit (and trace.model) just like fit_exponential does:
+            the components of trace.fitresults are numbered shortest lifetime
+            first, while shared_values keeps the names given in `shared`.
+        """
+        kwargs.setdefault( 'x_scale', 'jac' )
+        self.result = least_squares( self.residuals, self.x0, jac_sparsity=self.sparsity,
+                                     verbose=2 if verbose else 0, **kwargs )
+        residuals = self.residuals( self.result.x )
+
+        # covariance as leastsq would report it (scaled by the reduced chi^2 without deconvolution, like curve_fit)
+        J = self.result.jac
+        JTJ = J.T.dot( J )
+        JTJ = JTJ.toarray() if hasattr( JTJ, 'toarray' ) else np.asarray( JTJ )
+        try:
+            pcov = np.linalg.inv( JTJ )
+        except np.linalg.LinAlgError:
+            pcov = np.inf*np.ones( JTJ.shape )
+        dof = len( residuals ) - len( self.x0 )
+        self.ReducedChi2 = np.sum( residuals**2 )/dof
+        if not self.deconvolve:
+            pcov *= self.ReducedChi2
+        self.pcov = pcov
+        err = np.sqrt( np.diag( pcov ) )
+
+        nshared, nlocal = len( self.shared ), len( self.local )
+        self.shared_values = dict( zip( self.shared, self.result.x[:nshared] ) )
+        self.shared_err = dict( zip( self.shared, err[:nshared] ) )
+        for key in self.shared_values:
+            if key[0] in 'la': self.shared_values[key] = abs( self.shared_values[key] )
+        for k, (trace, p, model, (y, sigma)) in enumerate( zip( self.traces, self.params, self.models, self.data ) ):
+            errors = dict( zip( self.local, err[nshared+k*nlocal:nshared+(k+1)*nlocal] ) )
+            errors.update( self.shared_err )
+            self.store_results( trace, p, errors, model( p ), y, sigma, nlocal )
+
+    def store_results( self, trace, p, errors, fit, y, sigma, nfree ):
+        """ fill trace.fitresults, bestfit, etc. the way fit_exponential does
+            (fit is the model on the fitting window, y and sigma the data there) """
+        results = dict()
+        for key, value in zip( self.keylist, p ):
+            results[key] = abs( value ) if key[0] in 'la' or key == 'trise' else value
+            results[key+'_err'] = errors.get( key, np.NaN )
+        # number the components with the shortest lifetime as l0, like fit_exponential
+        components = sorted( [ tuple( results[key % i] for key in ['l%d', 'a%d', 'l%d_err', 'a%d_err'] )
+                               for i in range( self.num_exp ) ] )
+        for i, values in enumerate( components ):
+            for key, value in zip( ['l%d', 'a%d', 'l%d_err', 'a%d_err'], values ):
+                results[key % i] = value
+        for i in range( self.num_exp ):
+            results['l%d_int' % i] = results['l%d' % i]*results['a%d' % i]
+        curve = trace.curves[self.curve_num]
+        t = np.array( trace.t[self.curve_num], dtype=np.float )
+        if self.deconvolve:
+            results['irf_dispersion'] = trace.irf_dispersion
+            trace.bestfit = fit
+            trace.model = np.zeros( len(t) )
+            for i in range( self.num_exp ):
+                l, a = abs( results['l%d' % i] ), results['a%d' % i]
+                trace.model += a*np.exp( -t/l )/(1.0-np.exp( -1.0e9/trace.curveheaders[0]['InpRate0']/l ))
+            if results.has_key( 'trise' ): trace.model *= 1.0-np.exp( -t/results['trise'] )
+        else:
+            trace.bestfit = pq.multi_exponential( t-self.tstart, p[0:-1:2], p[1:-1:2], p[-1] )
+        degrees_of_freedom = len(y) - nfree
+        Chi2 = np.sum( ((fit - y)/sigma)**2 )
+        Chi2 *= trace.raw_curves[0].max()/curve.max() # undo any scaling
+        results['MSE'] = np.mean( (fit - y)**2 )/degrees_of_freedom
+        results['ReducedChi2'] = Chi2/degrees_of_freedom
+        trace.fitresults = results
+        trace.fitstart = self.tstart
+        trace.deconvolved = self.deconvolve
+        trace.has_fit = True
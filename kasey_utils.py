@@ -108,6 +108,23 @@ def parse_fname_for_wirenum_and_angle(fname_parallel,fname_perpendicular):
     if nums==[]: raise NameError('Function parse_fname_for_wirenum_and_angle could not successfully find angle.')
     return wire, float(''.join(nums)) # return the angle as a floating point number
     
+def raster_position( fullfname ):
+    """ (horizontal, vertical) position in nm of a raster-scan file written by
+        the python program, e.g. PbS10_wire06_x12796_y9083.SPE -> (12796.0, 9083.0) """
+    fname = str( os.path.splitext( os.path.basename( fullfname ) )[0] )
+    horiz = float( fname.split('x')[1].split('_')[0] ) # this is an absolute position in nanometers
+    vert = float( fname.split('y')[1] )
+    return horiz, vert
+
+def raster_grid( files ):
+    """ sorted lists of the distinct horizontal and vertical positions (nm) of
+        the raster-scan files; pixel (vlist.index(vert), hlist.index(horiz))
+        of a raster image holds the file at (horiz, vert). """
+    positions = [ raster_position( fullfname ) for fullfname in files ]
+    hlist = sorted( set( horiz for horiz, vert in positions ) ) # remove duplicate elements
+    vlist = sorted( set( vert for horiz, vert in positions ) )
+    return hlist, vlist
+
 def plot_raster( fname_base, interval='full', plot_relative_position=True, fignum=1, program='python', flipx=False, flipy=True, normalize=True ):
     """ 
     Plot a raster scan acquired using either the Excel program or (in the future) the python program.
@@ -133,12 +150,7 @@ def plot_raster( fname_base, interval='full', plot_relative_position=True, fignu
     vlist = []
     hlist = []
     if program == 'python':
-        for fullfname in files:
-            fname = str( os.path.splitext( os.path.basename( fullfname ) )[0] )
-            horiz = float( fname.split('x')[1].split('_')[0] ) # this is an absolute position in nanometers
-            hlist.append( horiz )
-            vert = float( fname.split('y')[1] )
-            vlist.append( vert )
+        hlist, vlist = raster_grid( files )
     elif program == 'excel':
         raise ValueError( 'now only supporting python-generated data' )
         for fname in files:
@@ -147,12 +159,7 @@ def plot_raster( fname_base, interval='full', plot_relative_position=True, fignu
             horiz = float( fname.split('horiz')[1].split('.')[0] )
             hlist.append( horiz )
 
-    vlist = list( set(vlist) ) # remove duplicate elements
-    vlist.sort()
     vcen = centers_to_corners( vlist )
-
-    hlist = list( set(hlist) )
-    hlist.sort()
     hcen = centers_to_corners( hlist )
 
     if plot_relative_position:
@@ -165,9 +172,7 @@ def plot_raster( fname_base, interval='full', plot_relative_position=True, fignu
     lum = np.zeros([ len(vlist), len(hlist) ]) # initialize matrix for holding luminescence data
     fname_matrix = [ [0]*len(hlist) for i in range(len(vlist)) ]  # initialize matrix for holding names of files
     for fullfname in files:
-        fname = str( os.path.splitext( os.path.basename( fullfname ) )[0] )
-        horiz = float( fname.split('x')[1].split('_')[0] ) # this is an absolute position in nanometers
-        vert = float( fname.split('y')[1] )
+        horiz, vert = raster_position( fullfname )
         wavelen, d = spe.getSpectrum( fullfname )
         lum[ vlist.index(vert), hlist.index(horiz) ] = ( np.sum(d) if type(interval) is str else np.sum(d[interval]) )
         fname_matrix[vlist.index(vert)][hlist.index(horiz)] = fullfname
@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 from __future__ import division
 import kasey_utils as kc
+import filecache
 import numpy as np
 import matplotlib.pyplot as plt
 
@@ -115,6 +116,7 @@ def load1D_timeseries( fname ):
 
         return np.loadtxt( fname, delimiter=',', skiprows=skiplines,dtype='float' )
 
+@filecache.cached( 'pyLumerical.load2D' )
 def load2D( fname ):
     """
     Say you used a frequency-domain field profile monitor and
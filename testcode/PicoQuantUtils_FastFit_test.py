@@ -0,0 +1,73 @@
+'''
+Tests of the initial guess and the fit cache of PicoQuantUtils_FastFit
+
+@author: Shanying
+'''
+
+import shutil
+import tempfile
+import numpy as np
+import filecache
+import PicoQuantUtils_FastFit as pq
+
+filecache.enabled = False
+
+def synthetic_trace( tau, ipeak, b=1.0, amplitude=1000.0, seed=0 ):
+    """ Single exponential decay of a 76 MHz laser in 4 ps bins, with the
+        peak (rise of 5 bins) at bin ipeak, decaying around the period.
+    """
+    resolution, inprate0 = 0.004, 76.0e6
+    n = int( 1.0e9/inprate0/resolution )
+    t = np.arange( n )*resolution
+    dt = (t - t[ipeak]) % (n*resolution)
+    decay = amplitude*np.exp( -dt/tau )/(1.0 - np.exp( -n*resolution/tau ))
+    rise = np.clip( 1.0 - ((ipeak - np.arange( n )) % n)/5.0, 0.0, 1.0 )
+    model = np.where( (ipeak - np.arange( n )) % n < 5, amplitude*rise, decay ) + b
+    curve = np.random.RandomState( seed ).poisson( model )
+    return pq.Trace.from_histogram( curve, resolution, inprate0, 1000 )
+
+class testEstimateGuess():
+
+    def check( self, trace, tau ):
+        guess = trace.estimate_guess()
+        print guess
+        assert abs( guess['l0'] - tau ) < 0.1*tau
+        assert abs( guess['b'] - 1.0 ) < 0.5
+
+    def testLatePeak(self):
+        self.check( synthetic_trace( 1.4, 1500 ), 1.4 )
+
+    def testPeakNearZero(self):
+        # the peak right after t=0: the rise is wrapped to the end of the curve
+        self.check( synthetic_trace( 1.4, 20 ), 1.4 )
+
+    def testWrapped(self):
+        trace = synthetic_trace( 1.4, 300 )
+        trace.wrapcurves( 1.0 )
+        self.check( trace, 1.4 )
+
+class testMemoizedFit():
+
+    def setUp(self):
+        self.cache_dir = filecache.CACHE_DIR
+        filecache.CACHE_DIR = tempfile.mkdtemp()
+        filecache.enabled = True
+
+    def tearDown(self):
+        filecache.enabled = False
+        shutil.rmtree( filecache.CACHE_DIR )
+        filecache.CACHE_DIR = self.cache_dir
+
+    def testRefitThenHit(self):
+        # the second fit of the same trace keeps some attributes' objects
+        # (has_fit, deconvolved, fitstart): they must be stored all the same
+        trace = synthetic_trace( 1.4, 300 )
+        trace.fit_exponential( num_exp=1, verbose=False )
+        trace.fit_exponential( num_exp=1, tend=10.0, verbose=False )
+        fresh = synthetic_trace( 1.4, 300 )
+        fresh.fit_exponential( num_exp=1, tend=10.0, verbose=False )
+        assert fresh.has_fit
+        assert fresh.deconvolved == False
+        assert fresh.fitstart == 0.0
+        assert fresh.fitresults == trace.fitresults
+        assert np.all( fresh.bestfit == trace.bestfit )
@@ -30,6 +30,7 @@ import struct # deal with binary data
 import numpy
 import pylab
 import kasey_fitspectra as kcfit
+import filecache
 
 class Spectrum():
     """
@@ -808,6 +809,7 @@ def get_spectrum( spefile, cts_per_sec=False ):
 
     return wavelength, luminescence
 
+@filecache.cached( 'winspec.read_spe' )
 def read_spe(spefilename, verbose=False):
     """ 
     Read a binary PI SPE file into a python dictionary